@@ -10,6 +10,8 @@ from api.models.user_models import User
 from api.models.generation_models import Generation
 from api.models.bg_removal_models import BackgroundRemoval
 from api.models.preprocess_models import Preprocess
+from api.models.job_models import GenerationJob
+from api.models.webhook_models import WebhookDelivery
 
 from sqlmodel import SQLModel
 
@@ -1,19 +1,70 @@
+import secrets
+
+from decouple import config
 from fastapi import Security, HTTPException, status, Depends
 from fastapi.security import APIKeyHeader
-from sqlalchemy.orm import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from database.utils import check_api_key, get_user_from_api_key
+from api.models.user_models import User
+from api.utils.cache import StatsTTLCache
+from database.utils import get_user_from_api_key, set_user_active
 from database.connection import get_db
 
 api_key_header = APIKeyHeader(name="X-PRESTI-API-KEY")
 
+# Key of the internal endpoints, like /healthcheck/stats, sent in the same
+# header. They are refused to everyone while it is not set.
+ADMIN_API_KEY = config("ADMIN_API_KEY", default="", cast=str)
+
+# Positive and negative API key lookups, so authentication does not hit Postgres
+# on every request. Entries are local to the process: deactivating a key on
+# another instance is picked up once the TTL expires.
+user_cache = StatsTTLCache(
+    name="auth_users",
+    maxsize=config("AUTH_CACHE_MAX_SIZE", default=10_000, cast=int),
+    ttl=config("AUTH_CACHE_TTL_SECONDS", default=60, cast=float),
+    negative_ttl=config("AUTH_CACHE_NEGATIVE_TTL_SECONDS", default=10, cast=float),
+)
+
+
+def invalidate_api_key(api_key: str) -> None:
+    user_cache.invalidate(api_key)
+
 
-def get_user(
-    api_key_header: str = Security(api_key_header), db: Session = Depends(get_db)
+async def deactivate_api_key(api_key: str, db: AsyncSession) -> User | None:
+    """Deactivate the user owning the API key and evict it from the auth cache."""
+    user = await get_user_from_api_key(api_key, db)
+    if user:
+        await set_user_active(user, False, db)
+    invalidate_api_key(api_key)
+    return user
+
+
+async def get_user(
+    api_key_header: str = Security(api_key_header), db: AsyncSession = Depends(get_db)
 ):
-    if check_api_key(api_key_header, db):
-        user = get_user_from_api_key(api_key_header, db)
+    found, user = user_cache.lookup(api_key_header)
+    if not found:
+        user = await get_user_from_api_key(api_key_header, db)
+        if user and not user.is_active:
+            user = None
+        if user:
+            # Detach the user so that commits made later in the request do not
+            # expire the instance shared through the cache
+            db.expunge(user)
+        user_cache.set(api_key_header, user)
+
+    if user:
         return user
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key"
     )
+
+
+async def require_admin(api_key_header: str = Security(api_key_header)) -> None:
+    if not ADMIN_API_KEY or not secrets.compare_digest(
+        api_key_header.encode(), ADMIN_API_KEY.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Admin API key required"
+        )
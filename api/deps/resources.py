@@ -0,0 +1,8 @@
+from fastapi import Request
+
+from api.resources import Resources
+
+
+def get_resources(request: Request) -> Resources:
+    """Shared clients built by the app lifespan."""
+    return request.app.state.resources
@@ -1,12 +1,93 @@
-from fastapi import APIRouter
-from .schemas import HealthResponse
+from fastapi import APIRouter, Depends
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from api.deps.auth import require_admin, user_cache
+from api.deps.resources import get_resources
+from api.endpoints.v1.generate_background.helpers import enhanced_prompt_cache
+from api.resources import Resources
+from api.utils.bulkhead import BULKHEADS
+from api.utils.cutout_cache import cutout_cache
+from api.utils.photoroom import photoroom_connection_stats
+from api.utils.retry_policy import CIRCUIT_BREAKERS, CIRCUIT_OPEN
+from api.utils.runpod import endpoint_id
+from api.utils.translate import translation_cache
+from .schemas import HealthResponse, StatsResponse
 
 router = APIRouter()
 
 
+class ResilienceCollector(Collector):
+    """Exports the bulkheads and circuit breakers as gauges, read at scrape time."""
+
+    def collect(self):
+        in_flight = GaugeMetricFamily(
+            "presti_upstream_in_flight",
+            "Calls in flight per upstream bulkhead.",
+            labels=["upstream"],
+        )
+        waiting = GaugeMetricFamily(
+            "presti_upstream_waiting",
+            "Calls waiting for a slot per upstream bulkhead.",
+            labels=["upstream"],
+        )
+        for name, bulkhead in BULKHEADS.items():
+            in_flight.add_metric([name], bulkhead.in_flight)
+            waiting.add_metric([name], bulkhead.waiting)
+        circuit_open = GaugeMetricFamily(
+            "presti_circuit_open",
+            "Whether the circuit of an upstream is open.",
+            labels=["upstream"],
+        )
+        for name, breaker in CIRCUIT_BREAKERS.items():
+            circuit_open.add_metric([name], breaker.state == CIRCUIT_OPEN)
+        yield in_flight
+        yield waiting
+        yield circuit_open
+
+
+REGISTRY.register(ResilienceCollector())
+
+
 @router.get("/healthcheck", response_model=HealthResponse)
 async def health():
     """
     Health check endpoint to verify if the service is running.
     """
     return HealthResponse(status="ok")
+
+
+# The stats show the upstream endpoints and the load of the instance, they are
+# only for the team
+@router.get(
+    "/healthcheck/stats",
+    response_model=StatsResponse,
+    include_in_schema=False,
+    dependencies=[Depends(require_admin)],
+)
+async def stats(resources: Resources = Depends(get_resources)):
+    """
+    Internal counters of this instance, used to tune connection pools, caches and queues.
+    """
+    return StatsResponse(
+        upstream_connections={"photoroom": photoroom_connection_stats.stats()},
+        caches={
+            "auth_users": user_cache.stats(),
+            "cutouts": cutout_cache.stats(),
+            "enhanced_prompts": enhanced_prompt_cache.stats(),
+            "translations": translation_cache.stats(),
+        },
+        write_behind=resources.write_behind.stats(),
+        bulkheads={name: bulkhead.stats() for name, bulkhead in BULKHEADS.items()},
+        circuit_breakers={
+            name: breaker.stats() for name, breaker in CIRCUIT_BREAKERS.items()
+        },
+        runpod_hedging={
+            model: {
+                endpoint_id(url): resources.runpod.hedge_stats[url].stats()
+                for url in urls
+            }
+            for model, urls in resources.router.endpoints.items()
+        },
+        runpod_routing=resources.router.stats(),
+    )
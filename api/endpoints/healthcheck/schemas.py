@@ -6,3 +6,27 @@ class HealthResponse(BaseModel):
         description="The status of the service. Should be 'ok' if the service is running correctly.",
         example="ok",
     )
+
+
+class StatsResponse(BaseModel):
+    upstream_connections: dict[str, dict] = Field(
+        description="Connection pool usage per upstream service: requests sent, connections opened and how often an open connection was reused.",
+    )
+    caches: dict[str, dict] = Field(
+        description="Size, hits, misses and evictions of the in-process caches.",
+    )
+    write_behind: dict = Field(
+        description="Usage records and uploads queued, written, spilled to disk and replayed by the write-behind queue.",
+    )
+    bulkheads: dict[str, dict] = Field(
+        description="Concurrency limit per upstream service: calls in flight and waiting, calls admitted and rejected, and the time calls waited for a slot.",
+    )
+    circuit_breakers: dict[str, dict] = Field(
+        description="Circuit state per upstream service (closed, open or half_open), consecutive failures, times opened and calls rejected while open.",
+    )
+    runpod_hedging: dict[str, dict] = Field(
+        description="Hedged RunPod calls per model and endpoint (when RUNPOD_HEDGING is on): calls, duplicates submitted and how often they won, losers cancelled, latency percentiles and the queue time and latency past which a call is hedged.",
+    )
+    runpod_routing: dict = Field(
+        description="Calls failed over to another endpoint, and per model and endpoint: the latency average and last /health probe the calls are routed on, calls and failures.",
+    )
@@ -1,56 +1,96 @@
+import asyncio
+import hashlib
 import os
 from fastapi import HTTPException
 
-from api.endpoints.v1.generate_background.schema import GenerateBackgroundRequest
+from api.endpoints.v1.generate_background.schema import GenerateBackgroundOptions
 import api.utils.image as image_utils
+import api.utils.image_kernels as image_kernels
 import api.utils.translate as translate_utils
 from PIL import Image
 from decouple import config
-from typing import Literal, Optional
+from typing import Literal, Optional, Union
 
-from openai import OpenAI
-from retry import retry
+from openai import AsyncOpenAI
 
+from api.utils.cache import StatsTTLCache
+from api.utils import metrics
+from api.utils.image_pool import ImageProcessPool, SharedImage
+from api.utils.openai_client import openai_bulkhead, openai_retry
 from api.utils.constants import FLUX_PROMPTING_SYSTEM_INSTRUCTIONS, NEGATIVE_PROMPT
 
+FLUX_PROMPTING_MODEL = "gpt-4.1-nano"
 
-@retry(tries=3, delay=1, backoff=2)
-def get_flux_improved_prompt(translated_prompt: str, product_image: str) -> str:
-    client = OpenAI(api_key=config("OPENAI_API_KEY", cast=str))
-
-    response = client.chat.completions.create(
-        model="gpt-4.1-nano",
-        messages=[
-            {"role": "system", "content": FLUX_PROMPTING_SYSTEM_INSTRUCTIONS},
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Improve the following Flux prompt: {translated_prompt}. You need to first guess the packshot type using the image provided. Position it logically in the improved Flux prompt at the very beginning.",
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": product_image,
+# Enhanced prompts keyed by (translated prompt, packshot hash, LLM model). The
+# control image is derived from the packshot, the raw bytes are hashed rather
+# than its much larger base64 encoding.
+enhanced_prompt_cache = StatsTTLCache(
+    name="enhanced_prompts",
+    maxsize=config("ENHANCED_PROMPT_CACHE_MAX_SIZE", default=2_000, cast=int),
+    ttl=config("ENHANCED_PROMPT_CACHE_TTL_SECONDS", default=24 * 3600, cast=float),
+)
+
+
+@openai_retry
+async def get_flux_improved_prompt(
+    translated_prompt: str, product_image: str, openai_client: AsyncOpenAI
+) -> str:
+    async with openai_bulkhead.slot():
+        response = await openai_client.chat.completions.create(
+            model=FLUX_PROMPTING_MODEL,
+            messages=[
+                {"role": "system", "content": FLUX_PROMPTING_SYSTEM_INSTRUCTIONS},
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"Improve the following Flux prompt: {translated_prompt}. You need to first guess the packshot type using the image provided. Position it logically in the improved Flux prompt at the very beginning.",
                         },
-                    },
-                ],
-            },
-        ],
-    )
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": product_image,
+                            },
+                        },
+                    ],
+                },
+            ],
+        )
 
     return response.choices[0].message.content
 
 
-def get_payload_for_model(
+async def get_flux_improved_prompt_cached(
+    translated_prompt: str,
+    product_image: str,
+    packshot_data: bytes,
+    openai_client: AsyncOpenAI,
+) -> str:
+    """Enhance the prompt, skipping the LLM call if this prompt and packshot were already enhanced."""
+    # Hashing megabytes takes milliseconds, hashlib releases the GIL meanwhile
+    packshot_hash = await asyncio.to_thread(hashlib.sha256, packshot_data)
+    key = (translated_prompt, packshot_hash.hexdigest(), FLUX_PROMPTING_MODEL)
+    found, improved_prompt = enhanced_prompt_cache.lookup(key)
+    if not found:
+        with metrics.stage("generate_background", "enhance_prompt"):
+            improved_prompt = await get_flux_improved_prompt(
+                translated_prompt, product_image, openai_client
+            )
+        enhanced_prompt_cache.set(key, improved_prompt)
+    return improved_prompt
+
+
+async def get_payload_for_model(
     model: Literal["presti_v1", "presti_v2", "presti_v3"],
     translated_prompt: str,
     enhance_prompt: bool,
     base64_string: str,
+    packshot_data: bytes,
     seed: int,
     width: Optional[int],
     height: Optional[int],
+    openai_client: AsyncOpenAI,
 ) -> tuple[dict, str]:
     if model == "presti_v1":
         # SDXL Model
@@ -69,7 +109,9 @@ def get_payload_for_model(
     elif model == "presti_v2":
         # FLUX V2 Model
         final_prompt = (
-            get_flux_improved_prompt(translated_prompt, base64_string)
+            await get_flux_improved_prompt_cached(
+                translated_prompt, base64_string, packshot_data, openai_client
+            )
             if enhance_prompt
             else translated_prompt + ", high resolution, professional photography"
         )
@@ -89,7 +131,9 @@ def get_payload_for_model(
     elif model == "presti_v3":
         # FLUX V5 Model
         final_prompt = (
-            get_flux_improved_prompt(translated_prompt, base64_string)
+            await get_flux_improved_prompt_cached(
+                translated_prompt, base64_string, packshot_data, openai_client
+            )
             if enhance_prompt
             else translated_prompt + ", high resolution, professional photography"
         )
@@ -113,51 +157,85 @@ def get_payload_for_model(
     return payload, final_prompt
 
 
-def preprocess(
-    request: GenerateBackgroundRequest,
-    packshot_image: Image.Image,
-    width: int,
-    height: int,
-) -> tuple[dict, str, str]:
-    # Prepare the control image
+def build_control_image(
+    packshot_image: Image.Image, width: int, height: int, binarize_alpha: bool
+) -> str:
+    """Paste the packshot on a transparent canvas and encode it for the model."""
     control_image = Image.new("RGBA", (width, height))
 
-    # Check if the image has an alpha channel
-    try:
-        alpha_channel = packshot_image.split()[3]
-    except IndexError:
-        # Image doesn't have an alpha channel, raise an appropriate error
-        raise HTTPException(
-            status_code=400,
-            detail="Product image must have a transparent background (alpha channel). Please upload a PNG image with transparency or ensure your image has an alpha channel.",
-        )
-
-    if request.model in ["presti_v2", "presti_v3"]:
+    if binarize_alpha:
         # For Flux models, we convert to a binary mask to avoid the appearance of an edge, it is very visible on
         # low-res packshots (https://presti-ai.slack.com/archives/C077N5HF9BP/p1738139806501099)
-        alpha_channel = alpha_channel.point(lambda x: 255 if x >= 128 else 0)
+        alpha_channel = image_kernels.threshold_alpha_mask(packshot_image)
+    else:
+        alpha_channel = packshot_image.getchannel("A")
 
     control_image.paste(
         im=packshot_image,
         mask=alpha_channel,
     )
 
-    base64_string = image_utils.image_to_base64_string(control_image)
+    return image_utils.image_to_base64_string(control_image)
 
-    # Use translate_prompt_if_needed function
-    translated_prompt, _ = translate_utils.translate_prompt_if_needed(request.prompt)
+
+async def preprocess(
+    request: GenerateBackgroundOptions,
+    packshot_image: Union[Image.Image, SharedImage],
+    packshot_data: bytes,
+    width: int,
+    height: int,
+    openai_client: AsyncOpenAI,
+    image_pool: ImageProcessPool,
+    translated_prompt: Optional[str] = None,
+) -> tuple[dict, str, str]:
+    # Check if the image has an alpha channel
+    if not image_kernels.has_alpha(packshot_image.mode):
+        # Image doesn't have an alpha channel, raise an appropriate error
+        raise HTTPException(
+            status_code=400,
+            detail="Product image must have a transparent background (alpha channel). Please upload a PNG image with transparency or ensure your image has an alpha channel.",
+        )
+
+    control_image_task = metrics.timed(
+        "generate_background",
+        "control_image",
+        image_pool.run(
+            build_control_image,
+            packshot_image,
+            width,
+            height,
+            request.model in ["presti_v2", "presti_v3"],
+        ),
+    )
+    if translated_prompt is None:
+        # The control image is built in a worker process while the prompt is translated
+        base64_string, (translated_prompt, _) = await asyncio.gather(
+            control_image_task,
+            metrics.timed(
+                "generate_background",
+                "translation",
+                translate_utils.translate_prompt_if_needed(
+                    request.prompt, openai_client
+                ),
+            ),
+        )
+    else:
+        # Translated by the caller, once for a whole batch
+        base64_string = await control_image_task
 
     seed = int.from_bytes(os.urandom(2), "big")
 
     # Prepare payload for each model type
-    payload, final_prompt = get_payload_for_model(
+    payload, final_prompt = await get_payload_for_model(
         model=request.model,
         translated_prompt=translated_prompt,
         base64_string=base64_string,
+        packshot_data=packshot_data,
         enhance_prompt=request.enhance_prompt,
         seed=seed,
         width=width,
         height=height,
+        openai_client=openai_client,
     )
     return payload, final_prompt, seed
 
@@ -171,8 +249,16 @@ def postprocess(
         original_width=width,
         original_height=height,
     )
-    generation_image.paste(
-        im=packshot_image,
-        mask=packshot_image,
-    )
-    return generation_image
+    # Generations are opaque, the packshot is blended over its bounding box only
+    return image_kernels.composite_over(generation_image, packshot_image)
+
+
+def postprocess_and_encode(
+    image: Image.Image,
+    packshot_image: Image.Image,
+    width: int,
+    height: int,
+    encoding: image_utils.OutputEncoding,
+) -> bytes:
+    """Postprocess and encode in one worker call, only the encoded bytes come back."""
+    return encoding.encode(postprocess(image, packshot_image, width, height))
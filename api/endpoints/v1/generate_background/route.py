@@ -1,26 +1,66 @@
-import base64
 import datetime
-from io import BytesIO
+import logging
 import time
 import uuid
 import asyncio
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session
+from dataclasses import dataclass
+from typing import Optional
+from decouple import config
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse
+from sqlmodel.ext.asyncio.session import AsyncSession
+from api.endpoints.v1.jobs.schema import GenerationJobResponse
 from api.models.generation_models import Generation
-from api.services.generation_service import create_generation
-from api.utils.runpod import call_runpod_endpoint
+from api.models.job_models import GenerationJob
+from api.services.job_service import create_job, create_jobs
 from database.connection import get_db
-from .helpers import postprocess, preprocess
-from api.utils.constants import ALLOWED_DIMENSIONS, OUTPAINT_MODELS_URL
+from .helpers import postprocess_and_encode, preprocess
+from api.utils.constants import ALLOWED_DIMENSIONS
 import api.utils.image as image_utils
-from .schema import ErrorResponse, GenerateBackgroundRequest, GenerateBackgroundResponse
-from PIL import Image, UnidentifiedImageError
+from api.utils import metrics
+from api.utils.response_format import (
+    binary_image_response,
+    output_encoding,
+    resolve_response_format,
+    url_response,
+)
+from api.utils.public_network import NonPublicURLError, check_public_url
+from api.utils.runpod import endpoint_id
+from api.utils.upload import (
+    decode_base64_image,
+    image_upload_openapi,
+    open_image,
+    parse_upload_options,
+    read_image_upload,
+)
+from .schema import (
+    ErrorResponse,
+    GenerateBackgroundBatchItem,
+    GenerateBackgroundBatchItemResult,
+    GenerateBackgroundBatchRequest,
+    GenerateBackgroundBatchResponse,
+    GenerateBackgroundOptions,
+    GenerateBackgroundRequest,
+    GenerateBackgroundResponse,
+)
 from api.deps.auth import get_user
+from api.deps.resources import get_resources
 from api.models.user_models import User
+from api.resources import Resources
 import api.utils.storage as storage_utils
+import api.utils.translate as translate_utils
+
+logger = logging.getLogger(__name__)
+
+ROUTE = "generate_background"
 
 router = APIRouter()
 
+# Items of a batch generated at the same time, per batch request
+GENERATE_BACKGROUND_BATCH_CONCURRENCY = config(
+    "GENERATE_BACKGROUND_BATCH_CONCURRENCY", default=4, cast=int
+)
+
 
 @router.post(
     "/generate_background",
@@ -28,15 +68,20 @@ router = APIRouter()
     responses={
         200: {
             "model": GenerateBackgroundResponse,
-            "description": "Successfully generated background for the product",
+            "description": 'Successfully generated background for the product. The image is returned as base64 (default), as raw bytes (response_format=binary or Accept: image/png), or as a JSON body {"url": ...} with its stored URL (response_format=url).',
             "content": {
                 "application/json": {
                     "example": {
                         "image": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
                     }
-                }
+                },
+                "image/png": {"schema": {"type": "string", "format": "binary"}},
             },
         },
+        202: {
+            "model": GenerationJobResponse,
+            "description": "Generation submitted as a background job (run_async=true)",
+        },
         401: {"model": ErrorResponse, "description": "API Key missing"},
         403: {"model": ErrorResponse, "description": "Invalid API Key"},
         429: {"model": ErrorResponse, "description": "Rate limit exceeded"},
@@ -102,8 +147,10 @@ curl -X POST 'https://sdk.presti.ai/v1/generate_background' \\
 )
 async def generate_background(
     request: GenerateBackgroundRequest,
+    http_request: Request,
     user: User = Depends(get_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    resources: Resources = Depends(get_resources),
 ):
     """
     Generate a background scene for a product image.
@@ -124,23 +171,335 @@ async def generate_background(
 
     The function will generate a background based on the prompt and compose
     the product image over it.
+
+    With `run_async=true`, the request returns a 202 with a job id as soon as the
+    generation is submitted. Poll GET /v1/jobs/{job_id} to get the output URL, or
+    set `callback_url` to receive the result in a signed webhook.
+
+    Set `response_format=binary` (or send `Accept: image/png`) to receive the raw
+    PNG bytes, or `response_format=url` to only receive the URL of the stored
+    image. Both skip the base64 encoding of large outputs.
     """
     t0 = time.time()
-    # Remove data URI prefix if present
-    if request.product_image.startswith("data:image"):
-        base64_image_data = request.product_image.split(",")[1]
-    else:
-        base64_image_data = request.product_image
+    with metrics.stage(ROUTE, "decode_base64"):
+        image_data = decode_base64_image(request.product_image)
+    return await run_generate_background(
+        http_request, request, image_data, t0, user, db, resources
+    )
+
+
+@router.post(
+    "/generate_background/upload",
+    response_model=GenerateBackgroundResponse,
+    responses={
+        200: {
+            "model": GenerateBackgroundResponse,
+            "description": "Successfully generated background for the product, in the requested response_format",
+            "content": {
+                "image/png": {"schema": {"type": "string", "format": "binary"}}
+            },
+        },
+        202: {
+            "model": GenerationJobResponse,
+            "description": "Generation submitted as a background job (run_async=true)",
+        },
+        400: {"model": ErrorResponse, "description": "Invalid image"},
+        401: {"model": ErrorResponse, "description": "API Key missing"},
+        403: {"model": ErrorResponse, "description": "Invalid API Key"},
+        413: {"model": ErrorResponse, "description": "Image too large"},
+        415: {"model": ErrorResponse, "description": "Unsupported content type"},
+        429: {"model": ErrorResponse, "description": "Rate limit exceeded"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    },
+    openapi_extra={
+        **image_upload_openapi(
+            GenerateBackgroundOptions,
+            "product_image",
+            "Image of the product on a transparent background.",
+        ),
+        "x-codeSamples": [
+            {
+                "lang": "Python",
+                "source": """
+import requests
+
+url = "https://sdk.presti.ai/v1/generate_background/upload"
+headers = {"X-PRESTI-API-KEY": "your_api_key_here"}
+
+with open("packshot.png", "rb") as f:
+    response = requests.post(
+        url,
+        headers=headers,
+        files={"product_image": ("packshot.png", f, "image/png")},
+        data={"prompt": "luxury living room with modern furniture, warm lighting"},
+    )
+print(response.json()["image"])
+""",
+            },
+            {
+                "lang": "cURL",
+                "source": """
+curl -X POST 'https://sdk.presti.ai/v1/generate_background/upload' \\
+    -H 'X-PRESTI-API-KEY: your_api_key_here' \\
+    -F 'product_image=@packshot.png' \\
+    -F 'prompt=luxury living room with modern furniture, warm lighting'
+""",
+            },
+        ],
+    },
+)
+async def generate_background_upload(
+    http_request: Request,
+    user: User = Depends(get_user),
+    db: AsyncSession = Depends(get_db),
+    resources: Resources = Depends(get_resources),
+):
+    """
+    Generate a background scene for a product image sent as binary instead of base64.
+
+    The image is sent either as the `product_image` field of a `multipart/form-data`
+    body, with the options as the other form fields, or as the raw body of an
+    `image/png` or `image/webp` request, with the options in the query string.
+    This avoids the base64 overhead for large packshots. The image requirements
+    and options are the same as for POST /v1/generate_background.
+    """
+    t0 = time.time()
+    with metrics.stage(ROUTE, "read_upload"):
+        image_data, params = await read_image_upload(http_request, "product_image")
+    with metrics.stage(ROUTE, "validation"):
+        request = parse_upload_options(GenerateBackgroundOptions, params)
+    return await run_generate_background(
+        http_request, request, image_data, t0, user, db, resources
+    )
+
+
+@router.post(
+    "/generate_background/batch",
+    response_model=GenerateBackgroundBatchResponse,
+    responses={
+        200: {
+            "model": GenerateBackgroundBatchResponse,
+            "description": "All the items were processed. Each result is 'completed' or 'failed'.",
+        },
+        202: {
+            "model": GenerateBackgroundBatchResponse,
+            "description": "The items were submitted as background jobs (run_async=true). Each result is 'queued' or 'failed'.",
+        },
+        401: {"model": ErrorResponse, "description": "API Key missing"},
+        403: {"model": ErrorResponse, "description": "Invalid API Key"},
+        429: {"model": ErrorResponse, "description": "Rate limit exceeded"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    },
+    openapi_extra={
+        "x-codeSamples": [
+            {
+                "lang": "Python",
+                "source": """
+import requests
+
+url = "https://sdk.presti.ai/v1/generate_background/batch"
+headers = {"X-PRESTI-API-KEY": "your_api_key_here"}
+payload = {
+    "prompt": "luxury living room with modern furniture, warm lighting",
+    "response_format": "url",
+    "items": [
+        {"product_image": "data:image/png;base64,..."},
+        {"product_image": "data:image/png;base64,...", "prompt": "scandinavian bedroom, morning light"},
+    ],
+}
+
+response = requests.post(url, json=payload, headers=headers)
+for result in response.json()["results"]:
+    print(result["index"], result["status"], result["url"] or result["error"])
+""",
+            },
+        ]
+    },
+)
+async def generate_background_batch(
+    request: GenerateBackgroundBatchRequest,
+    user: User = Depends(get_user),
+    db: AsyncSession = Depends(get_db),
+    resources: Resources = Depends(get_resources),
+):
+    """
+    Generate backgrounds for several product images in one request.
+
+    Each item takes a product image, with the same requirements as for
+    POST /v1/generate_background, and optionally its own prompt. Items without
+    a prompt use the prompt of the batch. Each distinct prompt is translated
+    once for the whole batch. The other options apply to every item.
+
+    Items are generated concurrently. A failed item does not fail the batch:
+    its result has the `failed` status and an error message.
+
+    With `run_async=true`, the request returns a 202 as soon as every item is
+    submitted, with a job id per item. Poll GET /v1/jobs/batches/{batch_id} for
+    the status of all the jobs, or set `callback_url` to receive a webhook per job.
+    """
+    batch_id = uuid.uuid4()
+    await check_callback_url(request)
+
+    # Distinct prompts are translated once, before the items are fanned out
+    prompts = list({item.prompt or request.prompt for item in request.items})
+    translations = await asyncio.gather(
+        *(
+            translate_utils.translate_prompt_if_needed(prompt, resources.openai_client)
+            for prompt in prompts
+        )
+    )
+    translated_prompts = {
+        prompt: translated_prompt
+        for prompt, (translated_prompt, _) in zip(prompts, translations)
+    }
+
+    semaphore = asyncio.Semaphore(GENERATE_BACKGROUND_BATCH_CONCURRENCY)
+
+    async def run_item(
+        index: int, item: GenerateBackgroundBatchItem
+    ) -> tuple[GenerateBackgroundBatchItemResult, Optional[GenerationJob]]:
+        prompt = item.prompt or request.prompt
+        async with semaphore:
+            # The time waited for a slot is not part of the item's execution time
+            t0 = time.time()
+            try:
+                output = await generate(
+                    request.model_copy(update={"prompt": prompt}),
+                    decode_base64_image(item.product_image),
+                    t0,
+                    user,
+                    resources,
+                    store_output=request.response_format == "url",
+                    translated_prompt=translated_prompts[prompt],
+                    batch_id=batch_id,
+                )
+                if output.job:
+                    result = GenerateBackgroundBatchItemResult(
+                        index=index, status="queued", job_id=output.job.id
+                    )
+                elif request.response_format == "url":
+                    result = GenerateBackgroundBatchItemResult(
+                        index=index, status="completed", url=output.url
+                    )
+                else:
+                    result = GenerateBackgroundBatchItemResult(
+                        index=index,
+                        status="completed",
+                        image=await asyncio.to_thread(
+                            image_utils.image_bytes_to_base64_string,
+                            output.image,
+                            output.encoding.media_type,
+                        ),
+                    )
+                return result, output.job
+            except HTTPException as e:
+                error = e.detail
+            except Exception as e:
+                logger.exception(f"Batch {batch_id} item {index} failed")
+                error = str(e)
+            return (
+                GenerateBackgroundBatchItemResult(
+                    index=index, status="failed", error=error
+                ),
+                None,
+            )
+
+    outcomes = await asyncio.gather(
+        *(run_item(index, item) for index, item in enumerate(request.items))
+    )
+    response = GenerateBackgroundBatchResponse(
+        batch_id=batch_id, results=[result for result, _ in outcomes]
+    )
+
+    if request.run_async or request.callback_url:
+        # The jobs of the batch are saved at once
+        await create_jobs([job for _, job in outcomes if job], db)
+        return JSONResponse(status_code=202, content=response.model_dump(mode="json"))
+    return response
 
+
+async def check_callback_url(request: GenerateBackgroundOptions) -> None:
+    if request.callback_url is None:
+        return
     try:
-        image_data = base64.b64decode(base64_image_data)
-        packshot_image = Image.open(BytesIO(image_data))
-    except (base64.binascii.Error, UnidentifiedImageError) as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid base64 image data: {e}",
+        await check_public_url(str(request.callback_url))
+    except NonPublicURLError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid callback_url: {e}")
+
+
+async def run_generate_background(
+    http_request: Request,
+    request: GenerateBackgroundOptions,
+    image_data: bytes,
+    t0: float,
+    user: User,
+    db: AsyncSession,
+    resources: Resources,
+):
+    await check_callback_url(request)
+    metrics.PAYLOAD_BYTES.labels(ROUTE, "request").observe(len(image_data))
+    response_format = resolve_response_format(http_request, request)
+    with metrics.REQUESTS_IN_FLIGHT.labels(ROUTE).track_inprogress():
+        output = await generate(
+            request,
+            image_data,
+            t0,
+            user,
+            resources,
+            store_output=response_format == "url",
         )
 
+    if output.job:
+        with metrics.stage(ROUTE, "db_insert"):
+            job = await create_job(output.job, db)
+        return JSONResponse(
+            status_code=202,
+            content=GenerationJobResponse.from_job(job).model_dump(mode="json"),
+        )
+
+    metrics.PAYLOAD_BYTES.labels(ROUTE, "response").observe(len(output.image))
+    if response_format == "url":
+        return url_response(output.url)
+    if response_format == "binary":
+        return binary_image_response(output.image, output.encoding.media_type)
+    with metrics.stage(ROUTE, "encode_base64"):
+        final_base64_image = await asyncio.to_thread(
+            image_utils.image_bytes_to_base64_string,
+            output.image,
+            output.encoding.media_type,
+        )
+    return GenerateBackgroundResponse(image=final_base64_image)
+
+
+@dataclass
+class GenerationOutput:
+    """The encoded output of a generation, or the unsaved job of an asynchronous one."""
+
+    job: Optional[GenerationJob] = None
+    image: Optional[bytes] = None
+    url: Optional[str] = None
+    encoding: Optional[image_utils.OutputEncoding] = None
+
+
+async def generate(
+    request: GenerateBackgroundOptions,
+    image_data: bytes,
+    t0: float,
+    user: User,
+    resources: Resources,
+    store_output: bool,
+    translated_prompt: Optional[str] = None,
+    batch_id: Optional[uuid.UUID] = None,
+) -> GenerationOutput:
+    """
+    Generate a background for one packshot.
+
+    With `store_output`, the output is uploaded before returning, otherwise it
+    is uploaded in the background. Jobs of asynchronous generations are
+    returned unsaved, so that a batch can save all its jobs at once.
+    """
+    with metrics.stage(ROUTE, "decode_image"):
+        packshot_image = open_image(image_data)
     image_width, image_height = packshot_image.size
 
     # Check if the image dimensions are allowed
@@ -153,39 +512,114 @@ async def generate_background(
             detail=f"Invalid image dimensions ({image_width}x{image_height}). Accepted dimensions are: {allowed_dims_str}.",
         )
 
-    # Pre-process
-    payload, final_prompt, seed = preprocess(
-        request, packshot_image, image_width, image_height
-    )
+    # The packshot is copied to the image pool's shared memory once, for both
+    # the control image and the post-processing
+    async with resources.image_pool.share(packshot_image) as shared_packshot:
+        # Pre-process
+        payload, final_prompt, seed = await preprocess(
+            request,
+            shared_packshot,
+            image_data,
+            image_width,
+            image_height,
+            resources.openai_client,
+            resources.image_pool,
+            translated_prompt,
+        )
+
+        # Prepare paths and URLs
+        now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        packshot_format = packshot_image.format.lower()
+        packshot_image_path = (
+            f"api/{user.id}/hd/packshot-{now}_{uuid.uuid4()}.{packshot_format}"
+        )
 
-    # Prepare paths and URLs
-    now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    packshot_image_path = f"api/{user.id}/hd/packshot-{now}_{uuid.uuid4()}.png"
-    outpaint_model_url = OUTPAINT_MODELS_URL[request.model]
+        if request.run_async or request.callback_url:
+            # Queue the job on RunPod, the job poller finishes the generation. The
+            # poller reads the packshot back, so it is uploaded before the job is
+            # created, as it was uploaded (there is no need to encode it again).
+            packshot_output_url, (runpod_job_id, runpod_url) = await asyncio.gather(
+                storage_utils.call_gcs(
+                    storage_utils.upload_image,
+                    resources.storage_client,
+                    image_data,
+                    packshot_image_path,
+                    packshot_image.get_format_mimetype(),
+                ),
+                metrics.timed(
+                    ROUTE,
+                    "runpod_submit",
+                    resources.router.call(
+                        request.model,
+                        lambda url: resources.runpod.submit_job(url, payload),
+                        measure_latency=False,
+                    ),
+                ),
+            )
+            job = GenerationJob(
+                user_id=user.id,
+                runpod_job_id=runpod_job_id,
+                runpod_endpoint_id=endpoint_id(runpod_url),
+                batch_id=batch_id,
+                model=request.model,
+                packshot_path=packshot_image_path,
+                packshot_url=packshot_output_url,
+                final_prompt=final_prompt,
+                original_prompt=request.prompt,
+                generation_width=image_width,
+                generation_height=image_height,
+                seed=seed,
+                callback_url=(
+                    str(request.callback_url) if request.callback_url else None
+                ),
+                output_format=request.output_format,
+                output_quality=request.quality,
+                output_compress_level=request.compress_level,
+            )
+            return GenerationOutput(job=job)
 
-    # Run upload and RunPod call concurrently
-    packshot_upload_task = asyncio.create_task(
-        asyncio.to_thread(
-            storage_utils.upload_image_pil, packshot_image, packshot_image_path
+        # Nothing in the response depends on the stored packshot, it is uploaded
+        # in the background
+        packshot_output_url = await resources.write_behind.add_upload(
+            image_data, packshot_image_path, packshot_image.get_format_mimetype()
         )
-    )
-    runpod_call_task = asyncio.create_task(
-        asyncio.to_thread(call_runpod_endpoint, outpaint_model_url, payload)
-    )
 
-    packshot_output_url, generation_image = await asyncio.gather(
-        packshot_upload_task, runpod_call_task
-    )
+        with metrics.stage(ROUTE, "runpod"):
+            generation_image, runpod_url = await resources.router.call(
+                request.model, lambda url: resources.runpod.call_endpoint(url, payload)
+            )
 
-    # Post-process the image
-    processed_generation_image = postprocess(
-        generation_image, packshot_image, image_width, image_height
-    )
+        # Post-process the image. The output is encoded once, in the same worker
+        # process, and the same bytes are uploaded and sent back
+        encoding = output_encoding(request)
+        with metrics.stage(ROUTE, "postprocess_encode"):
+            output_bytes = await resources.image_pool.run(
+                postprocess_and_encode,
+                generation_image,
+                shared_packshot,
+                image_width,
+                image_height,
+                encoding,
+            )
+    file_path = f"api/{user.id}/hd/{now}_{uuid.uuid4()}.{encoding.extension}"
 
-    file_path = f"api/{user.id}/hd/{now}_{uuid.uuid4()}.png"
-    output_url = storage_utils.upload_image_pil(processed_generation_image, file_path)
+    # Only a URL response needs the output to be stored before it is sent,
+    # otherwise the upload happens in the background
+    if store_output:
+        with metrics.stage(ROUTE, "gcs_upload"):
+            output_url = await storage_utils.call_gcs(
+                storage_utils.upload_image,
+                resources.storage_client,
+                output_bytes,
+                file_path,
+                encoding.media_type,
+            )
+    else:
+        output_url = await resources.write_behind.add_upload(
+            output_bytes, file_path, encoding.media_type
+        )
 
-    # Save the generation to the database
+    # The generation is saved to the database in the background
     generation = Generation(
         user_id=user.id,
         output_url=output_url,
@@ -196,11 +630,10 @@ async def generate_background(
         generation_height=image_height,
         seed=seed,
         model=request.model,
+        runpod_endpoint_id=endpoint_id(runpod_url),
+        output_format=encoding.format,
         execution_time_ms=int((time.time() - t0) * 1000),
     )
-    generation = create_generation(generation, db)
+    await resources.write_behind.add_record(generation)
 
-    # Convert final image to base64 for the response
-    final_base64_image = image_utils.image_to_base64_string(processed_generation_image)
-
-    return GenerateBackgroundResponse(image=final_base64_image)
+    return GenerationOutput(image=output_bytes, url=output_url, encoding=encoding)
@@ -1,13 +1,26 @@
-from typing import Literal
-from pydantic import BaseModel, Field, model_validator
+import uuid
+from typing import Literal, Optional
+from decouple import config
+from pydantic import BaseModel, Field, HttpUrl, field_validator, model_validator
 
+from api.utils.public_network import check_url_syntax
+
+from api.utils.response_format import (
+    COMPRESS_LEVEL_DESCRIPTION,
+    OUTPUT_FORMAT_DESCRIPTION,
+    QUALITY_DESCRIPTION,
+    RESPONSE_FORMAT_DESCRIPTION,
+    ResponseFormat,
+)
+
+GENERATE_BACKGROUND_BATCH_MAX_ITEMS = config(
+    "GENERATE_BACKGROUND_BATCH_MAX_ITEMS", default=50, cast=int
+)
+
+
+class GenerateBackgroundOptions(BaseModel):
+    """Generation options, shared by the JSON and the binary upload endpoints."""
 
-class GenerateBackgroundRequest(BaseModel):
-    product_image: str = Field(
-        min_length=1,
-        description="Base64 encoded image of the product.",
-        example="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==",
-    )
     prompt: str = Field(
         min_length=1,
         description="Text description of the desired background scene. Be specific about the environment, style, lighting, and mood you want to create around your product.",
@@ -23,9 +36,52 @@ class GenerateBackgroundRequest(BaseModel):
         description="The model to use for image generation. Options include 'presti_v3', 'presti_v2', 'presti_v1'.",
         example="presti_v3",
     )
+    run_async: bool = Field(
+        default=False,
+        description="Whether to run the generation as a background job. The request then returns immediately with a job id to poll on GET /v1/jobs/{job_id}.",
+        example=False,
+    )
+    callback_url: Optional[HttpUrl] = Field(
+        default=None,
+        description="URL called with a POST once the generation is finished. Implies run_async. The JSON body contains the job status, output URL, seed, final prompt and timings. It is signed in the X-Presti-Signature header as 't={timestamp},v1={HMAC-SHA256 of '{timestamp}.{body}' keyed with your API key}'. Failed deliveries are retried with exponential backoff.",
+        example="https://example.com/webhooks/presti",
+    )
+    response_format: ResponseFormat = Field(
+        default="base64",
+        description=RESPONSE_FORMAT_DESCRIPTION,
+        example="base64",
+    )
+    output_format: Literal["png", "webp", "jpeg"] = Field(
+        default="png",
+        description=OUTPUT_FORMAT_DESCRIPTION,
+        example="jpeg",
+    )
+    quality: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=100,
+        description=QUALITY_DESCRIPTION,
+        example=85,
+    )
+    compress_level: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=9,
+        description=COMPRESS_LEVEL_DESCRIPTION,
+        example=6,
+    )
+
+    @field_validator("callback_url")
+    @classmethod
+    def check_callback_url(cls, callback_url: Optional[HttpUrl]) -> Optional[HttpUrl]:
+        # The host name is resolved and checked by the endpoint, and again
+        # when the webhook is delivered
+        if callback_url is not None:
+            check_url_syntax(str(callback_url))
+        return callback_url
 
     @model_validator(mode="after")
-    def check_enhance_prompt_with_model(self) -> "GenerateBackgroundRequest":
+    def check_enhance_prompt_with_model(self) -> "GenerateBackgroundOptions":
         if self.model == "presti_v1" and self.enhance_prompt:
             raise ValueError(
                 "Prompt enhancement is only available for the 'presti_v2' and 'presti_v3' models."
@@ -33,6 +89,14 @@ class GenerateBackgroundRequest(BaseModel):
         return self
 
 
+class GenerateBackgroundRequest(GenerateBackgroundOptions):
+    product_image: str = Field(
+        min_length=1,
+        description="Base64 encoded image of the product.",
+        example="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==",
+    )
+
+
 class GenerateBackgroundResponse(BaseModel):
     image: str = Field(
         ...,
@@ -41,5 +105,76 @@ class GenerateBackgroundResponse(BaseModel):
     )
 
 
+class GenerateBackgroundBatchItem(BaseModel):
+    product_image: str = Field(
+        min_length=1,
+        description="Base64 encoded image of the product.",
+        example="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==",
+    )
+    prompt: Optional[str] = Field(
+        default=None,
+        min_length=1,
+        description="Prompt for this product only, overriding the prompt of the batch.",
+    )
+
+
+class GenerateBackgroundBatchRequest(GenerateBackgroundOptions):
+    prompt: Optional[str] = Field(
+        default=None,
+        min_length=1,
+        description="Prompt shared by the items of the batch that do not have their own. It is translated once for the whole batch.",
+        example="luxury living room with modern furniture, warm lighting, and a view of the city skyline at sunset",
+    )
+    response_format: Literal["base64", "url"] = Field(
+        default="base64",
+        description="How the resulting images are returned in the results: 'base64' as data URLs, or 'url' as the URLs of the stored images.",
+        example="url",
+    )
+    items: list[GenerateBackgroundBatchItem] = Field(
+        min_length=1,
+        max_length=GENERATE_BACKGROUND_BATCH_MAX_ITEMS,
+        description=f"Products to generate a background for, at most {GENERATE_BACKGROUND_BATCH_MAX_ITEMS}.",
+    )
+
+    @model_validator(mode="after")
+    def check_items_have_prompt(self) -> "GenerateBackgroundBatchRequest":
+        if self.prompt is None and any(item.prompt is None for item in self.items):
+            raise ValueError(
+                "Every item needs a prompt when the batch has no shared prompt."
+            )
+        return self
+
+
+class GenerateBackgroundBatchItemResult(BaseModel):
+    index: int = Field(..., description="Position of the item in the request.")
+    status: Literal["completed", "queued", "failed"] = Field(
+        ...,
+        description="'completed' for a generated image, 'queued' for a job submitted with run_async, 'failed' otherwise.",
+    )
+    image: Optional[str] = Field(
+        default=None, description="The generated image in base64 format."
+    )
+    url: Optional[str] = Field(
+        default=None, description="URL of the stored generated image."
+    )
+    job_id: Optional[uuid.UUID] = Field(
+        default=None,
+        description="Identifier of the generation job, with run_async.",
+    )
+    error: Optional[str] = Field(
+        default=None, description="Why the generation of this item failed."
+    )
+
+
+class GenerateBackgroundBatchResponse(BaseModel):
+    batch_id: uuid.UUID = Field(
+        ...,
+        description="Identifier of the batch. With run_async, poll GET /v1/jobs/batches/{batch_id} for the status of its jobs.",
+    )
+    results: list[GenerateBackgroundBatchItemResult] = Field(
+        ..., description="One result per item, in the order of the request."
+    )
+
+
 class ErrorResponse(BaseModel):
     detail: str
@@ -0,0 +1,67 @@
+import uuid
+from fastapi import APIRouter, Depends, HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api.deps.auth import get_user
+from api.models.user_models import User
+from api.services.job_service import get_batch_jobs, get_job
+from database.connection import get_db
+from .schema import ErrorResponse, GenerationBatchResponse, GenerationJobResponse
+
+router = APIRouter()
+
+
+@router.get(
+    "/jobs/{job_id}",
+    response_model=GenerationJobResponse,
+    responses={
+        401: {"model": ErrorResponse, "description": "API Key missing"},
+        403: {"model": ErrorResponse, "description": "Invalid API Key"},
+        404: {"model": ErrorResponse, "description": "Job not found"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    },
+)
+async def get_generation_job(
+    job_id: uuid.UUID,
+    user: User = Depends(get_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Get the status of a background generation submitted with `run_async=true`.
+
+    Once the job is `completed`, `output_url` points to the generated image.
+    """
+    job = await get_job(job_id, user.id, db)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return GenerationJobResponse.from_job(job)
+
+
+@router.get(
+    "/jobs/batches/{batch_id}",
+    response_model=GenerationBatchResponse,
+    responses={
+        401: {"model": ErrorResponse, "description": "API Key missing"},
+        403: {"model": ErrorResponse, "description": "Invalid API Key"},
+        404: {"model": ErrorResponse, "description": "Batch not found"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    },
+)
+async def get_generation_batch(
+    batch_id: uuid.UUID,
+    user: User = Depends(get_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Get the status of the jobs of a batch submitted with `run_async=true` on
+    POST /v1/generate_background/batch.
+
+    Items that failed before their job was created are not listed, they were
+    reported in the response to the batch request.
+    """
+    jobs = await get_batch_jobs(batch_id, user.id, db)
+    if not jobs:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return GenerationBatchResponse(
+        batch_id=batch_id, jobs=[GenerationJobResponse.from_job(job) for job in jobs]
+    )
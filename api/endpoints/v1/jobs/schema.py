@@ -0,0 +1,72 @@
+import datetime
+import uuid
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from api.models.job_models import JOB_STATUSES, GenerationJob
+
+
+class GenerationJobResponse(BaseModel):
+    job_id: uuid.UUID = Field(
+        ...,
+        description="Identifier of the generation job, to be polled on GET /v1/jobs/{job_id}.",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa6",
+    )
+    status: JOB_STATUSES = Field(
+        ...,
+        description="Status of the job: 'queued', 'in_progress', 'finalizing', 'completed' or 'failed'.",
+        example="queued",
+    )
+    output_url: Optional[str] = Field(
+        default=None,
+        description="URL of the generated image, available once the job is completed.",
+        example="https://storage.googleapis.com/presti-tmp-test/gallery/api/generation.png",
+    )
+    batch_id: Optional[uuid.UUID] = Field(
+        default=None,
+        description="Identifier of the batch the job was submitted with, if any.",
+    )
+    seed: int = Field(..., description="Seed used for the generation.", example=1234)
+    final_prompt: str = Field(
+        ..., description="Prompt sent to the model after translation and enhancement."
+    )
+    error: Optional[str] = Field(
+        default=None, description="Error message if the job failed."
+    )
+    execution_time_ms: Optional[int] = Field(
+        default=None,
+        description="Total time between the submission and the completion of the job.",
+    )
+    created_at: datetime.datetime
+    completed_at: Optional[datetime.datetime] = None
+
+    @classmethod
+    def from_job(cls, job: GenerationJob) -> "GenerationJobResponse":
+        return cls(
+            job_id=job.id,
+            status=job.status,
+            output_url=job.output_url,
+            batch_id=job.batch_id,
+            seed=job.seed,
+            final_prompt=job.final_prompt,
+            error=job.error,
+            execution_time_ms=job.execution_time_ms,
+            created_at=job.created_at,
+            completed_at=job.completed_at,
+        )
+
+
+class GenerationBatchResponse(BaseModel):
+    batch_id: uuid.UUID = Field(
+        ...,
+        description="Identifier of the batch, returned by POST /v1/generate_background/batch.",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa6",
+    )
+    jobs: list[GenerationJobResponse] = Field(
+        ..., description="Jobs of the batch, oldest first."
+    )
+
+
+class ErrorResponse(BaseModel):
+    detail: str
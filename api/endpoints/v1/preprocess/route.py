@@ -1,15 +1,34 @@
+import asyncio
+import datetime
 import time
-from fastapi import APIRouter, HTTPException, Depends
-from sqlmodel import Session
-from .schema import PreprocessRequest, PreprocessResponse
+import uuid
+from fastapi import APIRouter, HTTPException, Depends, Request
+from .schema import PreprocessOptions, PreprocessRequest, PreprocessResponse
 from api.services.preprocess_service import (
     preprocess_image as preprocess_service_image,
-    create_preprocess,
 )
 from api.deps.auth import get_user
+from api.deps.resources import get_resources
 from api.models.user_models import User
 from api.models.preprocess_models import Preprocess
-from database.connection import get_db
+from api.resources import Resources
+import api.utils.image as image_utils
+from api.utils.response_format import (
+    binary_image_response,
+    output_encoding,
+    resolve_response_format,
+    url_response,
+)
+import api.utils.storage as storage_utils
+from api.utils import metrics
+from api.utils.upload import (
+    decode_base64_image,
+    image_upload_openapi,
+    parse_upload_options,
+    read_image_upload,
+)
+
+ROUTE = "preprocess"
 
 router = APIRouter()
 
@@ -39,13 +58,14 @@ def is_valid_dimension(width, height):
     responses={
         200: {
             "model": PreprocessResponse,
-            "description": "Successfully preprocessed the image",
+            "description": 'Successfully preprocessed the image. The image is returned as base64 (default), as raw bytes (response_format=binary or Accept: image/png), or as a JSON body {"url": ...} with the URL of the stored result (response_format=url).',
             "content": {
                 "application/json": {
                     "example": {
                         "image": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
                     }
-                }
+                },
+                "image/png": {"schema": {"type": "string", "format": "binary"}},
             },
         },
         400: {"description": "Invalid target dimensions"},
@@ -162,10 +182,11 @@ curl -X POST 'https://sdk.presti.ai/v1/preprocess' \\
         ],
     },
 )
-def preprocess_image(
+async def preprocess_image(
     request: PreprocessRequest,
+    http_request: Request,
     user: User = Depends(get_user),
-    db: Session = Depends(get_db),
+    resources: Resources = Depends(get_resources),
 ):
     """
     Preprocess an image by removing background, adding margins, and aligning on a target canvas.
@@ -176,24 +197,127 @@ def preprocess_image(
     3. Add margins around the image (default: 10% on all sides)
     4. Resize the image to fit within the target dimensions
     5. Align the image according to the specified parameters
-    6. Return the result as a base64 encoded image
+    6. Return the result as a base64 encoded image, or as raw PNG bytes with
+       `response_format=binary` (or `Accept: image/png`), or as the URL of the
+       stored result with `response_format=url`
     """
     t0 = time.time()
+    with metrics.stage(ROUTE, "decode_base64"):
+        image_data = decode_base64_image(request.image)
+    return await run_preprocess(http_request, request, image_data, t0, user, resources)
 
+
+@router.post(
+    "/preprocess/upload",
+    response_model=PreprocessResponse,
+    responses={
+        200: {
+            "model": PreprocessResponse,
+            "description": "Successfully preprocessed the image, in the requested response_format",
+            "content": {
+                "image/png": {"schema": {"type": "string", "format": "binary"}}
+            },
+        },
+        400: {"description": "Invalid image or target dimensions"},
+        401: {"description": "API Key missing"},
+        403: {"description": "Invalid API Key"},
+        413: {"description": "Image too large"},
+        415: {"description": "Unsupported content type"},
+        429: {"description": "Rate limit exceeded"},
+        500: {"description": "Internal server error"},
+    },
+    openapi_extra={
+        **image_upload_openapi(PreprocessOptions, "image", "The image to preprocess."),
+        "x-codeSamples": [
+            {
+                "lang": "cURL",
+                "source": """
+curl -X POST 'https://sdk.presti.ai/v1/preprocess/upload?target_width=1024&target_height=1024' \\
+    -H 'X-PRESTI-API-KEY: your_api_key_here' \\
+    -H 'Content-Type: image/png' \\
+    --data-binary '@photo.png'
+""",
+            },
+        ],
+    },
+)
+async def preprocess_image_upload(
+    http_request: Request,
+    user: User = Depends(get_user),
+    resources: Resources = Depends(get_resources),
+):
+    """
+    Preprocess an image sent as binary instead of base64.
+
+    The image is sent either as the `image` field of a `multipart/form-data` body,
+    with the options as the other form fields, or as the raw body of an `image/png`,
+    `image/jpeg` or `image/webp` request, with the options in the query string.
+    A per-side margin is passed as a JSON object, e.g. `{"left": 50, "right": 30}`.
+    """
+    t0 = time.time()
+    with metrics.stage(ROUTE, "read_upload"):
+        image_data, params = await read_image_upload(http_request, "image")
+    with metrics.stage(ROUTE, "validation"):
+        options = parse_upload_options(PreprocessOptions, params)
+    return await run_preprocess(http_request, options, image_data, t0, user, resources)
+
+
+async def run_preprocess(
+    http_request: Request,
+    request: PreprocessOptions,
+    image_data: bytes,
+    t0: float,
+    user: User,
+    resources: Resources,
+):
     if not is_valid_dimension(request.target_width, request.target_height):
         raise HTTPException(
             status_code=400,
             detail=f"Invalid target dimensions. Accepted dimensions: {ACCEPTED_DIMENSIONS} and their multiples (x2, x4, x8)",
         )
 
-    result_b64 = preprocess_service_image(
-        request.image,
-        request.margin,
-        request.horizontal_alignment,
-        request.vertical_alignment,
-        request.target_width,
-        request.target_height,
-    )
+    metrics.PAYLOAD_BYTES.labels(ROUTE, "request").observe(len(image_data))
+    response_format = resolve_response_format(http_request, request)
+    encoding = output_encoding(request)
+    with metrics.REQUESTS_IN_FLIGHT.labels(ROUTE).track_inprogress():
+        # Segmentation, crop and placement
+        with metrics.stage(ROUTE, "preprocess"):
+            result = await preprocess_service_image(
+                image_data,
+                request.margin,
+                request.horizontal_alignment,
+                request.vertical_alignment,
+                request.target_width,
+                request.target_height,
+                resources.photoroom_client,
+                resources.image_pool,
+            )
+
+        if response_format == "url":
+            now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            file_path = (
+                f"api/{user.id}/hd/preprocess-{now}_{uuid.uuid4()}.{encoding.extension}"
+            )
+            # Encoded in the upload
+            with metrics.stage(ROUTE, "encode_gcs_upload"):
+                output = await storage_utils.call_gcs(
+                    storage_utils.upload_image_pil,
+                    resources.storage_client,
+                    result,
+                    file_path,
+                    encoding,
+                )
+        elif response_format == "binary":
+            with metrics.stage(ROUTE, "encode"):
+                output = await asyncio.to_thread(
+                    image_utils.image_to_bytes, result, encoding
+                )
+        else:
+            with metrics.stage(ROUTE, "encode"):
+                output = await asyncio.to_thread(
+                    image_utils.image_to_base64_string, result, encoding
+                )
+    metrics.PAYLOAD_BYTES.labels(ROUTE, "response").observe(len(output))
 
     # Normalize margin for JSON storage
     if isinstance(request.margin, (int, float)):
@@ -211,6 +335,10 @@ def preprocess_image(
         target_width=request.target_width,
         target_height=request.target_height,
     )
-    create_preprocess(db_obj, db)
+    await resources.write_behind.add_record(db_obj)
 
-    return PreprocessResponse(image=result_b64)
+    if response_format == "url":
+        return url_response(output)
+    if response_format == "binary":
+        return binary_image_response(output, encoding.media_type)
+    return PreprocessResponse(image=output)
@@ -1,13 +1,18 @@
 from pydantic import BaseModel, Field
-from typing import Union, Dict, Literal
+from typing import Union, Dict, Literal, Optional
 
+from api.utils.response_format import (
+    COMPRESS_LEVEL_DESCRIPTION,
+    OUTPUT_FORMAT_DESCRIPTION,
+    QUALITY_DESCRIPTION,
+    RESPONSE_FORMAT_DESCRIPTION,
+    ResponseFormat,
+)
+
+
+class PreprocessOptions(BaseModel):
+    """Preprocessing options, shared by the JSON and the binary upload endpoints."""
 
-class PreprocessRequest(BaseModel):
-    image: str = Field(
-        ...,
-        description="Base64 encoded string of the image to preprocess. The image will have its background removed, margins added, and be aligned on a target canvas.",
-        example="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==",
-    )
     margin: Union[float, Dict[str, float]] = Field(
         default=0.1,
         description="Margin to add around the image. Can be a float (percentage of image size, e.g., 0.1 = 10% on all sides) or a dict with specific values for each side: {'left': 50, 'right': 30, 'top': 20, 'bottom': 40}",
@@ -33,6 +38,38 @@ class PreprocessRequest(BaseModel):
         description="Target height of the output image in pixels. Dimensions must be one of the accepted formats: 1024x1024 (1:1), 1280x720 (16:9) or 720x1280 (9:16), 768x920 (4:5) or 920x768 (5:4), 1152x768 (3:2) or 768x1152 (2:3). Multiples of these dimensions (x2, x4, x8) are also accepted.",
         example=1024,
     )
+    response_format: ResponseFormat = Field(
+        default="base64",
+        description=RESPONSE_FORMAT_DESCRIPTION,
+        example="base64",
+    )
+    output_format: Literal["png", "webp"] = Field(
+        default="png",
+        description=OUTPUT_FORMAT_DESCRIPTION,
+        example="webp",
+    )
+    quality: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=100,
+        description=QUALITY_DESCRIPTION,
+        example=85,
+    )
+    compress_level: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=9,
+        description=COMPRESS_LEVEL_DESCRIPTION,
+        example=6,
+    )
+
+
+class PreprocessRequest(PreprocessOptions):
+    image: str = Field(
+        ...,
+        description="Base64 encoded string of the image to preprocess. The image will have its background removed, margins added, and be aligned on a target canvas.",
+        example="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==",
+    )
 
     class Config:
         schema_extra = {
@@ -1,68 +1,146 @@
-import http.client
+import asyncio
 import io
+from typing import Optional
 from decouple import config
-import uuid
 from fastapi import HTTPException
+import httpx
 from PIL import Image
-from retry import retry
 
+import api.utils.image_kernels as image_kernels
+from api.utils.cutout_cache import cutout_cache
+from api.utils.image_pool import ImageProcessPool
+from api.utils.photoroom import (
+    photoroom_bulkhead,
+    photoroom_connection_stats,
+    photoroom_retry,
+)
 
-@retry(tries=3, delay=1, backoff=2)
-def remove_background_helper(input_image: Image.Image) -> Image.Image:
-    # Define multipart boundary
-    boundary = "----------{}".format(uuid.uuid4().hex)
+# Longest side of the downscaled copy sent for segmentation in proxy mode, 0
+# segments at full resolution
+SEGMENTATION_PROXY_MAX_SIZE = config(
+    "SEGMENTATION_PROXY_MAX_SIZE", default=2048, cast=int
+)
+SEGMENTATION_PROXY_QUALITY = 95
 
-    # Convert the PIL Image to bytes (ensure PNG format for PhotoRoom)
-    image_io = io.BytesIO()
-    # Ensure the image has a format attribute, default to PNG if not present or needed
-    image_format = getattr(input_image, "format", "PNG")
-
-    input_image.save(image_io, format=image_format)
-    image_data = image_io.getvalue()
 
+@photoroom_retry
+async def segment_image_data(
+    image_data: bytes, image_format: str, photoroom_client: httpx.AsyncClient
+) -> Image.Image:
     # Generate a filename (optional, for content-disposition header)
     filename = f"image.{image_format.lower()}"
 
     # Set the content type
     content_type = f"image/{image_format.lower()}"
 
-    # Prepare the POST data
-    body = (
-        (
-            f"--{boundary}\r\n"
-            f'Content-Disposition: form-data; name="image_file"; filename="{filename}"\r\n'
-            f"Content-Type: {content_type}\r\n\r\n"
-        ).encode("utf-8")
-        + image_data
-        + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    # Make the POST request on the shared keep-alive connection pool
+    async with photoroom_bulkhead.slot():
+        response = await photoroom_client.post(
+            "/v1/segment",
+            files={"image_file": (filename, image_data, content_type)},
+            extensions={"trace": photoroom_connection_stats.trace},
+        )
+
+    # Handle the response
+    if response.status_code == 200:
+        image = Image.open(io.BytesIO(response.content))
+        return image
+    else:
+        print(f"Error: {response.status_code} - {response.reason_phrase}")
+        error_details = response.text
+        print(error_details)
+        raise HTTPException(
+            status_code=response.status_code,  # Use actual status code if appropriate
+            detail=f"Error removing background: {response.reason_phrase} - {error_details}",
+        )
+
+
+async def remove_background_helper(
+    input_image: Image.Image, photoroom_client: httpx.AsyncClient
+) -> Image.Image:
+    # Convert the PIL Image to bytes (ensure PNG format for PhotoRoom)
+    image_io = io.BytesIO()
+    # Ensure the image has a format attribute, default to PNG if not present or needed
+    image_format = input_image.format or "PNG"
+
+    await asyncio.to_thread(input_image.save, image_io, format=image_format)
+    return await segment_image_data(image_io.getvalue(), image_format, photoroom_client)
+
+
+def encode_segmentation_proxy(
+    input_image: Image.Image, image_format: str, max_size: int
+) -> bytes:
+    """Downscale the image to ``max_size`` on its longest side and encode it."""
+    proxy = input_image.copy()
+    proxy.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    image_io = io.BytesIO()
+    if image_format == "JPEG" and proxy.mode not in ("RGB", "L"):
+        proxy = proxy.convert("RGB")
+    if image_format == "PNG":
+        proxy.save(image_io, format=image_format)
+    else:
+        # Lossy like the original, at a quality that keeps the edges sharp
+        proxy.save(image_io, format=image_format, quality=SEGMENTATION_PROXY_QUALITY)
+    return image_io.getvalue()
+
+
+def apply_proxy_cutout(input_image: Image.Image, cutout: Image.Image) -> Image.Image:
+    """Cutout of the full resolution image, from the alpha of the proxy's cutout."""
+    alpha = image_kernels.guided_upsample_alpha(cutout.getchannel("A"), input_image)
+    result = input_image.convert("RGB")
+    result.putalpha(alpha)
+    return result
+
+
+async def remove_background_proxy(
+    input_image: Image.Image,
+    photoroom_client: httpx.AsyncClient,
+    image_pool: ImageProcessPool,
+    max_size: int = SEGMENTATION_PROXY_MAX_SIZE,
+) -> Image.Image:
+    """Segment a downscaled copy of a large image, and apply its mask at full resolution.
+
+    Images no larger than ``max_size`` are segmented as they are.
+    """
+    if not max_size or max(input_image.size) <= max_size:
+        return await remove_background_helper(input_image, photoroom_client)
+    image_format = (
+        input_image.format if input_image.format in ("JPEG", "WEBP") else "PNG"
     )
+    # The image is copied to shared memory once, for both transforms
+    async with image_pool.share(input_image) as shared_image:
+        proxy_data = await image_pool.run(
+            encode_segmentation_proxy, shared_image, image_format, max_size
+        )
+        cutout = await segment_image_data(proxy_data, image_format, photoroom_client)
+        return await image_pool.run(apply_proxy_cutout, shared_image, cutout)
 
-    # Set up the HTTP connection and headers
-    conn = http.client.HTTPSConnection("sdk.photoroom.com")
-    headers = {
-        "Content-Type": f"multipart/form-data; boundary={boundary}",
-        "x-api-key": config("PHOTOROOM_API_KEY"),
-    }
-
-    try:
-        # Make the POST request
-        conn.request("POST", "/v1/segment", body=body, headers=headers)
-        response = conn.getresponse()
-
-        # Handle the response
-        if response.status == 200:
-            response_data = response.read()
-            image = Image.open(io.BytesIO(response_data))
-            return image
-        else:
-            print(f"Error: {response.status} - {response.reason}")
-            # Read the response body for more details, but be careful with large responses
-            error_details = response.read().decode("utf-8", errors="ignore")
-            print(error_details)
-            raise HTTPException(
-                status_code=response.status,  # Use actual status code if appropriate
-                detail=f"Error removing background: {response.reason} - {error_details}",
+
+async def remove_background_cached(
+    image_data: bytes,
+    input_image: Image.Image,
+    photoroom_client: httpx.AsyncClient,
+    image_pool: Optional[ImageProcessPool] = None,
+    proxy_max_size: int = 0,
+) -> Image.Image:
+    """Segment the image, reusing the cutout of identical image bytes if cached.
+
+    With a ``proxy_max_size``, larger images are segmented through a downscaled
+    proxy (see ``remove_background_proxy``).
+    """
+    key = await asyncio.to_thread(cutout_cache.key_for, image_data)
+    use_proxy = bool(proxy_max_size) and max(input_image.size) > proxy_max_size
+    if use_proxy:
+        # Proxy cutouts are cached apart from full resolution ones
+        key = f"{key}-proxy{proxy_max_size}"
+    cutout = await asyncio.to_thread(cutout_cache.get, key)
+    if cutout is None:
+        if use_proxy:
+            cutout = await remove_background_proxy(
+                input_image, photoroom_client, image_pool, proxy_max_size
             )
-    finally:
-        # Ensure the connection is closed
-        conn.close()
+        else:
+            cutout = await remove_background_helper(input_image, photoroom_client)
+        # Caching loads the image, which decodes the PNG returned by PhotoRoom
+        await asyncio.to_thread(cutout_cache.set, key, cutout)
+    return cutout
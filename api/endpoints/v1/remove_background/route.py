@@ -1,21 +1,57 @@
-import base64
-import io
+import asyncio
+import datetime
+import logging
 import time
-from PIL import Image, UnidentifiedImageError
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session
+import uuid
+from typing import Union
+from decouple import config
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 
 from api.deps.auth import get_user
+from api.deps.resources import get_resources
 from api.models.bg_removal_models import BackgroundRemoval
 from api.models.user_models import User
-from api.services.bg_removal_service import create_bg_removal
-from database.connection import get_db
+from api.resources import Resources
 import api.utils.image as image_utils
-from .helpers import remove_background_helper
-from .schema import RemoveBackgroundRequest, RemoveBackgroundResponse, ErrorResponse
+import api.utils.storage as storage_utils
+from api.utils import metrics
+from api.utils.response_format import (
+    binary_image_response,
+    output_encoding,
+    resolve_response_format,
+    url_response,
+)
+from api.utils.upload import (
+    decode_base64_image,
+    fetch_image,
+    image_upload_openapi,
+    open_image,
+    parse_upload_options,
+    read_image_upload,
+)
+from .helpers import remove_background_cached
+from .schema import (
+    ErrorResponse,
+    RemoveBackgroundBatchItem,
+    RemoveBackgroundBatchItemResult,
+    RemoveBackgroundBatchRequest,
+    RemoveBackgroundOptions,
+    RemoveBackgroundRequest,
+    RemoveBackgroundResponse,
+)
+
+logger = logging.getLogger(__name__)
+
+ROUTE = "remove_background"
 
 router = APIRouter()
 
+# Items of a batch segmented at the same time, per batch request
+REMOVE_BACKGROUND_BATCH_CONCURRENCY = config(
+    "REMOVE_BACKGROUND_BATCH_CONCURRENCY", default=8, cast=int
+)
+
 
 @router.post(
     "/remove_background",
@@ -23,13 +59,14 @@ router = APIRouter()
     responses={
         200: {
             "model": RemoveBackgroundResponse,
-            "description": "Successfully removed background from the image",
+            "description": 'Successfully removed background from the image. The image is returned as base64 (default), as raw bytes (response_format=binary or Accept: image/png), or as a JSON body {"url": ...} with the URL of the stored image (response_format=url).',
             "content": {
                 "application/json": {
                     "example": {
                         "image": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
                     }
-                }
+                },
+                "image/png": {"schema": {"type": "string", "format": "binary"}},
             },
         },
         401: {"model": ErrorResponse, "description": "API Key missing"},
@@ -92,10 +129,11 @@ curl -X POST 'https://sdk.presti.ai/v1/remove_background' \\
         ]
     },
 )
-def remove_background(
+async def remove_background(
     request: RemoveBackgroundRequest,
+    http_request: Request,
     user: User = Depends(get_user),
-    db: Session = Depends(get_db),
+    resources: Resources = Depends(get_resources),
 ):
     """
     Remove the background from an image, isolating the main subject.
@@ -105,32 +143,266 @@ def remove_background(
     2. Identify and isolate the main subject
     3. Remove the background
     4. Return the result with a transparent background
+
+    Set `response_format=binary` (or send `Accept: image/png`) to receive the raw
+    PNG bytes, or `response_format=url` to receive the URL of the stored result.
     """
     t0 = time.time()
-    # Decode the base64 string
-    if request.image.startswith("data:image"):
-        base64_image_data = request.image.split(",")[1]
-    else:
-        base64_image_data = request.image
-
-    try:
-        image_data = base64.b64decode(base64_image_data)
-        input_image = Image.open(io.BytesIO(image_data))
-    except (base64.binascii.Error, UnidentifiedImageError) as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid base64 image data: {e}",
-        )
+    with metrics.stage(ROUTE, "decode_base64"):
+        image_data = decode_base64_image(request.image)
+    return await run_remove_background(
+        http_request, request, image_data, t0, user, resources
+    )
 
-    result = remove_background_helper(input_image)
 
-    # Convert the result image to base64
-    base64_image = image_utils.image_to_base64_string(result)
+@router.post(
+    "/remove_background/upload",
+    response_model=RemoveBackgroundResponse,
+    responses={
+        200: {
+            "model": RemoveBackgroundResponse,
+            "description": "Successfully removed background from the image, in the requested response_format",
+            "content": {
+                "image/png": {"schema": {"type": "string", "format": "binary"}}
+            },
+        },
+        400: {"model": ErrorResponse, "description": "Invalid image"},
+        401: {"model": ErrorResponse, "description": "API Key missing"},
+        403: {"model": ErrorResponse, "description": "Invalid API Key"},
+        413: {"model": ErrorResponse, "description": "Image too large"},
+        415: {"model": ErrorResponse, "description": "Unsupported content type"},
+        429: {"model": ErrorResponse, "description": "Rate limit exceeded"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    },
+    openapi_extra={
+        **image_upload_openapi(
+            RemoveBackgroundOptions,
+            "image",
+            "The image from which to remove the background.",
+        ),
+        "x-codeSamples": [
+            {
+                "lang": "cURL",
+                "source": """
+curl -X POST 'https://sdk.presti.ai/v1/remove_background/upload' \\
+    -H 'X-PRESTI-API-KEY: your_api_key_here' \\
+    -F 'image=@photo.png'
+""",
+            },
+        ],
+    },
+)
+async def remove_background_upload(
+    http_request: Request,
+    user: User = Depends(get_user),
+    resources: Resources = Depends(get_resources),
+):
+    """
+    Remove the background from an image sent as binary instead of base64.
+
+    The image is sent either as the `image` field of a `multipart/form-data` body,
+    or as the raw body of an `image/png`, `image/jpeg` or `image/webp` request.
+    This avoids the base64 overhead for large images.
+    """
+    t0 = time.time()
+    with metrics.stage(ROUTE, "read_upload"):
+        image_data, params = await read_image_upload(http_request, "image")
+    with metrics.stage(ROUTE, "validation"):
+        options = parse_upload_options(RemoveBackgroundOptions, params)
+    return await run_remove_background(
+        http_request, options, image_data, t0, user, resources
+    )
+
+
+@router.post(
+    "/remove_background/batch",
+    responses={
+        200: {
+            "description": "One JSON object per line (NDJSON), sent as soon as each item is done, in completion order. Each line has the index of its item in the request, its status ('completed' or 'failed') and either the image, its URL or an error.",
+            "content": {
+                "application/x-ndjson": {
+                    "schema": RemoveBackgroundBatchItemResult.model_json_schema()
+                }
+            },
+        },
+        401: {"model": ErrorResponse, "description": "API Key missing"},
+        403: {"model": ErrorResponse, "description": "Invalid API Key"},
+        429: {"model": ErrorResponse, "description": "Rate limit exceeded"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    },
+    openapi_extra={
+        "x-codeSamples": [
+            {
+                "lang": "Python",
+                "source": """
+import json
+import requests
+
+url = "https://sdk.presti.ai/v1/remove_background/batch"
+headers = {"X-PRESTI-API-KEY": "your_api_key_here"}
+payload = {
+    "response_format": "url",
+    "items": [
+        {"image_url": "https://example.com/products/1234.jpg"},
+        {"image": "data:image/png;base64,..."},
+    ],
+}
+
+with requests.post(url, json=payload, headers=headers, stream=True) as response:
+    for line in response.iter_lines():
+        result = json.loads(line)
+        print(result["index"], result["status"], result.get("url") or result.get("error"))
+""",
+            },
+        ]
+    },
+)
+async def remove_background_batch(
+    request: RemoveBackgroundBatchRequest,
+    user: User = Depends(get_user),
+    resources: Resources = Depends(get_resources),
+):
+    """
+    Remove the background from several images in one request.
+
+    Each item is either a base64 image or the URL of an image to download.
+    Items are segmented concurrently and streamed back as newline-delimited
+    JSON, one line per item as soon as it is done. A failed item does not fail
+    the batch: its line has the `failed` status and an error message.
+    """
+    encoding = output_encoding(request)
+    semaphore = asyncio.Semaphore(REMOVE_BACKGROUND_BATCH_CONCURRENCY)
+
+    async def run_item(
+        index: int, item: RemoveBackgroundBatchItem
+    ) -> tuple[RemoveBackgroundBatchItemResult, int]:
+        """The result of an item, and its execution time in milliseconds."""
+        async with semaphore:
+            # The time waited for a slot is not part of the item's execution time
+            t0 = time.time()
+            try:
+                image_data = (
+                    decode_base64_image(item.image)
+                    if item.image is not None
+                    else await fetch_image(
+                        resources.image_fetch_client, str(item.image_url)
+                    )
+                )
+                output = await remove_background_output(
+                    image_data, request.response_format, encoding, user, resources
+                )
+            except HTTPException as e:
+                result = RemoveBackgroundBatchItemResult(
+                    index=index, status="failed", error=e.detail
+                )
+            except Exception as e:
+                logger.exception(f"Batch background removal item {index} failed")
+                result = RemoveBackgroundBatchItemResult(
+                    index=index, status="failed", error=str(e)
+                )
+            else:
+                if request.response_format == "url":
+                    result = RemoveBackgroundBatchItemResult(
+                        index=index, status="completed", url=output
+                    )
+                else:
+                    result = RemoveBackgroundBatchItemResult(
+                        index=index, status="completed", image=output
+                    )
+            return result, int((time.time() - t0) * 1000)
+
+    async def stream_results():
+        tasks = [
+            asyncio.create_task(run_item(index, item))
+            for index, item in enumerate(request.items)
+        ]
+        records = []
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result, execution_time_ms = await next_result
+                if result.status == "completed":
+                    records.append(
+                        BackgroundRemoval(
+                            user_id=user.id, execution_time_ms=execution_time_ms
+                        )
+                    )
+                yield result.model_dump_json(exclude_none=True) + "\n"
+        finally:
+            # Items still running when the client goes away are abandoned
+            for task in tasks:
+                task.cancel()
+            # The removals of the batch are written in one insert
+            await resources.write_behind.add_records(records)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+async def run_remove_background(
+    http_request: Request,
+    options: RemoveBackgroundOptions,
+    image_data: bytes,
+    t0: float,
+    user: User,
+    resources: Resources,
+):
+    metrics.PAYLOAD_BYTES.labels(ROUTE, "request").observe(len(image_data))
+    response_format = resolve_response_format(http_request, options)
+    encoding = output_encoding(options)
+    with metrics.REQUESTS_IN_FLIGHT.labels(ROUTE).track_inprogress():
+        output = await remove_background_output(
+            image_data, response_format, encoding, user, resources
+        )
 
     db_obj = BackgroundRemoval(
         user_id=user.id,
         execution_time_ms=int((time.time() - t0) * 1000),
     )
-    create_bg_removal(db_obj, db)
+    await resources.write_behind.add_record(db_obj)
+
+    metrics.PAYLOAD_BYTES.labels(ROUTE, "response").observe(len(output))
+    if response_format == "url":
+        return url_response(output)
+    if response_format == "binary":
+        return binary_image_response(output, encoding.media_type)
+    return RemoveBackgroundResponse(image=output)
 
-    return RemoveBackgroundResponse(image=base64_image)
+
+async def remove_background_output(
+    image_data: bytes,
+    response_format: str,
+    encoding: image_utils.OutputEncoding,
+    user: User,
+    resources: Resources,
+) -> Union[str, bytes]:
+    """
+    Remove the background of an image and return it in the response format:
+    the URL of the stored cutout, its encoded bytes or a base64 data URL.
+    """
+    with metrics.stage(ROUTE, "decode_image"):
+        input_image = open_image(image_data)
+
+    with metrics.stage(ROUTE, "segmentation"):
+        result = await remove_background_cached(
+            image_data, input_image, resources.photoroom_client
+        )
+
+    if response_format == "url":
+        now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        file_path = f"api/{user.id}/hd/cutout-{now}_{uuid.uuid4()}.{encoding.extension}"
+        # Encoded in the upload
+        with metrics.stage(ROUTE, "encode_gcs_upload"):
+            return await storage_utils.call_gcs(
+                storage_utils.upload_image_pil,
+                resources.storage_client,
+                result,
+                file_path,
+                encoding,
+            )
+    if response_format == "binary":
+        with metrics.stage(ROUTE, "encode"):
+            return await asyncio.to_thread(image_utils.image_to_bytes, result, encoding)
+    # Convert the result image to base64
+    with metrics.stage(ROUTE, "encode"):
+        return await asyncio.to_thread(
+            image_utils.image_to_base64_string, result, encoding
+        )
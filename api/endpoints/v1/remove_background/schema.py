@@ -1,7 +1,50 @@
-from pydantic import BaseModel, Field
+from typing import Literal, Optional
+from decouple import config
+from pydantic import BaseModel, Field, HttpUrl, model_validator
 
+from api.utils.response_format import (
+    COMPRESS_LEVEL_DESCRIPTION,
+    OUTPUT_FORMAT_DESCRIPTION,
+    QUALITY_DESCRIPTION,
+    RESPONSE_FORMAT_DESCRIPTION,
+    ResponseFormat,
+)
 
-class RemoveBackgroundRequest(BaseModel):
+REMOVE_BACKGROUND_BATCH_MAX_ITEMS = config(
+    "REMOVE_BACKGROUND_BATCH_MAX_ITEMS", default=100, cast=int
+)
+
+
+class RemoveBackgroundOptions(BaseModel):
+    """Options shared by the JSON and the binary upload endpoints."""
+
+    response_format: ResponseFormat = Field(
+        default="base64",
+        description=RESPONSE_FORMAT_DESCRIPTION,
+        example="base64",
+    )
+    output_format: Literal["png", "webp"] = Field(
+        default="png",
+        description=OUTPUT_FORMAT_DESCRIPTION,
+        example="webp",
+    )
+    quality: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=100,
+        description=QUALITY_DESCRIPTION,
+        example=85,
+    )
+    compress_level: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=9,
+        description=COMPRESS_LEVEL_DESCRIPTION,
+        example=6,
+    )
+
+
+class RemoveBackgroundRequest(RemoveBackgroundOptions):
     image: str = Field(
         ...,
         description="Base64 encoded string of the image from which to remove the background. The image will be processed to separate the main subject from its background.",
@@ -17,5 +60,51 @@ class RemoveBackgroundResponse(BaseModel):
     )
 
 
+class RemoveBackgroundBatchItem(BaseModel):
+    image: Optional[str] = Field(
+        default=None,
+        min_length=1,
+        description="Base64 encoded image. Either image or image_url must be set.",
+        example="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==",
+    )
+    image_url: Optional[HttpUrl] = Field(
+        default=None,
+        description="URL the image is downloaded from. Either image or image_url must be set.",
+        example="https://example.com/products/1234.jpg",
+    )
+
+    @model_validator(mode="after")
+    def check_one_image(self) -> "RemoveBackgroundBatchItem":
+        if (self.image is None) == (self.image_url is None):
+            raise ValueError("Exactly one of image and image_url must be set.")
+        return self
+
+
+class RemoveBackgroundBatchRequest(RemoveBackgroundOptions):
+    response_format: Literal["base64", "url"] = Field(
+        default="base64",
+        description="How the resulting images are returned in the results: 'base64' as data URLs, or 'url' as the URLs of the stored images.",
+        example="url",
+    )
+    items: list[RemoveBackgroundBatchItem] = Field(
+        min_length=1,
+        max_length=REMOVE_BACKGROUND_BATCH_MAX_ITEMS,
+        description=f"Images to remove the background from, at most {REMOVE_BACKGROUND_BATCH_MAX_ITEMS}.",
+    )
+
+
+class RemoveBackgroundBatchItemResult(BaseModel):
+    index: int = Field(..., description="Position of the item in the request.")
+    status: Literal["completed", "failed"]
+    image: Optional[str] = Field(
+        default=None,
+        description="The image with its background removed, in base64 format.",
+    )
+    url: Optional[str] = Field(
+        default=None, description="URL of the stored image with its background removed."
+    )
+    error: Optional[str] = Field(default=None, description="Why this item failed.")
+
+
 class ErrorResponse(BaseModel):
     detail: str
@@ -1,9 +1,12 @@
 import datetime
 import uuid
 
+from typing import Optional
+
 from sqlmodel import Field, SQLModel, String
 
 from api.utils.constants import AVAILABLE_MODELS
+from api.utils.image import OUTPUT_FORMATS
 
 
 class Generation(SQLModel, table=True):
@@ -17,7 +20,16 @@ class Generation(SQLModel, table=True):
     generation_height: int
     seed: int
     model: AVAILABLE_MODELS = Field(sa_type=String, nullable=False)
+    # RunPod endpoint that ran the generation, among those serving the model
+    runpod_endpoint_id: Optional[str] = None
     execution_time_ms: int
+    # Encoding of the stored output, rows from before the option are PNG
+    output_format: OUTPUT_FORMATS = Field(
+        default="png",
+        sa_type=String,
+        nullable=False,
+        sa_column_kwargs={"server_default": "png"},
+    )
     created_at: datetime.datetime = Field(
         default_factory=datetime.datetime.now, nullable=False
     )
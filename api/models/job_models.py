@@ -0,0 +1,70 @@
+import datetime
+import uuid
+from typing import Literal, Optional
+
+from sqlmodel import Field, SQLModel, String
+
+from api.utils.constants import AVAILABLE_MODELS
+from api.utils.image import OUTPUT_FORMATS
+
+JOB_STATUSES = Literal["queued", "in_progress", "finalizing", "completed", "failed"]
+
+
+class GenerationJob(SQLModel, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    user_id: uuid.UUID = Field(foreign_key="users.id", index=True, nullable=False)
+    status: JOB_STATUSES = Field(
+        default="queued", sa_type=String, index=True, nullable=False
+    )
+    runpod_job_id: Optional[str] = None
+    # Endpoint the job was routed to, among those serving its model
+    runpod_endpoint_id: Optional[str] = None
+    # Set on the jobs submitted together through /v1/generate_background/batch
+    batch_id: Optional[uuid.UUID] = Field(default=None, index=True)
+
+    # Everything the poller needs to finish the generation
+    model: AVAILABLE_MODELS = Field(sa_type=String, nullable=False)
+    packshot_path: str
+    packshot_url: str
+    final_prompt: str
+    original_prompt: str
+    generation_width: int
+    generation_height: int
+    seed: int
+    output_format: OUTPUT_FORMATS = Field(
+        default="png",
+        sa_type=String,
+        nullable=False,
+        sa_column_kwargs={"server_default": "png"},
+    )
+    output_quality: Optional[int] = None
+    output_compress_level: Optional[int] = None
+
+    generation_id: Optional[uuid.UUID] = Field(
+        default=None, foreign_key="generations.id"
+    )
+    output_url: Optional[str] = None
+    callback_url: Optional[str] = None
+    # Set with the final status of a job with a callback URL, until its
+    # webhook is delivered or given up on
+    webhook_pending: bool = Field(
+        default=False,
+        nullable=False,
+        index=True,
+        sa_column_kwargs={"server_default": "false"},
+    )
+    error: Optional[str] = None
+
+    # Timings reported by RunPod and measured end to end
+    runpod_delay_time_ms: Optional[int] = None
+    runpod_execution_time_ms: Optional[int] = None
+    execution_time_ms: Optional[int] = None
+    created_at: datetime.datetime = Field(
+        default_factory=datetime.datetime.now, nullable=False
+    )
+    updated_at: datetime.datetime = Field(
+        default_factory=datetime.datetime.now, nullable=False
+    )
+    completed_at: Optional[datetime.datetime] = None
+
+    __tablename__ = "generation_jobs"
@@ -0,0 +1,24 @@
+import datetime
+import uuid
+from typing import Optional
+
+from sqlmodel import Field, SQLModel
+
+
+class WebhookDelivery(SQLModel, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    job_id: uuid.UUID = Field(
+        foreign_key="generation_jobs.id", index=True, nullable=False
+    )
+    url: str
+    event: str  # "generation.completed", "generation.failed"
+    attempt: int
+    success: bool
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    duration_ms: int
+    created_at: datetime.datetime = Field(
+        default_factory=datetime.datetime.now, nullable=False
+    )
+
+    __tablename__ = "webhook_deliveries"
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from decouple import config
+from google.cloud import storage
+import httpx
+from openai import AsyncOpenAI
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import api.utils.storage as storage_utils
+from api.services.write_behind_service import WriteBehindQueue
+from api.utils.endpoint_router import EndpointRouter, model_endpoints
+from api.utils.image_pool import ImageProcessPool
+from api.utils.openai_client import create_openai_client
+from api.utils.photoroom import create_photoroom_client
+from api.utils.runpod import RunPodClient
+from api.utils.upload import create_image_fetch_client
+from api.utils.webhooks import create_webhook_client
+from database.connection import DB_POOL_SIZE, create_db_engine, create_sessionmaker
+
+logger = logging.getLogger(__name__)
+
+RESOURCES_WARMUP_TIMEOUT = config("RESOURCES_WARMUP_TIMEOUT", default=10, cast=float)
+DB_POOL_WARM_CONNECTIONS = config("DB_POOL_WARM_CONNECTIONS", default=2, cast=int)
+
+
+@dataclass
+class Resources:
+    """Clients shared by all requests, built once per process by the app lifespan.
+
+    Handlers get them through the ``get_resources`` dependency, background tasks
+    receive them when they are started.
+    """
+
+    db_engine: AsyncEngine
+    db_sessionmaker: async_sessionmaker[AsyncSession]
+    storage_client: storage.Client
+    openai_client: AsyncOpenAI
+    runpod: RunPodClient
+    router: EndpointRouter
+    photoroom_client: httpx.AsyncClient
+    webhook_client: httpx.AsyncClient
+    image_fetch_client: httpx.AsyncClient
+    image_pool: ImageProcessPool
+    write_behind: WriteBehindQueue
+
+    @classmethod
+    async def create(cls) -> "Resources":
+        db_engine = create_db_engine()
+        # Resolving the default credentials can block on the metadata server
+        storage_client = await asyncio.to_thread(storage_utils.create_storage_client)
+        endpoints = model_endpoints()
+        runpod = RunPodClient(
+            config("RUNPOD_API_KEY", cast=str),
+            [url for urls in endpoints.values() for url in urls],
+        )
+        return cls(
+            db_engine=db_engine,
+            db_sessionmaker=create_sessionmaker(db_engine),
+            storage_client=storage_client,
+            openai_client=create_openai_client(config("OPENAI_API_KEY", cast=str)),
+            runpod=runpod,
+            router=EndpointRouter(runpod, endpoints),
+            photoroom_client=create_photoroom_client(
+                config("PHOTOROOM_API_KEY", cast=str)
+            ),
+            webhook_client=create_webhook_client(),
+            image_fetch_client=create_image_fetch_client(),
+            image_pool=ImageProcessPool(),
+            write_behind=WriteBehindQueue(db_engine, storage_client),
+        )
+
+    async def _warm_db(self) -> None:
+        async def connect():
+            async with self.db_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+
+        # Connections are checked out concurrently, so the pool keeps several of them
+        await asyncio.gather(
+            *(connect() for _ in range(min(DB_POOL_WARM_CONNECTIONS, DB_POOL_SIZE)))
+        )
+
+    async def warm(self) -> None:
+        """Open the connections and fetch the credentials the first requests
+        would otherwise wait for.
+
+        Warm-up is best effort: an upstream that cannot be reached is logged
+        and does not prevent the instance from starting.
+        """
+        warmups = {
+            "postgres": self._warm_db(),
+            "gcs": asyncio.to_thread(
+                self.storage_client.bucket(storage_utils.BUCKET_NAME).exists
+            ),
+            "openai": self.openai_client.models.list(),
+            "runpod": self.runpod.warm(),
+            "photoroom": self.photoroom_client.head("/"),
+            "image_pool": self.image_pool.warm(),
+        }
+        results = await asyncio.gather(
+            *(
+                asyncio.wait_for(warmup, RESOURCES_WARMUP_TIMEOUT)
+                for warmup in warmups.values()
+            ),
+            return_exceptions=True,
+        )
+        for name, result in zip(warmups, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not warm up {name}: {result!r}")
+
+    async def aclose(self) -> None:
+        # Pending records and uploads are flushed while the clients are still open
+        await self.write_behind.aclose()
+        await self.router.aclose()
+        await self.runpod.aclose()
+        await self.photoroom_client.aclose()
+        await self.webhook_client.aclose()
+        await self.image_fetch_client.aclose()
+        await self.openai_client.close()
+        self.storage_client.close()
+        await self.db_engine.dispose()
+        await asyncio.to_thread(self.image_pool.shutdown)
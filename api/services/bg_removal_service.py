@@ -1,16 +1,16 @@
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from api.models.bg_removal_models import BackgroundRemoval
 
 
-def create_bg_removal(removal: BackgroundRemoval, db: Session):
+async def create_bg_removal(removal: BackgroundRemoval, db: AsyncSession):
     """
     Create a new background removal record in the database.
     """
     try:
         db.add(removal)
-        db.commit()
-        db.refresh(removal)
+        await db.commit()
+        await db.refresh(removal)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise e
     return removal
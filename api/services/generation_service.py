@@ -1,16 +1,16 @@
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from api.models.generation_models import Generation
 
 
-def create_generation(generation: Generation, db: Session):
+async def create_generation(generation: Generation, db: AsyncSession):
     """
     Create a new generation record in the database.
     """
     try:
         db.add(generation)
-        db.commit()
-        db.refresh(generation)
+        await db.commit()
+        await db.refresh(generation)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise e
     return generation
@@ -0,0 +1,373 @@
+import asyncio
+import datetime
+import logging
+import uuid
+from io import BytesIO
+
+from decouple import config
+from PIL import Image
+from sqlmodel import and_, col, or_, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import api.utils.storage as storage_utils
+from api.endpoints.v1.generate_background.helpers import postprocess_and_encode
+from api.models.generation_models import Generation
+from api.models.job_models import GenerationJob
+from api.resources import Resources
+from api.services.webhook_service import (
+    redeliver_abandoned_webhooks,
+    schedule_job_webhook,
+)
+from api.utils.constants import OUTPAINT_MODELS_URL
+from api.utils.image import OutputEncoding
+from api.utils.runpod import RUNPOD_FAILED_STATUSES, endpoint_url, parse_runpod_output
+
+logger = logging.getLogger(__name__)
+
+JOB_POLL_INTERVAL_SECONDS = config("JOB_POLL_INTERVAL_SECONDS", default=2, cast=float)
+JOB_POLL_BATCH_SIZE = config("JOB_POLL_BATCH_SIZE", default=20, cast=int)
+# A job left in "finalizing" for longer than this was abandoned by a stopped instance
+JOB_FINALIZE_TIMEOUT_SECONDS = config(
+    "JOB_FINALIZE_TIMEOUT_SECONDS", default=300, cast=float
+)
+# A job still waiting for a RunPod worker this long after it was submitted fails
+JOB_QUEUE_TIMEOUT_SECONDS = config(
+    "JOB_QUEUE_TIMEOUT_SECONDS", default=1800, cast=float
+)
+# Any job still unfinished this long after it was submitted fails, whether it
+# is stuck running, its status cannot be fetched or it cannot be finalized
+JOB_TIMEOUT_SECONDS = config("JOB_TIMEOUT_SECONDS", default=3600, cast=float)
+
+ACTIVE_JOB_STATUSES = ["queued", "in_progress"]
+
+
+async def create_job(job: GenerationJob, db: AsyncSession):
+    """
+    Create a new generation job record in the database.
+    """
+    try:
+        db.add(job)
+        await db.commit()
+        await db.refresh(job)
+    except Exception as e:
+        await db.rollback()
+        raise e
+    return job
+
+
+async def create_jobs(jobs: list[GenerationJob], db: AsyncSession):
+    """
+    Create several generation job records in one transaction.
+    """
+    try:
+        db.add_all(jobs)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise e
+    return jobs
+
+
+async def get_job(
+    job_id: uuid.UUID, user_id: uuid.UUID, db: AsyncSession
+) -> GenerationJob | None:
+    """
+    Get a generation job owned by the user.
+    """
+    result = await db.exec(
+        select(GenerationJob).where(
+            GenerationJob.id == job_id, GenerationJob.user_id == user_id
+        )
+    )
+    return result.first()
+
+
+async def get_batch_jobs(
+    batch_id: uuid.UUID, user_id: uuid.UUID, db: AsyncSession
+) -> list[GenerationJob]:
+    """
+    Get the generation jobs of a batch owned by the user, oldest first.
+    """
+    result = await db.exec(
+        select(GenerationJob)
+        .where(GenerationJob.batch_id == batch_id, GenerationJob.user_id == user_id)
+        .order_by(GenerationJob.created_at)
+    )
+    return list(result.all())
+
+
+async def lock_jobs(
+    db: AsyncSession, job_ids: list[uuid.UUID]
+) -> dict[uuid.UUID, GenerationJob]:
+    """
+    Lock the rows of jobs until the end of the transaction, to change their
+    status knowing that no other instance is changing it.
+    """
+    result = await db.exec(
+        select(GenerationJob)
+        .where(col(GenerationJob.id).in_(job_ids))
+        .with_for_update()
+    )
+    return {job.id: job for job in result.all()}
+
+
+async def claim_jobs_to_poll(db: AsyncSession) -> list[GenerationJob]:
+    """
+    Claim the next batch of unfinished jobs. Rows locked by another instance are
+    skipped, so several instances can run the poller side by side.
+
+    The claimed jobs are touched and the transaction is committed at once:
+    other instances skip them until the next poll interval without a lock
+    being held while RunPod is called.
+    """
+    now = datetime.datetime.now()
+    poll_before = now - datetime.timedelta(seconds=JOB_POLL_INTERVAL_SECONDS)
+    stale_before = now - datetime.timedelta(seconds=JOB_FINALIZE_TIMEOUT_SECONDS)
+    result = await db.exec(
+        select(GenerationJob)
+        .where(
+            or_(
+                and_(
+                    col(GenerationJob.status).in_(ACTIVE_JOB_STATUSES),
+                    GenerationJob.updated_at < poll_before,
+                ),
+                and_(
+                    GenerationJob.status == "finalizing",
+                    GenerationJob.updated_at < stale_before,
+                ),
+            )
+        )
+        .order_by(GenerationJob.updated_at)
+        .limit(JOB_POLL_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    jobs = list(result.all())
+    for job in jobs:
+        job.updated_at = now
+    await db.commit()
+    return jobs
+
+
+async def mark_job_failed(resources: Resources, job_id: uuid.UUID, error: str) -> None:
+    async with resources.db_sessionmaker() as db:
+        job = (await lock_jobs(db, [job_id]))[job_id]
+        # A job finished by another instance keeps its outcome
+        if job.status in ("completed", "failed"):
+            return
+        job.status = "failed"
+        job.error = error
+        job.webhook_pending = job.callback_url is not None
+        job.completed_at = job.updated_at = datetime.datetime.now()
+        await db.commit()
+    schedule_job_webhook(resources, job)
+
+
+async def finalize_job(
+    resources: Resources, job: GenerationJob, response_json: dict
+) -> None:
+    """
+    Post-process the RunPod output of a completed job, upload it and save the generation.
+    """
+    try:
+        generation_image = parse_runpod_output(response_json)
+        # Jobs are finalized in the background, their GCS calls are never shed
+        packshot_data = await storage_utils.call_gcs(
+            storage_utils.download_image,
+            resources.storage_client,
+            job.packshot_path,
+            shed=False,
+        )
+        packshot_image = Image.open(BytesIO(packshot_data))
+
+        encoding = OutputEncoding(
+            format=job.output_format,
+            quality=job.output_quality,
+            compress_level=job.output_compress_level,
+        )
+        output_bytes = await resources.image_pool.run(
+            postprocess_and_encode,
+            generation_image,
+            packshot_image,
+            job.generation_width,
+            job.generation_height,
+            encoding,
+        )
+
+        now = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        file_path = f"api/{job.user_id}/hd/{now}_{uuid.uuid4()}.{encoding.extension}"
+        output_url = await storage_utils.call_gcs(
+            storage_utils.upload_image,
+            resources.storage_client,
+            output_bytes,
+            file_path,
+            encoding.media_type,
+            shed=False,
+        )
+    except Exception as e:
+        logger.exception(f"Failed to finalize generation job {job.id}")
+        await mark_job_failed(resources, job.id, str(e))
+        return
+
+    execution_time_ms = int(
+        (datetime.datetime.now() - job.created_at).total_seconds() * 1000
+    )
+    generation = Generation(
+        user_id=job.user_id,
+        output_url=output_url,
+        packshot_url=job.packshot_url,
+        final_prompt=job.final_prompt,
+        original_prompt=job.original_prompt,
+        generation_width=job.generation_width,
+        generation_height=job.generation_height,
+        seed=job.seed,
+        model=job.model,
+        runpod_endpoint_id=job.runpod_endpoint_id,
+        output_format=job.output_format,
+        execution_time_ms=execution_time_ms,
+    )
+
+    # The generation and the job are written in one transaction, so a job is
+    # never completed without its generation. The job's row is locked first:
+    # an instance finalizing the same job waits, then finds it completed.
+    async with resources.db_sessionmaker() as db:
+        try:
+            db_job = (await lock_jobs(db, [job.id]))[job.id]
+            if db_job.status != "finalizing":
+                await db.rollback()
+                logger.warning(
+                    f"Generation job {job.id} is already {db_job.status}, discarding {output_url}"
+                )
+                return
+            db.add(generation)
+            db_job.status = "completed"
+            db_job.generation_id = generation.id
+            db_job.output_url = output_url
+            db_job.execution_time_ms = execution_time_ms
+            db_job.webhook_pending = db_job.callback_url is not None
+            db_job.completed_at = db_job.updated_at = datetime.datetime.now()
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            raise e
+    schedule_job_webhook(resources, db_job)
+
+
+def job_endpoint_url(job: GenerationJob) -> str:
+    # Jobs from before endpoint routing ran on the endpoint of their model
+    if job.runpod_endpoint_id:
+        return endpoint_url(job.runpod_endpoint_id)
+    return OUTPAINT_MODELS_URL[job.model]
+
+
+def update_job_from_runpod_status(job: GenerationJob, response_json: dict) -> None:
+    runpod_status = response_json.get("status")
+    if "delayTime" in response_json:
+        job.runpod_delay_time_ms = response_json["delayTime"]
+    if "executionTime" in response_json:
+        job.runpod_execution_time_ms = response_json["executionTime"]
+
+    if runpod_status == "COMPLETED":
+        job.status = "finalizing"
+    elif runpod_status in RUNPOD_FAILED_STATUSES:
+        job.status = "failed"
+        job.error = str(response_json.get("error") or runpod_status)
+        job.webhook_pending = job.callback_url is not None
+        job.completed_at = datetime.datetime.now()
+    elif runpod_status == "IN_PROGRESS":
+        job.status = "in_progress"
+    job.updated_at = datetime.datetime.now()
+
+
+async def poll_jobs(resources: Resources) -> None:
+    """
+    Refresh the status of unfinished jobs from RunPod and finalize completed ones.
+    """
+    async with resources.db_sessionmaker() as db:
+        jobs = await claim_jobs_to_poll(db)
+    if not jobs:
+        return
+
+    responses = await asyncio.gather(
+        *(
+            resources.runpod.get_job_status(job_endpoint_url(job), job.runpod_job_id)
+            for job in jobs
+        ),
+        return_exceptions=True,
+    )
+
+    now = datetime.datetime.now()
+    queued_before = now - datetime.timedelta(seconds=JOB_QUEUE_TIMEOUT_SECONDS)
+    deadline_before = now - datetime.timedelta(seconds=JOB_TIMEOUT_SECONDS)
+    completed, failed, timed_out = [], [], []
+    async with resources.db_sessionmaker() as db:
+        db_jobs = await lock_jobs(db, [job.id for job in jobs])
+        for job, response_json in zip(jobs, responses):
+            db_job = db_jobs.get(job.id)
+            # Another instance moved the job on while RunPod was called
+            if db_job is None or db_job.status != job.status:
+                continue
+            if isinstance(response_json, Exception):
+                logger.warning(
+                    f"Could not fetch RunPod status for job {job.id}: {response_json}"
+                )
+            else:
+                update_job_from_runpod_status(db_job, response_json)
+            error = None
+            if db_job.status == "queued" and db_job.created_at < queued_before:
+                error = f"The job was not started within {JOB_QUEUE_TIMEOUT_SECONDS:g} seconds."
+            elif db_job.created_at < deadline_before and (
+                db_job.status in ACTIVE_JOB_STATUSES
+                # Claimed again after its finalization failed or was abandoned
+                or (job.status == "finalizing" and db_job.status == "finalizing")
+            ):
+                error = (
+                    f"The job did not finish within {JOB_TIMEOUT_SECONDS:g} seconds."
+                )
+            if error:
+                db_job.status = "failed"
+                db_job.error = error
+                db_job.webhook_pending = db_job.callback_url is not None
+                db_job.completed_at = db_job.updated_at = datetime.datetime.now()
+                timed_out.append(db_job)
+            if db_job.status == "failed":
+                failed.append(db_job)
+            elif db_job.status == "finalizing" and isinstance(response_json, dict):
+                completed.append((db_job, response_json))
+                if (
+                    job.status != "finalizing"
+                    and db_job.runpod_execution_time_ms is not None
+                ):
+                    resources.router.observe_latency(
+                        job_endpoint_url(db_job),
+                        (db_job.runpod_delay_time_ms or 0) / 1000
+                        + db_job.runpod_execution_time_ms / 1000,
+                    )
+        await db.commit()
+
+    for job in failed:
+        schedule_job_webhook(resources, job)
+
+    await asyncio.gather(
+        # The jobs that timed out are not left to run on a worker
+        *(
+            resources.runpod.cancel_job(job_endpoint_url(job), job.runpod_job_id)
+            for job in timed_out
+        ),
+        *(
+            finalize_job(resources, job, response_json)
+            for job, response_json in completed
+        ),
+    )
+
+
+async def run_job_poller(resources: Resources) -> None:
+    """
+    Background task polling RunPod for the jobs submitted in async mode.
+    """
+    while True:
+        try:
+            await poll_jobs(resources)
+            await redeliver_abandoned_webhooks(resources)
+        except Exception:
+            logger.exception("Generation job poller iteration failed")
+        await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
@@ -1,57 +1,91 @@
 from typing import Union, Dict
+import httpx
 from PIL import Image
-from sqlmodel import Session
-import api.utils.image as image_utils
-from api.endpoints.v1.remove_background.helpers import remove_background_helper
+from sqlmodel.ext.asyncio.session import AsyncSession
+from api.endpoints.v1.remove_background.helpers import (
+    SEGMENTATION_PROXY_MAX_SIZE,
+    remove_background_cached,
+)
 from api.models.preprocess_models import Preprocess
+from api.utils.image_kernels import alpha_bbox, has_alpha
+from api.utils.image_pool import ImageProcessPool
+from api.utils.upload import open_image
 
 # TODO: Import necessary image processing utilities
 
 
-def create_preprocess(preprocess: Preprocess, db: Session):
+async def create_preprocess(preprocess: Preprocess, db: AsyncSession):
     """
     Create a new preprocess record in the database.
     """
     try:
         db.add(preprocess)
-        db.commit()
-        db.refresh(preprocess)
+        await db.commit()
+        await db.refresh(preprocess)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise e
     return preprocess
 
 
 def crop_to_content(image: Image.Image) -> Image.Image:
     # Crop out fully transparent borders
-    if image.mode != "RGBA":
+    if not has_alpha(image.mode) and "transparency" in image.info:
+        # Palette or color key transparency only shows as an alpha band
         image = image.convert("RGBA")
-    bbox = image.getbbox()
+    bbox = alpha_bbox(image)
     if bbox:
-        return image.crop(bbox)
+        image = image.crop(bbox)
+    # Only the cropped image is converted
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
     return image
 
 
-def preprocess_image(
-    image_b64: str,
+async def preprocess_image(
+    image_data: bytes,
     margin: Union[float, Dict[str, float]],
     h_align: str,
     v_align: str,
     target_w: int,
     target_h: int,
-) -> str:
+    photoroom_client: httpx.AsyncClient,
+    image_pool: ImageProcessPool,
+) -> Image.Image:
     """
     Process the image by removing background, cropping, adding margins, aligning, and resizing/canvas.
-    Returns the processed image as base64.
+    Returns the processed image.
     """
-    # 1. Convert base64 to PIL Image
-    if image_b64.startswith("data:image"):
-        image_b64 = image_b64.split(",", 1)[1]
-    input_image = image_utils.base64_string_to_image(image_b64)
+    # 1. Open the uploaded image
+    input_image = open_image(image_data)
+
+    # 2. Remove background (cached by image content, re-layouts of the same photo skip segmentation)
+    # Large photos are segmented through a downscaled proxy, they are resized to the canvas anyway
+    no_bg_image = await remove_background_cached(
+        image_data,
+        input_image,
+        photoroom_client,
+        image_pool,
+        proxy_max_size=SEGMENTATION_PROXY_MAX_SIZE,
+    )
+
+    # The remaining steps are CPU bound, run them in a worker process
+    return await image_pool.run(
+        place_on_canvas, no_bg_image, margin, h_align, v_align, target_w, target_h
+    )
 
-    # 2. Remove background
-    no_bg_image = remove_background_helper(input_image)
 
+def place_on_canvas(
+    no_bg_image: Image.Image,
+    margin: Union[float, Dict[str, float]],
+    h_align: str,
+    v_align: str,
+    target_w: int,
+    target_h: int,
+) -> Image.Image:
+    """
+    Crop the cutout to its content, add margins, resize and align it on the target canvas.
+    """
     # 2b. Crop to content (remove transparent borders)
     no_bg_image = crop_to_content(no_bg_image)
 
@@ -126,5 +160,4 @@ def preprocess_image(
 
     canvas.paste(resized_image, (x, y), resized_image)
 
-    # 8. Return as base64
-    return image_utils.image_to_base64_string(canvas)
+    return canvas
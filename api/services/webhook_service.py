@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import json
+import logging
+import random
+import time
+import uuid
+
+from decouple import config
+import httpx
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api.endpoints.v1.jobs.schema import GenerationJobResponse
+from api.models.job_models import GenerationJob
+from api.models.user_models import User
+from api.models.webhook_models import WebhookDelivery
+from api.resources import Resources
+from api.utils.public_network import (
+    HostResolutionError,
+    NonPublicURLError,
+    check_public_url,
+)
+from api.utils.webhooks import SIGNATURE_HEADER, is_retryable_status, sign_payload
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_MAX_ATTEMPTS = config("WEBHOOK_MAX_ATTEMPTS", default=6, cast=int)
+WEBHOOK_BACKOFF_BASE = config("WEBHOOK_BACKOFF_BASE", default=2, cast=float)
+WEBHOOK_BACKOFF_MAX = config("WEBHOOK_BACKOFF_MAX", default=300, cast=float)
+WEBHOOK_REDELIVERY_BATCH_SIZE = config(
+    "WEBHOOK_REDELIVERY_BATCH_SIZE", default=20, cast=int
+)
+# A webhook still pending this long after its job finished was abandoned by a
+# stopped instance, and is delivered again by the job poller
+WEBHOOK_REDELIVERY_TIMEOUT_SECONDS = config(
+    "WEBHOOK_REDELIVERY_TIMEOUT_SECONDS", default=600, cast=float
+)
+# How long a stopping instance waits for the deliveries in progress
+WEBHOOK_DRAIN_TIMEOUT = config("WEBHOOK_DRAIN_TIMEOUT", default=10, cast=float)
+
+# Keep references to the delivery tasks so they are not garbage collected
+webhook_tasks: set[asyncio.Task] = set()
+
+
+async def create_webhook_delivery(delivery: WebhookDelivery, db: AsyncSession):
+    """
+    Create a new webhook delivery record in the database.
+    """
+    try:
+        db.add(delivery)
+        await db.commit()
+        await db.refresh(delivery)
+    except Exception as e:
+        await db.rollback()
+        raise e
+    return delivery
+
+
+def build_job_webhook_payload(job: GenerationJob) -> dict:
+    return {
+        "event": f"generation.{job.status}",
+        **GenerationJobResponse.from_job(job).model_dump(mode="json"),
+        "timings": {
+            "execution_time_ms": job.execution_time_ms,
+            "runpod_delay_time_ms": job.runpod_delay_time_ms,
+            "runpod_execution_time_ms": job.runpod_execution_time_ms,
+        },
+    }
+
+
+async def deliver_job_webhook(resources: Resources, job_id: uuid.UUID) -> None:
+    """
+    POST the result of a finished job to its callback URL, retrying with
+    exponential backoff and logging every attempt.
+
+    The callback URL is checked to resolve to public addresses before every
+    attempt, since its DNS records may have changed since the job was created.
+    """
+    async with resources.db_sessionmaker() as db:
+        job = await db.get(GenerationJob, job_id)
+        user = await db.get(User, job.user_id)
+
+    payload = build_job_webhook_payload(job)
+    body = json.dumps(payload).encode()
+    delivery_id = str(uuid.uuid4())
+
+    for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+        # Webhooks are signed with the API key of the user, which is the secret
+        # the integrator already holds
+        headers = {
+            "Content-Type": "application/json",
+            "X-Presti-Delivery-Id": delivery_id,
+            "X-Presti-Event": payload["event"],
+            SIGNATURE_HEADER: sign_payload(user.api_key, body),
+        }
+        status_code, error, retryable = None, None, True
+        t0 = time.time()
+        try:
+            await check_public_url(job.callback_url)
+            response = await resources.webhook_client.post(
+                job.callback_url, content=body, headers=headers
+            )
+            status_code = response.status_code
+            retryable = is_retryable_status(status_code)
+            if not response.is_success:
+                error = f"HTTP {status_code}"
+        except NonPublicURLError as e:
+            error = str(e)
+            retryable = isinstance(e, HostResolutionError)
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+
+        delivery = WebhookDelivery(
+            job_id=job.id,
+            url=job.callback_url,
+            event=payload["event"],
+            attempt=attempt,
+            success=error is None,
+            status_code=status_code,
+            error=error,
+            duration_ms=int((time.time() - t0) * 1000),
+        )
+        async with resources.db_sessionmaker() as db:
+            await create_webhook_delivery(delivery, db)
+
+        if delivery.success or not retryable:
+            break
+        if attempt == WEBHOOK_MAX_ATTEMPTS:
+            logger.warning(
+                f"Giving up webhook delivery for job {job.id} after {WEBHOOK_MAX_ATTEMPTS} attempts"
+            )
+            break
+        # Full jitter, so that a recovering receiver is not hit by synchronized retries
+        await asyncio.sleep(
+            random.uniform(
+                0, min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** (attempt - 1))
+            )
+        )
+
+    async with resources.db_sessionmaker() as db:
+        db_job = await db.get(GenerationJob, job.id)
+        db_job.webhook_pending = False
+        await db.commit()
+
+
+def schedule_job_webhook(resources: Resources, job: GenerationJob) -> None:
+    """Deliver the webhook of a job saved with ``webhook_pending`` set."""
+    if not job.callback_url:
+        return
+    task = asyncio.create_task(deliver_job_webhook(resources, job.id))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+
+
+async def redeliver_abandoned_webhooks(resources: Resources) -> None:
+    """
+    Deliver again the webhooks left pending by a stopped instance. Rows locked
+    by another instance are skipped, and the claimed jobs are touched so that
+    they are not claimed again while they are delivered.
+    """
+    abandoned_before = datetime.datetime.now() - datetime.timedelta(
+        seconds=WEBHOOK_REDELIVERY_TIMEOUT_SECONDS
+    )
+    async with resources.db_sessionmaker() as db:
+        result = await db.exec(
+            select(GenerationJob)
+            .where(
+                col(GenerationJob.webhook_pending),
+                GenerationJob.updated_at < abandoned_before,
+            )
+            .order_by(GenerationJob.updated_at)
+            .limit(WEBHOOK_REDELIVERY_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        jobs = list(result.all())
+        for job in jobs:
+            job.updated_at = datetime.datetime.now()
+        await db.commit()
+
+    for job in jobs:
+        logger.info(f"Redelivering the abandoned webhook of job {job.id}")
+        schedule_job_webhook(resources, job)
+
+
+async def drain_webhooks(timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+    """
+    Wait for the deliveries in progress when the instance stops. Those still
+    running after ``timeout`` are cancelled and stay pending, to be delivered
+    again by the job poller of another instance.
+    """
+    if not webhook_tasks:
+        return
+    _, pending = await asyncio.wait(set(webhook_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,434 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+
+from decouple import config
+from google.cloud import storage
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import SQLModel
+
+import api.utils.storage as storage_utils
+from api.models.bg_removal_models import BackgroundRemoval
+from api.models.generation_models import Generation
+from api.models.preprocess_models import Preprocess
+from api.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_QUEUE_SIZE = config("WRITE_BEHIND_QUEUE_SIZE", default=10_000, cast=int)
+WRITE_BEHIND_BATCH_SIZE = config("WRITE_BEHIND_BATCH_SIZE", default=500, cast=int)
+# Pending uploads hold whole encoded images, their queue is kept short
+WRITE_BEHIND_UPLOAD_QUEUE_SIZE = config(
+    "WRITE_BEHIND_UPLOAD_QUEUE_SIZE", default=32, cast=int
+)
+WRITE_BEHIND_UPLOAD_WORKERS = config("WRITE_BEHIND_UPLOAD_WORKERS", default=4, cast=int)
+WRITE_BEHIND_SPILL_DIR = config(
+    "WRITE_BEHIND_SPILL_DIR", default="/tmp/presti-write-behind", cast=str
+)
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = config(
+    "WRITE_BEHIND_SHUTDOWN_TIMEOUT", default=30, cast=float
+)
+
+# Errors of the rows themselves, which no retry can fix
+INVALID_RECORD_ERRORS = (IntegrityError, DataError)
+
+# Usage records that can be written behind, by table name for the spill files
+WRITE_BEHIND_MODELS: dict[str, type[SQLModel]] = {
+    model.__tablename__: model for model in (Generation, BackgroundRemoval, Preprocess)
+}
+
+
+class WriteBehindQueue:
+    """Usage records and uploads written after the response was sent.
+
+    Records are queued and inserted in batches by a background task. When
+    Postgres cannot be reached, a batch is spilled to a JSON lines file in
+    ``spill_dir`` and inserted again after the next successful batch, or by the
+    next process using the same directory. Inserts skip rows whose id already
+    exists, so a spilled batch can be replayed safely. Rows that Postgres
+    refuses are set aside in ``.invalid`` files instead of being retried.
+
+    Uploads are queued and sent to GCS by a few worker tasks. Their URLs are
+    already in responses and usage records, so an upload that fails or is still
+    queued at shutdown is spilled to ``spill_dir/uploads`` too, and sent again
+    after the next successful upload or by the next process. Both queues are
+    bounded: when one is full, adding to it waits for room.
+    """
+
+    def __init__(
+        self,
+        db_engine: AsyncEngine,
+        storage_client: storage.Client,
+        spill_dir: str = WRITE_BEHIND_SPILL_DIR,
+    ):
+        self.db_engine = db_engine
+        self.storage_client = storage_client
+        self.spill_dir = spill_dir
+        self.upload_spill_dir = os.path.join(spill_dir, "uploads")
+        # Records added together are queued together, and written in the same insert
+        self._records: asyncio.Queue[list[SQLModel]] = asyncio.Queue(
+            maxsize=WRITE_BEHIND_QUEUE_SIZE
+        )
+        self._uploads: asyncio.Queue[tuple[bytes, str, str]] = asyncio.Queue(
+            maxsize=WRITE_BEHIND_UPLOAD_QUEUE_SIZE
+        )
+        self._tasks: list[asyncio.Task] = []
+        self._queued_records = 0
+        self._spill_files = 0
+        self._spilled_uploads = 0
+        self._replaying_uploads = False
+        self.records_written = 0
+        self.records_spilled = 0
+        self.records_replayed = 0
+        self.records_quarantined = 0
+        self.batches = 0
+        self.uploads_done = 0
+        self.uploads_failed = 0
+        self.uploads_spilled = 0
+        self.uploads_replayed = 0
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._drain_records()),
+            asyncio.create_task(self._replay_spilled_uploads()),
+        ] + [
+            asyncio.create_task(self._drain_uploads())
+            for _ in range(WRITE_BEHIND_UPLOAD_WORKERS)
+        ]
+
+    async def add_record(self, record: SQLModel) -> None:
+        await self.add_records([record])
+
+    async def add_records(self, records: list[SQLModel]) -> None:
+        if records:
+            self._queued_records += len(records)
+            await self._records.put(list(records))
+
+    async def add_upload(
+        self, image: bytes, file_path: str, content_type: str = "image/png"
+    ) -> str:
+        """Queue an image upload and return the URL it will be served at."""
+        await self._uploads.put((image, file_path, content_type))
+        return storage_utils.image_public_url(self.storage_client, file_path)
+
+    async def _drain_records(self) -> None:
+        await self._replay_spilled()
+        while True:
+            # Records queued while the previous batch was written go in the next one
+            entries = [await self._records.get()]
+            batch = list(entries[0])
+            while len(batch) < WRITE_BEHIND_BATCH_SIZE and not self._records.empty():
+                entries.append(self._records.get_nowait())
+                batch.extend(entries[-1])
+            self._queued_records -= len(batch)
+            try:
+                await self._write_batch(batch)
+            except Exception:
+                # The only writer of the records, it must outlive any error
+                logger.exception(f"Write-behind batch of {len(batch)} records failed")
+            finally:
+                for _ in entries:
+                    self._records.task_done()
+
+    async def _write_batch(self, records: list[SQLModel]) -> None:
+        try:
+            with metrics.stage("write_behind", "db_insert"):
+                invalid = await self._insert_valid(records)
+        except asyncio.CancelledError:
+            # Stopped mid-batch on shutdown, the batch is replayed on the next start
+            self._spill(records)
+            raise
+        except Exception:
+            logger.exception(f"Could not write {len(records)} usage records")
+            await asyncio.to_thread(self._spill, records)
+            return
+        if invalid:
+            await asyncio.to_thread(self._quarantine, invalid)
+        self.records_written += len(records) - len(invalid)
+        self.batches += 1
+        if self._spill_files:
+            # Postgres is reachable again
+            await self._replay_spilled()
+
+    async def _insert(self, records: list[SQLModel]) -> None:
+        rows_by_model = defaultdict(list)
+        for record in records:
+            rows_by_model[type(record)].append(record.model_dump())
+        # One executemany per table, in a single transaction
+        async with self.db_engine.begin() as connection:
+            for model, rows in rows_by_model.items():
+                await connection.execute(
+                    insert(model.__table__).on_conflict_do_nothing(
+                        index_elements=["id"]
+                    ),
+                    rows,
+                )
+
+    async def _insert_valid(self, records: list[SQLModel]) -> list[SQLModel]:
+        """Insert the records and return those Postgres refused.
+
+        A refused row (a broken foreign key, a value out of range) fails the
+        whole batch, which is then inserted row by row to write the others.
+        Other errors, like a lost connection, are raised.
+        """
+        try:
+            await self._insert(records)
+            return []
+        except INVALID_RECORD_ERRORS:
+            if len(records) == 1:
+                logger.exception(f"Usage record {records[0].id} refused")
+                return records
+            logger.warning(
+                f"Batch of {len(records)} usage records refused, inserting them one by one"
+            )
+        invalid = []
+        for record in records:
+            try:
+                await self._insert([record])
+            except INVALID_RECORD_ERRORS:
+                logger.exception(f"Usage record {record.id} refused")
+                invalid.append(record)
+        return invalid
+
+    def _write_records_file(self, path: str, records: list[SQLModel]) -> None:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(f"{path}.tmp", "w") as spill_file:
+            for record in records:
+                spill_file.write(
+                    json.dumps(
+                        {
+                            "table": record.__tablename__,
+                            "row": record.model_dump(mode="json"),
+                        }
+                    )
+                    + "\n"
+                )
+        os.replace(f"{path}.tmp", path)
+
+    def _spill(self, records: list[SQLModel]) -> None:
+        path = os.path.join(self.spill_dir, f"{time.time_ns()}-{uuid.uuid4()}.jsonl")
+        try:
+            self._write_records_file(path, records)
+        except OSError:
+            logger.exception(f"Could not spill {len(records)} usage records, lost")
+            return
+        self._spill_files += 1
+        self.records_spilled += len(records)
+
+    def _quarantine(self, records: list[SQLModel]) -> None:
+        # Kept for inspection, .invalid files are not replayed
+        path = os.path.join(
+            self.spill_dir, f"{time.time_ns()}-{uuid.uuid4()}.jsonl.invalid"
+        )
+        try:
+            self._write_records_file(path, records)
+        except OSError:
+            logger.exception(f"Could not set aside {len(records)} invalid records")
+            return
+        self.records_quarantined += len(records)
+
+    def _read_spill_file(self, path: str) -> list[SQLModel]:
+        with open(path) as spill_file:
+            lines = [json.loads(line) for line in spill_file if line.strip()]
+        return [
+            WRITE_BEHIND_MODELS[line["table"]].model_validate(line["row"])
+            for line in lines
+        ]
+
+    def _list_spill_files(self) -> list[str]:
+        if not os.path.isdir(self.spill_dir):
+            return []
+        return sorted(
+            os.path.join(self.spill_dir, name)
+            for name in os.listdir(self.spill_dir)
+            if name.endswith(".jsonl")
+        )
+
+    async def _replay_spilled(self) -> None:
+        try:
+            paths = await asyncio.to_thread(self._list_spill_files)
+        except OSError:
+            logger.exception("Could not list the spilled usage records")
+            return
+        self._spill_files = len(paths)
+        for path in paths:
+            try:
+                records = await asyncio.to_thread(self._read_spill_file, path)
+            except (OSError, ValueError, KeyError):
+                # Set aside, so that an unreadable file does not block the others
+                logger.exception(f"Unreadable spilled usage records {path}")
+                try:
+                    await asyncio.to_thread(os.replace, path, f"{path}.invalid")
+                except OSError:
+                    logger.exception(f"Could not set aside {path}")
+                    continue
+                self._spill_files -= 1
+                continue
+            try:
+                invalid = await self._insert_valid(records)
+            except Exception:
+                # Left for the next replay, the other files are still tried
+                logger.exception(f"Could not replay spilled usage records {path}")
+                continue
+            if invalid:
+                await asyncio.to_thread(self._quarantine, invalid)
+            self.records_replayed += len(records) - len(invalid)
+            try:
+                await asyncio.to_thread(os.remove, path)
+            except OSError:
+                # Replayed again later, the rows already inserted are skipped
+                logger.exception(f"Could not remove replayed usage records {path}")
+                continue
+            self._spill_files -= 1
+
+    async def _upload(self, image: bytes, file_path: str, content_type: str) -> None:
+        # Already answered for, the upload waits for room rather than being shed
+        with metrics.stage("write_behind", "gcs_upload"):
+            await storage_utils.call_gcs(
+                storage_utils.upload_image,
+                self.storage_client,
+                image,
+                file_path,
+                content_type,
+                shed=False,
+            )
+
+    async def _drain_uploads(self) -> None:
+        while True:
+            image, file_path, content_type = await self._uploads.get()
+            try:
+                await self._upload(image, file_path, content_type)
+                self.uploads_done += 1
+            except asyncio.CancelledError:
+                # Stopped mid-upload on shutdown, sent again on the next start
+                self._spill_upload(image, file_path, content_type)
+                raise
+            except Exception:
+                logger.exception(f"Deferred upload of {file_path} failed")
+                self.uploads_failed += 1
+                await asyncio.to_thread(
+                    self._spill_upload, image, file_path, content_type
+                )
+            else:
+                if self._spilled_uploads and not self._replaying_uploads:
+                    # GCS is reachable again
+                    await self._replay_spilled_uploads()
+            finally:
+                self._uploads.task_done()
+
+    def _spill_upload(self, image: bytes, file_path: str, content_type: str) -> None:
+        # A JSON header line, then the image bytes
+        path = os.path.join(
+            self.upload_spill_dir, f"{time.time_ns()}-{uuid.uuid4()}.upload"
+        )
+        header = {"file_path": file_path, "content_type": content_type}
+        try:
+            os.makedirs(self.upload_spill_dir, exist_ok=True)
+            with open(f"{path}.tmp", "wb") as spill_file:
+                spill_file.write(json.dumps(header).encode() + b"\n")
+                spill_file.write(image)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            logger.exception(f"Could not spill the upload of {file_path}, lost")
+            return
+        self._spilled_uploads += 1
+        self.uploads_spilled += 1
+
+    def _read_spilled_upload(self, path: str) -> tuple[bytes, str, str]:
+        with open(path, "rb") as spill_file:
+            header = json.loads(spill_file.readline())
+            image = spill_file.read()
+        return image, header["file_path"], header["content_type"]
+
+    def _list_spilled_uploads(self) -> list[str]:
+        if not os.path.isdir(self.upload_spill_dir):
+            return []
+        return sorted(
+            os.path.join(self.upload_spill_dir, name)
+            for name in os.listdir(self.upload_spill_dir)
+            if name.endswith(".upload")
+        )
+
+    async def _replay_spilled_uploads(self) -> None:
+        # Spilled images are read one at a time, not queued, to bound the memory
+        self._replaying_uploads = True
+        try:
+            try:
+                paths = await asyncio.to_thread(self._list_spilled_uploads)
+            except OSError:
+                logger.exception("Could not list the spilled uploads")
+                return
+            self._spilled_uploads = len(paths)
+            for path in paths:
+                try:
+                    upload = await asyncio.to_thread(self._read_spilled_upload, path)
+                except (OSError, ValueError, KeyError):
+                    logger.exception(f"Unreadable spilled upload {path}")
+                    try:
+                        await asyncio.to_thread(os.replace, path, f"{path}.invalid")
+                    except OSError:
+                        logger.exception(f"Could not set aside {path}")
+                        continue
+                    self._spilled_uploads -= 1
+                    continue
+                try:
+                    await self._upload(*upload)
+                except Exception:
+                    # Left for the next replay, the other files are still tried
+                    logger.exception(f"Could not replay the spilled upload {path}")
+                    continue
+                self.uploads_replayed += 1
+                try:
+                    await asyncio.to_thread(os.remove, path)
+                except OSError:
+                    # Uploaded again later, which overwrites the same object
+                    logger.exception(f"Could not remove the replayed upload {path}")
+                    continue
+                self._spilled_uploads -= 1
+        finally:
+            self._replaying_uploads = False
+
+    async def aclose(self) -> None:
+        """Flush the queues, spilling the records and uploads that could not be
+        written in time."""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(self._records.join(), self._uploads.join()),
+                WRITE_BEHIND_SHUTDOWN_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out flushing the write-behind queues")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        remaining = []
+        while not self._records.empty():
+            remaining.extend(self._records.get_nowait())
+        if remaining:
+            self._spill(remaining)
+        while not self._uploads.empty():
+            await asyncio.to_thread(self._spill_upload, *self._uploads.get_nowait())
+
+    def stats(self) -> dict:
+        return {
+            "queued_records": self._queued_records,
+            "queued_uploads": self._uploads.qsize(),
+            "records_written": self.records_written,
+            "batches": self.batches,
+            "records_spilled": self.records_spilled,
+            "records_replayed": self.records_replayed,
+            "records_quarantined": self.records_quarantined,
+            "spill_files": self._spill_files,
+            "uploads_done": self.uploads_done,
+            "uploads_failed": self.uploads_failed,
+            "uploads_spilled": self.uploads_spilled,
+            "uploads_replayed": self.uploads_replayed,
+            "spilled_uploads": self._spilled_uploads,
+        }
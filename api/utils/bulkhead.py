@@ -0,0 +1,126 @@
+import asyncio
+import functools
+import statistics
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Optional
+
+from decouple import config
+from fastapi import HTTPException
+
+# Queue times kept per bulkhead for the percentiles of the stats
+BULKHEAD_QUEUE_TIME_WINDOW = config(
+    "BULKHEAD_QUEUE_TIME_WINDOW", default=1_000, cast=int
+)
+
+
+class BulkheadFullError(HTTPException):
+    """Raised instead of queueing a call when an upstream's bulkhead queue is full."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"The {name} service is at capacity, please retry later.",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.name = name
+
+
+class Bulkhead:
+    """Bounds the concurrent calls to one upstream service.
+
+    Calls beyond ``max_concurrent`` wait in a queue of at most ``max_queue``
+    calls. Once the queue is full, calls fail at once with a 503 and a
+    ``Retry-After`` of ``retry_after`` seconds, rather than piling up until
+    they time out. Background calls that must not be shed pass
+    ``shed=False``, they wait whatever the queue length.
+
+    Blocking calls go through ``run_sync``, in threads of the bulkhead's own,
+    so that a slow upstream cannot take the threads the others need.
+    """
+
+    def __init__(
+        self, name: str, max_concurrent: int, max_queue: int, retry_after: int
+    ):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queue_times: deque[float] = deque(maxlen=BULKHEAD_QUEUE_TIME_WINDOW)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.max_queue_time = 0.0
+        BULKHEADS[name] = self
+
+    @asynccontextmanager
+    async def slot(self, shed: bool = True) -> AsyncIterator[None]:
+        """Hold one of the upstream's concurrent calls."""
+        if shed and self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise BulkheadFullError(self.name, self.retry_after)
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        queue_time = time.perf_counter() - start
+        self._queue_times.append(queue_time)
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        self.admitted += 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def has_capacity(self) -> bool:
+        """Whether a call would get a slot without waiting."""
+        return not self._semaphore.locked()
+
+    async def run_sync(
+        self, func: Callable, *args: Any, shed: bool = True, **kwargs: Any
+    ) -> Any:
+        """Run a blocking call to the upstream in one of the bulkhead's threads."""
+        async with self.slot(shed):
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrent,
+                    thread_name_prefix=f"bulkhead-{self.name}",
+                )
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+
+    def stats(self) -> dict:
+        queue_times = sorted(self._queue_times)
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_time_ms": {
+                "p50": statistics.median(queue_times) * 1000 if queue_times else 0.0,
+                "p99": (
+                    queue_times[int(len(queue_times) * 0.99)] * 1000
+                    if queue_times
+                    else 0.0
+                ),
+                "max": self.max_queue_time * 1000,
+            },
+        }
+
+
+# Every bulkhead by name, for the stats endpoint
+BULKHEADS: dict[str, Bulkhead] = {}
@@ -0,0 +1,70 @@
+import threading
+from typing import Any, Hashable, Optional
+
+from cachetools import TLRUCache
+
+
+class StatsTTLCache:
+    """Thread-safe, bounded TTL cache that keeps hit/miss counters.
+
+    Values of ``None`` are valid entries (negative lookups) and can be given a
+    shorter lifetime with ``negative_ttl``.
+    """
+
+    _MISSING = object()
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl: float,
+        negative_ttl: Optional[float] = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._cache = TLRUCache(maxsize=maxsize, ttu=self._time_to_use)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _time_to_use(self, key: Hashable, value: Any, now: float) -> float:
+        return now + (self.negative_ttl if value is None else self.ttl)
+
+    def lookup(self, key: Hashable) -> tuple[bool, Any]:
+        """Return ``(found, value)`` so that cached ``None`` can be told apart from a miss."""
+        with self._lock:
+            value = self._cache.get(key, self._MISSING)
+            if value is self._MISSING:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._cache[key] = value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "size": len(self._cache),
+                "maxsize": self._cache.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
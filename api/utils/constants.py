@@ -59,9 +59,10 @@ FLUX_PROMPTING_SYSTEM_INSTRUCTIONS = """This GPT generates AI prompts for stagin
 The output consists strictly of a visually rich, comma-separated list of elements, formatted for compatibility with Presti AI's staging capabilities. The product to stage is the one in the image. If another product is mentioned at the beginning, remove it and replace it with the product in the image, logically positioned it in the scene."""
 
 
-OUTPAINT_SDXL_RUNPOD_API_URL = "https://api.runpod.ai/v2/6w17g20tvehm01/runsync"
-OUTPAINT_FLUX_V2_RUNPOD_API_URL = "https://api.runpod.ai/v2/d3tt1mqxwjydba/runsync"
-OUTPAINT_FLUX_V5_RUNPOD_API_URL = "https://api.runpod.ai/v2/g0nuvioyb32l8r/runsync"
+# RunPod serverless endpoints, the /runsync, /run and /status routes are built from these
+OUTPAINT_SDXL_RUNPOD_API_URL = "https://api.runpod.ai/v2/6w17g20tvehm01"
+OUTPAINT_FLUX_V2_RUNPOD_API_URL = "https://api.runpod.ai/v2/d3tt1mqxwjydba"
+OUTPAINT_FLUX_V5_RUNPOD_API_URL = "https://api.runpod.ai/v2/g0nuvioyb32l8r"
 
 OUTPAINT_MODELS_URL = {
     "presti_v1": OUTPAINT_SDXL_RUNPOD_API_URL,
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from decouple import config
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+CUTOUT_CACHE_MAX_BYTES = config(
+    "CUTOUT_CACHE_MAX_BYTES", default=256 * 1024 * 1024, cast=int
+)
+# The disk tier is disabled unless a directory is configured
+CUTOUT_CACHE_DIR = config("CUTOUT_CACHE_DIR", default="", cast=str)
+CUTOUT_CACHE_DISK_MAX_BYTES = config(
+    "CUTOUT_CACHE_DISK_MAX_BYTES", default=2 * 1024 * 1024 * 1024, cast=int
+)
+
+
+def image_nbytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+class CutoutCache:
+    """Content-addressed cache of segmented cutouts.
+
+    Cutouts are kept decoded in an in-memory LRU bounded by a byte budget, and
+    optionally written as PNG files to a local directory bounded by its own
+    budget. Cached images are shared between requests and must not be modified.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, Image.Image] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        # PNG encoding is slow for large cutouts, disk writes happen in the background
+        self._disk_writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cutout-cache"
+        )
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if self.disk_dir:
+            self._load_disk_index()
+
+    @staticmethod
+    def key_for(image_data: bytes) -> str:
+        return hashlib.sha256(image_data).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _load_disk_index(self) -> None:
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return image
+            on_disk = key in self._disk
+            if on_disk:
+                self._disk.move_to_end(key)
+
+        if on_disk:
+            try:
+                image = Image.open(self._path(key))
+                image.load()
+            except (OSError, ValueError):
+                logger.warning(f"Unreadable cutout cache file for {key}")
+                image = None
+            if image is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._set_memory(key, image)
+                return image
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, image: Image.Image) -> None:
+        image.load()
+        self._set_memory(key, image)
+        if self.disk_dir:
+            self._disk_writer.submit(self._write_disk, key, image)
+
+    def _set_memory(self, key: str, image: Image.Image) -> None:
+        size = image_nbytes(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = image
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= image_nbytes(evicted)
+                self.evictions += 1
+
+    def _write_disk(self, key: str, image: Image.Image) -> None:
+        with self._lock:
+            if key in self._disk:
+                return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, format="PNG", compress_level=1)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError:
+            logger.exception(f"Could not write cutout cache file for {key}")
+            return
+
+        evicted = []
+        with self._lock:
+            self._disk[key] = size
+            self._disk_bytes += size
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                evicted_key, evicted_size = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                self.disk_evictions += 1
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "name": "cutouts",
+                "size": len(self._memory),
+                "bytes": self._memory_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_size": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+
+cutout_cache = CutoutCache(
+    max_bytes=CUTOUT_CACHE_MAX_BYTES,
+    disk_dir=CUTOUT_CACHE_DIR,
+    disk_max_bytes=CUTOUT_CACHE_DISK_MAX_BYTES,
+)
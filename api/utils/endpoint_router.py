@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from decouple import Csv, config
+import httpx
+
+from api.utils.bulkhead import BulkheadFullError
+from api.utils.metrics import UPSTREAM_ERRORS
+from api.utils.constants import OUTPAINT_MODELS_URL
+from api.utils.retry_policy import CIRCUIT_OPEN, CircuitOpenError
+from api.utils.runpod import (
+    RunPodClient,
+    RunPodJobError,
+    endpoint_id,
+    endpoint_url,
+)
+
+logger = logging.getLogger(__name__)
+
+# More endpoints serving a model, as "model:endpoint_id" pairs, e.g.
+# "presti_v3:abc123,presti_v3:def456". The endpoint of OUTPAINT_MODELS_URL
+# always serves its model.
+RUNPOD_EXTRA_ENDPOINTS = config("RUNPOD_EXTRA_ENDPOINTS", default="", cast=Csv())
+RUNPOD_HEALTH_PROBE_INTERVAL = config(
+    "RUNPOD_HEALTH_PROBE_INTERVAL", default=10, cast=float
+)
+# Weight of the latest call in the latency average of an endpoint
+RUNPOD_LATENCY_EWMA_ALPHA = config("RUNPOD_LATENCY_EWMA_ALPHA", default=0.2, cast=float)
+
+T = TypeVar("T")
+
+
+def model_endpoints() -> dict[str, list[str]]:
+    """The endpoint URLs of every model, the endpoint of OUTPAINT_MODELS_URL first."""
+    endpoints = {model: [url] for model, url in OUTPAINT_MODELS_URL.items()}
+    for entry in RUNPOD_EXTRA_ENDPOINTS:
+        model, _, extra_id = entry.partition(":")
+        if model not in endpoints or not extra_id:
+            raise ValueError(f"Invalid RUNPOD_EXTRA_ENDPOINTS entry: {entry!r}")
+        url = endpoint_url(extra_id.strip())
+        if url not in endpoints[model]:
+            endpoints[model].append(url)
+    return endpoints
+
+
+def is_failover_error(error: BaseException) -> bool:
+    """Errors of an endpoint another endpoint of the model may not have."""
+    if isinstance(error, (BulkheadFullError, CircuitOpenError)):
+        return True
+    if isinstance(error, RunPodJobError):
+        # A failed job would most likely fail the same way elsewhere
+        return error.status == "TIMED_OUT"
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+
+class EndpointState:
+    """What the router knows of one endpoint: its latency and its last /health."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency_ewma: Optional[float] = None
+        self.jobs_in_queue = 0
+        self.workers = 0
+        self.healthy = True
+        self.probed_at = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    def record_latency(self, latency: float) -> None:
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += RUNPOD_LATENCY_EWMA_ALPHA * (
+                latency - self.latency_ewma
+            )
+
+    def record_health(self, health: dict) -> None:
+        jobs, workers = health.get("jobs", {}), health.get("workers", {})
+        self.jobs_in_queue = jobs.get("inQueue", 0)
+        self.workers = workers.get("idle", 0) + workers.get("running", 0)
+        self.healthy = True
+        self.probed_at = time.monotonic()
+
+    def expected_latency(self, default_latency: float) -> float:
+        """Latency of a call sent now: the queued jobs ahead of it are shared
+        by the endpoint's workers."""
+        latency = (
+            self.latency_ewma if self.latency_ewma is not None else default_latency
+        )
+        return latency * (1 + self.jobs_in_queue / max(self.workers, 1))
+
+    def stats(self) -> dict:
+        return {
+            "latency_ewma_ms": (
+                self.latency_ewma * 1000 if self.latency_ewma is not None else None
+            ),
+            "jobs_in_queue": self.jobs_in_queue,
+            "workers": self.workers,
+            "healthy": self.healthy,
+            "calls": self.calls,
+            "failures": self.failures,
+        }
+
+
+class EndpointRouter:
+    """Spreads the calls to a model over the RunPod endpoints that serve it.
+
+    Endpoints are ranked by the latency a call is expected to have there,
+    from the average latency of their recent calls and the queue depth of
+    their last /health probe. Endpoints whose circuit is open or whose probe
+    failed come last. A call that fails on an endpoint for a reason of the
+    endpoint's own (saturation, 5xx, timeout) fails over to the next one.
+    Models served by a single endpoint are not probed.
+    """
+
+    def __init__(self, runpod: RunPodClient, endpoints: dict[str, list[str]]):
+        self.runpod = runpod
+        self.endpoints = endpoints
+        self.states = {
+            url: EndpointState(url) for urls in endpoints.values() for url in urls
+        }
+        self.failovers = 0
+        self._probes: dict[str, asyncio.Task] = {}
+        for model, urls in endpoints.items():
+            for url in urls:
+                runpod.get_retry_policy(url).metric_labels["model"] = model
+
+    async def _probe(self, model: str) -> None:
+        async def probe(url: str) -> None:
+            try:
+                self.states[url].record_health(await self.runpod.get_health(url))
+            except httpx.HTTPError as e:
+                logger.warning(f"RunPod /health of {endpoint_id(url)} failed: {e!r}")
+                self.states[url].healthy = False
+                self.states[url].probed_at = time.monotonic()
+
+        await asyncio.gather(*(probe(url) for url in self.endpoints[model]))
+
+    def _refresh(self, model: str) -> None:
+        # Probes run in the background, calls are routed on the last known state
+        urls = self.endpoints[model]
+        if len(urls) < 2 or model in self._probes:
+            return
+        probed_at = min(self.states[url].probed_at for url in urls)
+        if time.monotonic() - probed_at < RUNPOD_HEALTH_PROBE_INTERVAL:
+            return
+        task = asyncio.create_task(self._probe(model))
+        self._probes[model] = task
+        task.add_done_callback(lambda _: self._probes.pop(model, None))
+
+    def rank(self, model: str) -> list[str]:
+        """The endpoints of a model, from the one expected to answer first."""
+        self._refresh(model)
+        states = [self.states[url] for url in self.endpoints[model]]
+        known = [s.latency_ewma for s in states if s.latency_ewma is not None]
+        # An endpoint without calls yet is expected to be as fast as the fastest
+        default_latency = min(known) if known else 1.0
+
+        def key(state: EndpointState) -> tuple:
+            breaker = self.runpod.get_retry_policy(state.url).breaker
+            available = state.healthy and breaker.state != CIRCUIT_OPEN
+            return (not available, state.expected_latency(default_latency))
+
+        return [state.url for state in sorted(states, key=key)]
+
+    def observe_latency(self, url: str, latency: float) -> None:
+        """Account for a call made outside the router, e.g. a polled job."""
+        if url in self.states:
+            self.states[url].record_latency(latency)
+
+    async def call(
+        self,
+        model: str,
+        func: Callable[[str], Awaitable[T]],
+        measure_latency: bool = True,
+    ) -> tuple[T, str]:
+        """Call ``func`` with the best endpoint URL of the model, failing over
+        to the next ones. Returns the result and the endpoint that gave it.
+
+        Calls that do not wait for the inference, like job submissions, pass
+        ``measure_latency=False``."""
+        urls = self.rank(model)
+        for index, url in enumerate(urls):
+            state = self.states[url]
+            state.calls += 1
+            start = time.monotonic()
+            try:
+                result = await func(url)
+            except Exception as e:
+                state.failures += 1
+                if isinstance(e, RunPodJobError):
+                    # HTTP errors are counted by the endpoint's retry policy
+                    UPSTREAM_ERRORS.labels(
+                        "runpod", model, endpoint_id(url), f"job_{e.status.lower()}"
+                    ).inc()
+                if index == len(urls) - 1 or not is_failover_error(e):
+                    raise
+                self.failovers += 1
+                logger.warning(
+                    f"Failing over {model} from {endpoint_id(url)} to "
+                    f"{endpoint_id(urls[index + 1])}: {e!r}"
+                )
+            else:
+                if measure_latency:
+                    state.record_latency(time.monotonic() - start)
+                return result, url
+
+    async def aclose(self) -> None:
+        for task in list(self._probes.values()):
+            task.cancel()
+        await asyncio.gather(*self._probes.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "models": {
+                model: {endpoint_id(url): self.states[url].stats() for url in urls}
+                for model, urls in self.endpoints.items()
+            },
+        }
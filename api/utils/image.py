@@ -1,14 +1,86 @@
 import base64
+from dataclasses import dataclass
 from io import BytesIO
+from typing import Literal, Optional
 from PIL import Image
 
+OUTPUT_FORMATS = Literal["png", "webp", "jpeg"]
 
-def image_to_base64_string(image: Image.Image) -> str:
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    base64_bytes = base64.b64encode(buffered.getvalue())
-    base64_string = base64_bytes.decode()
-    return f"data:image/png;base64,{base64_string}"
+# Pillow's own default for PNG
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+DEFAULT_JPEG_QUALITY = 90
+
+
+@dataclass(frozen=True)
+class OutputEncoding:
+    """How a resulting image is encoded, for the response and the stored object.
+
+    WebP is lossless unless a quality is given. JPEG has no alpha channel,
+    images are converted to RGB.
+    """
+
+    format: OUTPUT_FORMATS = "png"
+    quality: Optional[int] = None
+    compress_level: Optional[int] = None
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.format}"
+
+    @property
+    def extension(self) -> str:
+        return "jpg" if self.format == "jpeg" else self.format
+
+    def encode(self, image: Image.Image) -> bytes:
+        buffered = BytesIO()
+        if self.format == "png":
+            image.save(
+                buffered,
+                format="PNG",
+                compress_level=(
+                    DEFAULT_PNG_COMPRESS_LEVEL
+                    if self.compress_level is None
+                    else self.compress_level
+                ),
+            )
+        elif self.format == "webp":
+            if self.quality is None:
+                image.save(buffered, format="WEBP", lossless=True)
+            else:
+                image.save(buffered, format="WEBP", quality=self.quality)
+        elif self.format == "jpeg":
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image.save(
+                buffered,
+                format="JPEG",
+                quality=DEFAULT_JPEG_QUALITY if self.quality is None else self.quality,
+            )
+        else:
+            raise ValueError(f"Unsupported output format: {self.format}")
+        return buffered.getvalue()
+
+
+PNG_ENCODING = OutputEncoding()
+
+
+def image_to_bytes(
+    image: Image.Image, encoding: OutputEncoding = PNG_ENCODING
+) -> bytes:
+    return encoding.encode(image)
+
+
+def image_bytes_to_base64_string(
+    image_bytes: bytes, media_type: str = "image/png"
+) -> str:
+    base64_string = base64.b64encode(image_bytes).decode()
+    return f"data:{media_type};base64,{base64_string}"
+
+
+def image_to_base64_string(
+    image: Image.Image, encoding: OutputEncoding = PNG_ENCODING
+) -> str:
+    return image_bytes_to_base64_string(encoding.encode(image), encoding.media_type)
 
 
 def base64_string_to_image(bytes64_string: str) -> Image.Image:
@@ -0,0 +1,216 @@
+from typing import Optional
+
+import numpy as np
+from PIL import Image, ImageMode
+
+# Pillow only hands its pixels out by copy. NumPy is used where the work is on a
+# single band copied out once, handed back without another copy by
+# Image.fromarray. Bounding boxes and blends stay in Pillow's C loops, which read
+# the pixels in place (benchmarks/image_kernels.py).
+
+BBox = tuple[int, int, int, int]
+
+# Alpha at or above this is opaque in a binarized mask
+ALPHA_THRESHOLD = 128
+
+
+def has_alpha(mode: str) -> bool:
+    """Whether images of this mode have an alpha band, without touching any pixel."""
+    return "A" in ImageMode.getmode(mode).bands
+
+
+def alpha_array(image: Image.Image) -> np.ndarray:
+    """The alpha band as a read-only ``(height, width)`` uint8 array.
+
+    Only the alpha band is copied out of the image, not every band as
+    ``Image.split`` does.
+    """
+    return np.asarray(image.getchannel("A"))
+
+
+def threshold_alpha(alpha: np.ndarray, threshold: int = ALPHA_THRESHOLD) -> np.ndarray:
+    """Binarize an alpha band: 255 at or above ``threshold``, 0 below."""
+    mask = np.greater_equal(alpha, threshold).view(np.uint8)
+    # The comparison made a new array, it is scaled in place
+    return np.multiply(mask, 255, out=mask)
+
+
+def threshold_alpha_mask(
+    image: Image.Image, threshold: int = ALPHA_THRESHOLD
+) -> Image.Image:
+    """Binarized alpha band of an image, as an "L" mask sharing the array's memory."""
+    return Image.fromarray(threshold_alpha(alpha_array(image), threshold))
+
+
+def alpha_bbox(image: Image.Image) -> Optional[BBox]:
+    """Bounding box ``(left, top, right, bottom)`` of the non-transparent pixels.
+
+    Returns None for a fully transparent image. Images without an alpha band
+    are opaque, their box is the whole image.
+    """
+    if not has_alpha(image.mode):
+        return (0, 0, *image.size)
+    # With an alpha band, Pillow scans only that band, in place
+    return image.getbbox(alpha_only=True)
+
+
+def composite_over(background: Image.Image, foreground: Image.Image) -> Image.Image:
+    """Composite a foreground with an alpha band over a background of the same size.
+
+    Only the alpha bounding box of the foreground is blended, the rest of the
+    background is left as is. Colors are weighted by their alpha as they are
+    blended, like a premultiplied "over". Returns the background, modified in
+    place, as an RGB image.
+    """
+    if background.mode != "RGB":
+        background = background.convert("RGB")
+    bbox = alpha_bbox(foreground)
+    if bbox is None:
+        return background
+    region = foreground.crop(bbox)
+    background.paste(region, bbox[:2], mask=region)
+    return background
+
+
+# Side of the full resolution tiles refined at a time, bounding the memory used
+GUIDED_UPSAMPLE_TILE_SIZE = 256
+
+
+def _box_sum(values: np.ndarray, radius: int, axis: int) -> np.ndarray:
+    # Sum over a window of 2 * radius + 1 along one axis, zero padded. Radii are
+    # small, adding shifted copies is faster than a cumulative sum and exact.
+    padding = [(0, 0)] * values.ndim
+    padding[axis] = (radius, radius)
+    padded = np.pad(values, padding)
+    length = values.shape[axis]
+    window = [slice(None)] * values.ndim
+    window[axis] = slice(0, length)
+    total = padded[tuple(window)].copy()
+    for shift in range(1, 2 * radius + 1):
+        window[axis] = slice(shift, shift + length)
+        total += padded[tuple(window)]
+    return total
+
+
+def _box_mean(values: np.ndarray, radius: int) -> np.ndarray:
+    """Mean over the ``(2 * radius + 1)`` square window of each pixel, clipped at the borders."""
+    height, width = values.shape
+    sums = _box_sum(_box_sum(values, radius, 0), radius, 1)
+    counts = np.outer(
+        _box_sum(np.ones(height, dtype=np.float32), radius, 0),
+        _box_sum(np.ones(width, dtype=np.float32), radius, 0),
+    )
+    return sums / counts
+
+
+def _symmetric_inverse(matrix: dict[tuple[int, int], np.ndarray]) -> dict:
+    # Per pixel inverse of a symmetric 3x3 matrix, from its cofactors
+    a, b, c = matrix[0, 0], matrix[0, 1], matrix[0, 2]
+    d, e, f = matrix[1, 1], matrix[1, 2], matrix[2, 2]
+    cofactors = {
+        (0, 0): d * f - e * e,
+        (0, 1): c * e - b * f,
+        (0, 2): b * e - c * d,
+        (1, 1): a * f - c * c,
+        (1, 2): b * c - a * e,
+        (2, 2): a * d - b * b,
+    }
+    determinant = a * cofactors[0, 0] + b * cofactors[0, 1] + c * cofactors[0, 2]
+    inverse = {key: value / determinant for key, value in cofactors.items()}
+    for i, j in list(inverse):
+        inverse[j, i] = inverse[i, j]
+    return inverse
+
+
+def _upsample_tile(
+    coefficients: Image.Image, size: tuple[int, int], tile: BBox
+) -> np.ndarray:
+    """Region ``tile`` of ``coefficients`` bilinearly resized to ``size``."""
+    scale_x, scale_y = coefficients.width / size[0], coefficients.height / size[1]
+    left, top, right, bottom = tile
+    return np.asarray(
+        coefficients.resize(
+            (right - left, bottom - top),
+            Image.Resampling.BILINEAR,
+            box=(left * scale_x, top * scale_y, right * scale_x, bottom * scale_y),
+        )
+    )
+
+
+def guided_upsample_alpha(
+    alpha: Image.Image,
+    guide: Image.Image,
+    radius: int = 1,
+    eps: float = 1e-4,
+) -> Image.Image:
+    """Upsample a low resolution alpha band to the size of ``guide``, following its edges.
+
+    Fast guided filter, with the guide's colors: the linear coefficients
+    relating the guide's RGB values to the alpha are fitted at the alpha's
+    resolution, over windows of ``radius``, then upsampled and applied to the
+    full resolution pixels. Mask edges snap to the color edges of the full
+    resolution image, rather than being blurred by the upsampling. ``eps``
+    sets how flat a window must be for the alpha to be smoothed rather than
+    follow the guide.
+    """
+    if guide.mode != "RGB":
+        guide = guide.convert("RGB")
+    low_guide = np.asarray(guide.resize(alpha.size, Image.Resampling.BOX))
+    low_guide = low_guide.astype(np.float32) / 255
+    low_alpha = np.asarray(alpha, dtype=np.float32) / 255
+
+    channels = range(3)
+    guide_channels = [low_guide[..., c] for c in channels]
+    mean_guide = [_box_mean(channel, radius) for channel in guide_channels]
+    mean_alpha = _box_mean(low_alpha, radius)
+    covariance = [
+        _box_mean(guide_channels[c] * low_alpha, radius) - mean_guide[c] * mean_alpha
+        for c in channels
+    ]
+    variance = {}
+    for i in channels:
+        for j in range(i, 3):
+            variance[i, j] = (
+                _box_mean(guide_channels[i] * guide_channels[j], radius)
+                - mean_guide[i] * mean_guide[j]
+            )
+        variance[i, i] += eps
+    inverse = _symmetric_inverse(variance)
+    scale = [sum(inverse[i, j] * covariance[j] for j in channels) for i in channels]
+    offset = mean_alpha - sum(scale[c] * mean_guide[c] for c in channels)
+    coefficients = [
+        Image.fromarray(_box_mean(values, radius)) for values in scale + [offset]
+    ]
+
+    # Where the alpha is flat over both windows, the filter gives back that
+    # alpha: a plain upsampling is exact there, only the tiles along the mask's
+    # edges are refined
+    size = guide.size
+    refined = np.array(alpha.resize(size, Image.Resampling.BILINEAR))
+    near_edge = _box_mean(low_alpha, 2 * radius + 1)
+    near_edge = (near_edge > 1e-6) & (near_edge < 1 - 1e-6)
+    scale_x, scale_y = alpha.width / size[0], alpha.height / size[1]
+    for top in range(0, size[1], GUIDED_UPSAMPLE_TILE_SIZE):
+        bottom = min(top + GUIDED_UPSAMPLE_TILE_SIZE, size[1])
+        for left in range(0, size[0], GUIDED_UPSAMPLE_TILE_SIZE):
+            right = min(left + GUIDED_UPSAMPLE_TILE_SIZE, size[0])
+            # The tile's area in the low resolution alpha, with the pixels
+            # bilinear interpolation reads around it
+            low_rows = slice(max(int(top * scale_y) - 1, 0), int(bottom * scale_y) + 2)
+            low_columns = slice(
+                max(int(left * scale_x) - 1, 0), int(right * scale_x) + 2
+            )
+            if not near_edge[low_rows, low_columns].any():
+                continue
+            tile = (left, top, right, bottom)
+            pixels = np.asarray(guide.crop(tile))
+            values = _upsample_tile(coefficients[3], size, tile).copy()
+            for c in channels:
+                channel_scale = _upsample_tile(coefficients[c], size, tile) / 255
+                channel_scale *= pixels[..., c]
+                values += channel_scale
+            np.clip(values, 0, 1, out=values)
+            values *= 255
+            values += 0.5
+            refined[top:bottom, left:right] = values
+    return Image.fromarray(refined)
@@ -0,0 +1,176 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any, AsyncIterator, Callable, Optional, Union
+
+from decouple import config
+from PIL import Image
+
+# 0 runs the transforms in a thread of the calling process instead
+IMAGE_PROCESS_POOL_SIZE = config(
+    "IMAGE_PROCESS_POOL_SIZE", default=os.cpu_count() or 1, cast=int
+)
+
+
+@dataclass(frozen=True)
+class SharedImage:
+    """Pixels of an image stored in a shared memory block.
+
+    Only this descriptor is pickled when the image is sent to or returned from
+    a worker process, the pixels are copied in and out of the block.
+    """
+
+    name: str
+    mode: str
+    size: tuple[int, int]
+    palette: Optional[bytes] = None
+
+    @classmethod
+    def create(
+        cls, image: Image.Image
+    ) -> tuple["SharedImage", shared_memory.SharedMemory]:
+        """Copy the image to a new block, the caller owns (and must unlink) the block."""
+        data = image.tobytes()
+        block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        block.buf[: len(data)] = data
+        palette = bytes(image.getpalette() or ()) if image.mode == "P" else None
+        return cls(block.name, image.mode, image.size, palette), block
+
+    def open(self) -> Image.Image:
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            image = Image.frombytes(self.mode, self.size, block.buf)
+        finally:
+            block.close()
+        if self.palette is not None:
+            image.putpalette(self.palette)
+        return image
+
+
+def release_block(block: shared_memory.SharedMemory) -> None:
+    block.close()
+    block.unlink()
+
+
+def _release_result(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        result = future.result()
+        if isinstance(result, SharedImage):
+            release_block(shared_memory.SharedMemory(name=result.name))
+
+
+def _warm_worker() -> int:
+    return os.getpid()
+
+
+def _run_in_worker(func: Callable, args: list, kwargs: dict) -> Any:
+    args = [arg.open() if isinstance(arg, SharedImage) else arg for arg in args]
+    result = func(*args, **kwargs)
+    if isinstance(result, Image.Image):
+        # The parent unlinks the block once it has read the image back
+        shared_result, block = SharedImage.create(result)
+        block.close()
+        return shared_result
+    return result
+
+
+class ImageProcessPool:
+    """Process pool for the CPU-bound image transforms of the async handlers.
+
+    PIL releases the GIL for little of what the handlers do (band splits,
+    pastes, ``point`` lookups, crops), so running them in threads still stalls
+    the event loop. Transforms run in worker processes instead, with images
+    passed through shared memory rather than pickled.
+
+    Transforms must be module-level functions. ``PIL.Image`` arguments and
+    results are moved through shared memory, other arguments and results are
+    pickled as usual.
+    """
+
+    def __init__(self, max_workers: int = IMAGE_PROCESS_POOL_SIZE):
+        self.max_workers = max_workers
+        # Workers are spawned rather than forked from a process running an
+        # event loop and client threads
+        self._executor = (
+            ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            if max_workers > 0
+            else None
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self._executor is not None
+
+    @asynccontextmanager
+    async def share(
+        self, image: Image.Image
+    ) -> AsyncIterator[Union[SharedImage, Image.Image]]:
+        """Copy an image to shared memory once, for several ``run`` calls.
+
+        Yields the image itself when the pool is disabled.
+        """
+        if not self.enabled:
+            yield image
+            return
+        # Reading the pixels decodes a lazily opened image, which PIL does
+        # without holding the GIL
+        shared_image, block = await asyncio.to_thread(SharedImage.create, image)
+        try:
+            yield shared_image
+        finally:
+            release_block(block)
+
+    async def run(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Run ``func(*args, **kwargs)`` in a worker process."""
+        if not self.enabled:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+        async with AsyncExitStack() as stack:
+            # Images that were not shared beforehand are shared for this call only
+            args = [
+                (
+                    await stack.enter_async_context(self.share(arg))
+                    if isinstance(arg, Image.Image)
+                    else arg
+                )
+                for arg in args
+            ]
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor, _run_in_worker, func, args, kwargs
+            )
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The worker keeps going, its result must still be released
+                future.add_done_callback(_release_result)
+                raise
+
+        if isinstance(result, SharedImage):
+            try:
+                return await asyncio.to_thread(result.open)
+            finally:
+                release_block(shared_memory.SharedMemory(name=result.name))
+        return result
+
+    async def warm(self) -> None:
+        """Start the worker processes now rather than on the first requests."""
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, _warm_worker)
+                for _ in range(self.max_workers)
+            )
+        )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,90 @@
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Iterator, Optional, TypeVar
+from wsgiref.simple_server import WSGIServer
+
+from decouple import config
+import httpx
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+T = TypeVar("T")
+
+# The metrics name the upstream endpoints, they are served on a port of their
+# own that is not routed from the internet (Cloud Run only routes the app's
+# port) rather than by the app. 0 disables them.
+METRICS_PORT = config("METRICS_PORT", default=9090, cast=int)
+METRICS_ADDR = config("METRICS_ADDR", default="0.0.0.0", cast=str)
+
+STAGE_SECONDS = Histogram(
+    "presti_stage_duration_seconds",
+    "Duration of each stage of the image pipelines.",
+    ["route", "stage"],
+    # From an image header read to a cold RunPod worker
+    buckets=(
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        20,
+        40,
+        80,
+        160,
+    ),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "presti_requests_in_flight", "Requests being processed.", ["route"]
+)
+UPSTREAM_ERRORS = Counter(
+    "presti_upstream_errors_total",
+    "Failed calls to upstream services, retries included.",
+    ["upstream", "model", "endpoint", "error"],
+)
+PAYLOAD_BYTES = Histogram(
+    "presti_payload_bytes",
+    "Size of the images received and sent.",
+    ["route", "direction"],
+    # 16 KB to 64 MB
+    buckets=tuple(2**exponent for exponent in range(14, 27)),
+)
+
+
+@contextmanager
+def stage(route: str, name: str) -> Iterator[None]:
+    """Time a stage of a pipeline, whether it succeeds or not."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(route, name).observe(time.perf_counter() - start)
+
+
+async def timed(route: str, name: str, awaitable: Awaitable[T]) -> T:
+    """Time a stage that runs concurrently with others, e.g. under asyncio.gather."""
+    with stage(route, name):
+        return await awaitable
+
+
+def error_label(error: BaseException) -> str:
+    # Status codes rather than messages, to bound the number of series
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"http_{error.response.status_code}"
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return f"http_{status_code}"
+    return type(error).__name__
+
+
+def start_metrics_server() -> Optional[WSGIServer]:
+    """Serve the metrics to Prometheus from a thread, until the returned
+    server is shut down."""
+    if not METRICS_PORT:
+        return None
+    server, _ = start_http_server(METRICS_PORT, METRICS_ADDR)
+    return server
@@ -0,0 +1,40 @@
+from decouple import config
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+
+from api.utils.bulkhead import Bulkhead
+from api.utils.retry_policy import CircuitBreaker, RetryPolicy
+from api.utils.webhooks import is_retryable_status
+
+OPENAI_MAX_CONCURRENCY = config("OPENAI_MAX_CONCURRENCY", default=32, cast=int)
+OPENAI_MAX_QUEUE = config("OPENAI_MAX_QUEUE", default=200, cast=int)
+OPENAI_RETRY_AFTER = config("OPENAI_RETRY_AFTER", default=5, cast=int)
+OPENAI_RETRY_DEADLINE = config("OPENAI_RETRY_DEADLINE", default=20, cast=float)
+
+openai_bulkhead = Bulkhead(
+    "openai", OPENAI_MAX_CONCURRENCY, OPENAI_MAX_QUEUE, OPENAI_RETRY_AFTER
+)
+
+
+def is_retryable_openai_error(error: BaseException) -> bool:
+    # APIConnectionError covers the timeouts
+    if isinstance(error, APIStatusError):
+        return is_retryable_status(error.status_code)
+    return isinstance(error, APIConnectionError)
+
+
+def is_openai_error_response(error: BaseException) -> bool:
+    return isinstance(error, APIStatusError)
+
+
+openai_retry = RetryPolicy(
+    "openai",
+    is_retryable=is_retryable_openai_error,
+    is_error_response=is_openai_error_response,
+    deadline=OPENAI_RETRY_DEADLINE,
+    breaker=CircuitBreaker("openai"),
+)
+
+
+def create_openai_client(api_key: str) -> AsyncOpenAI:
+    # Calls are retried by openai_retry, not by the SDK
+    return AsyncOpenAI(api_key=api_key, max_retries=0)
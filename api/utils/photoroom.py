@@ -0,0 +1,82 @@
+import importlib.util
+import threading
+
+from decouple import config
+import httpx
+
+from api.utils.bulkhead import Bulkhead
+from api.utils.retry_policy import CircuitBreaker, RetryPolicy
+
+PHOTOROOM_API_URL = "https://sdk.photoroom.com"
+PHOTOROOM_CONNECT_TIMEOUT = config("PHOTOROOM_CONNECT_TIMEOUT", default=5, cast=float)
+PHOTOROOM_READ_TIMEOUT = config("PHOTOROOM_READ_TIMEOUT", default=60, cast=float)
+PHOTOROOM_MAX_CONNECTIONS = config("PHOTOROOM_MAX_CONNECTIONS", default=20, cast=int)
+PHOTOROOM_KEEPALIVE_EXPIRY = config(
+    "PHOTOROOM_KEEPALIVE_EXPIRY", default=60, cast=float
+)
+PHOTOROOM_MAX_CONCURRENCY = config(
+    "PHOTOROOM_MAX_CONCURRENCY", default=PHOTOROOM_MAX_CONNECTIONS, cast=int
+)
+PHOTOROOM_MAX_QUEUE = config("PHOTOROOM_MAX_QUEUE", default=100, cast=int)
+PHOTOROOM_RETRY_AFTER = config("PHOTOROOM_RETRY_AFTER", default=5, cast=int)
+PHOTOROOM_RETRY_DEADLINE = config("PHOTOROOM_RETRY_DEADLINE", default=30, cast=float)
+
+
+class ConnectionStats:
+    """Counts requests and newly opened connections to tell how often keep-alive connections are reused."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    async def trace(self, event_name: str, info: dict) -> None:
+        # httpcore trace hook, called for each step of a request
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+        elif event_name.endswith(".send_request_headers.started"):
+            with self._lock:
+                self.requests += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+
+photoroom_connection_stats = ConnectionStats()
+photoroom_bulkhead = Bulkhead(
+    "photoroom", PHOTOROOM_MAX_CONCURRENCY, PHOTOROOM_MAX_QUEUE, PHOTOROOM_RETRY_AFTER
+)
+photoroom_retry = RetryPolicy(
+    "photoroom",
+    deadline=PHOTOROOM_RETRY_DEADLINE,
+    breaker=CircuitBreaker("photoroom"),
+)
+
+
+def create_photoroom_client(api_key: str) -> httpx.AsyncClient:
+    """Keep-alive client for the segmentation API, shared by all requests."""
+    return httpx.AsyncClient(
+        base_url=PHOTOROOM_API_URL,
+        # HTTP/2 needs the optional h2 package
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=PHOTOROOM_MAX_CONNECTIONS,
+            max_keepalive_connections=PHOTOROOM_MAX_CONNECTIONS,
+            keepalive_expiry=PHOTOROOM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=PHOTOROOM_CONNECT_TIMEOUT,
+            read=PHOTOROOM_READ_TIMEOUT,
+            write=PHOTOROOM_READ_TIMEOUT,
+            pool=PHOTOROOM_READ_TIMEOUT,
+        ),
+        headers={"x-api-key": api_key},
+    )
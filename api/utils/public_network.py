@@ -0,0 +1,198 @@
+import asyncio
+import ipaddress
+import socket
+from contextlib import contextmanager
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+import httpcore
+import httpx
+
+PUBLIC_URL_SCHEMES = ("http", "https")
+
+
+class NonPublicURLError(ValueError):
+    """A URL given by a client that does not point to the public internet."""
+
+
+class HostResolutionError(NonPublicURLError):
+    """The host of a URL could not be resolved, which may be temporary."""
+
+
+def is_public_address(address: str) -> bool:
+    """False for loopback, private, link-local (cloud metadata), shared,
+    reserved and multicast addresses."""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_url_syntax(url: str) -> tuple[str, int]:
+    """Check what can be checked without a DNS lookup: the scheme, and the
+    host if it is an IP address. Returns the host and port to resolve."""
+    parts = urlsplit(url)
+    if parts.scheme not in PUBLIC_URL_SCHEMES or not parts.hostname:
+        raise NonPublicURLError("Only http and https URLs are allowed.")
+    try:
+        is_public = is_public_address(parts.hostname)
+    except ValueError:
+        # A host name, checked once resolved
+        is_public = True
+    if not is_public:
+        raise NonPublicURLError("The URL does not point to a public address.")
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+async def resolve_public_host(
+    host: str, port: int, timeout: Optional[float] = None
+) -> list[str]:
+    """The addresses of a host, if they are all public."""
+    try:
+        infos = await asyncio.wait_for(
+            asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM),
+            timeout,
+        )
+    except (OSError, asyncio.TimeoutError):
+        raise HostResolutionError(f"Could not resolve {host}.")
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    # A single private answer is enough to be routed to it
+    if not addresses or not all(is_public_address(a) for a in addresses):
+        raise NonPublicURLError("The URL does not point to a public address.")
+    return addresses
+
+
+async def check_public_url(url: str) -> None:
+    """Raise ``NonPublicURLError`` unless the URL is http(s) and its host only
+    resolves to public addresses."""
+    await resolve_public_host(*check_url_syntax(url))
+
+
+class PublicNetworkBackend(httpcore.AsyncNetworkBackend):
+    """Opens connections to public addresses only.
+
+    The host is resolved and checked when the connection is opened, and the
+    connection is made to the checked address: a DNS answer that changed
+    since the URL was validated (DNS rebinding) cannot redirect it.
+    """
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: Optional[float] = None,
+        local_address: Optional[str] = None,
+        socket_options: Optional[Iterable[httpcore.SOCKET_OPTION]] = None,
+    ) -> httpcore.AsyncNetworkStream:
+        try:
+            addresses = await resolve_public_host(host, port, timeout)
+        except NonPublicURLError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        for index, address in enumerate(addresses):
+            try:
+                return await self._backend.connect_tcp(
+                    address, port, timeout, local_address, socket_options
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout):
+                if index == len(addresses) - 1:
+                    raise
+
+    async def connect_unix_socket(
+        self,
+        path: str,
+        timeout: Optional[float] = None,
+        socket_options: Optional[Iterable[httpcore.SOCKET_OPTION]] = None,
+    ) -> httpcore.AsyncNetworkStream:
+        raise httpcore.ConnectError("Unix sockets are not allowed.")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+# httpcore errors and the httpx errors of the same name raised to the clients
+HTTPCORE_ERRORS = tuple(
+    (getattr(httpcore, name), getattr(httpx, name))
+    for name in (
+        "ConnectTimeout",
+        "ReadTimeout",
+        "WriteTimeout",
+        "PoolTimeout",
+        "ConnectError",
+        "ReadError",
+        "WriteError",
+        "RemoteProtocolError",
+        "LocalProtocolError",
+        "ProxyError",
+        "UnsupportedProtocol",
+    )
+)
+
+
+@contextmanager
+def map_httpcore_errors() -> Iterator[None]:
+    try:
+        yield
+    except Exception as e:
+        for httpcore_error, httpx_error in HTTPCORE_ERRORS:
+            if isinstance(e, httpcore_error):
+                raise httpx_error(str(e)) from e
+        raise
+
+
+class PublicResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream: AsyncIterable[bytes]):
+        self._stream = stream
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        with map_httpcore_errors():
+            async for chunk in self._stream:
+                yield chunk
+
+    async def aclose(self) -> None:
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+
+
+class PublicTransport(httpx.AsyncBaseTransport):
+    """Transport of the clients that call URLs given by API clients.
+
+    httpx does not take a network backend, so the transport drives a
+    connection pool of its own that connects through ``PublicNetworkBackend``.
+    """
+
+    def __init__(self, limits: httpx.Limits):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=PublicNetworkBackend(),
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with map_httpcore_errors():
+            response = await self._pool.handle_async_request(core_request)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=PublicResponseStream(response.stream),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
@@ -0,0 +1,51 @@
+from typing import Literal
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from api.utils.image import OutputEncoding
+
+ResponseFormat = Literal["base64", "binary", "url"]
+
+RESPONSE_FORMAT_DESCRIPTION = "How the resulting image is returned: 'base64' as a data URL in a JSON body, 'binary' as the raw image bytes, or 'url' as the URL of the stored image in a JSON body. Defaults to 'binary' when the Accept header asks for an image, 'base64' otherwise."
+
+OUTPUT_FORMAT_DESCRIPTION = (
+    "Encoding of the resulting image, used for the response and the stored image."
+)
+QUALITY_DESCRIPTION = "Quality (0-100) of lossy encodings. For 'webp', omitting it gives a lossless image. For 'jpeg', it defaults to 90. Ignored for 'png'."
+COMPRESS_LEVEL_DESCRIPTION = "zlib compression level (0-9) of 'png' outputs. Lower levels encode faster but produce larger files. Defaults to 6."
+
+# Accept header values that ask for the raw image
+BINARY_MEDIA_TYPES = ("image/*", "image/png", "image/webp", "image/jpeg")
+
+
+def resolve_response_format(http_request: Request, options: BaseModel) -> str:
+    """Pick the response format, an explicit response_format wins over the Accept header."""
+    if "response_format" in options.model_fields_set:
+        return options.response_format
+    # Only the first (preferred) media type is considered, quality values are ignored
+    accept = http_request.headers.get("accept", "")
+    preferred = accept.split(",")[0].split(";")[0].strip()
+    if preferred in BINARY_MEDIA_TYPES:
+        return "binary"
+    return options.response_format
+
+
+def output_encoding(options: BaseModel) -> OutputEncoding:
+    return OutputEncoding(
+        format=options.output_format,
+        quality=options.quality,
+        compress_level=options.compress_level,
+    )
+
+
+def binary_image_response(
+    image_bytes: bytes, media_type: str = "image/png"
+) -> Response:
+    # The image is already encoded in memory, it is sent as is with its length
+    return Response(content=image_bytes, media_type=media_type)
+
+
+def url_response(url: str) -> JSONResponse:
+    return JSONResponse(content={"url": url})
@@ -0,0 +1,246 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from decouple import config
+from fastapi import HTTPException
+import httpx
+
+from api.utils.bulkhead import BulkheadFullError
+from api.utils.metrics import UPSTREAM_ERRORS, error_label
+from api.utils.webhooks import is_retryable_status
+
+logger = logging.getLogger(__name__)
+
+# Consecutive upstream failures that open a circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = config("CIRCUIT_FAILURE_THRESHOLD", default=5, cast=int)
+CIRCUIT_RESET_TIMEOUT = config("CIRCUIT_RESET_TIMEOUT", default=30, cast=float)
+RETRY_MAX_ATTEMPTS = config("RETRY_MAX_ATTEMPTS", default=3, cast=int)
+RETRY_BASE_DELAY = config("RETRY_BASE_DELAY", default=0.5, cast=float)
+RETRY_MAX_DELAY = config("RETRY_MAX_DELAY", default=8, cast=float)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(HTTPException):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail=f"The {name} service is unavailable, please retry later.",
+            headers={"Retry-After": str(max(int(retry_after + 0.999), 1))},
+        )
+        self.name = name
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail at once for ``reset_timeout`` seconds. The circuit is then
+    half-open: a single call goes through as a probe, and closes the circuit
+    if it succeeds or opens it again if it fails.
+
+    Only upstream faults (the errors a retry policy deems retryable) count as
+    failures. A 4xx response means the upstream is up.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+        self.rejected = 0
+        CIRCUIT_BREAKERS[name] = self
+
+    def before_call(self) -> None:
+        """Raise ``CircuitOpenError`` if the upstream must not be called now."""
+        if self.state == CIRCUIT_OPEN:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = CIRCUIT_HALF_OPEN
+            logger.info(f"Circuit {self.name} half-open")
+        if self.state == CIRCUIT_HALF_OPEN:
+            # Other calls wait for the probe's outcome
+            if self.probing:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self.probing = True
+
+    def record_success(self) -> None:
+        self.probing = False
+        self.consecutive_failures = 0
+        if self.state != CIRCUIT_CLOSED:
+            self.state = CIRCUIT_CLOSED
+            logger.info(f"Circuit {self.name} closed")
+
+    def record_failure(self) -> None:
+        self.probing = False
+        self.consecutive_failures += 1
+        if (
+            self.state == CIRCUIT_HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != CIRCUIT_OPEN:
+                self.times_opened += 1
+                logger.warning(
+                    f"Circuit {self.name} open after {self.consecutive_failures} failures"
+                )
+            self.state = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """End a call that never reached the upstream, without an outcome."""
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+def is_retryable_http_error(error: BaseException) -> bool:
+    """Transport errors, timeouts, 408, 429 and 5xx, as raised by httpx or
+    re-raised as an ``HTTPException``."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return is_retryable_status(error.response.status_code)
+    if isinstance(error, (BulkheadFullError, CircuitOpenError)):
+        return False
+    if isinstance(error, HTTPException):
+        return is_retryable_status(error.status_code)
+    return isinstance(error, httpx.TransportError)
+
+
+def is_http_error_response(error: BaseException) -> bool:
+    """Error responses of the upstream, as raised by httpx or re-raised as an
+    ``HTTPException``: the upstream answered, so it is up."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return True
+    if isinstance(error, (BulkheadFullError, CircuitOpenError)):
+        return False
+    return isinstance(error, HTTPException)
+
+
+class RetryPolicy:
+    """Retries the retryable errors of calls to one upstream.
+
+    Retries wait a random delay between 0 and an exponentially growing cap
+    (full jitter), so that the callers of a recovering upstream do not retry
+    in step. No retry is made past ``deadline`` seconds after the first
+    attempt, the attempts themselves are bounded by the clients' timeouts.
+    Every attempt goes through the upstream's circuit breaker, if any.
+
+    Errors that are neither retryable nor an answer of the upstream (a bad
+    argument, a bug in the caller) are raised as they are: they say nothing
+    of the upstream, so they are not counted as its errors.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        is_retryable: Callable[[BaseException], bool] = is_retryable_http_error,
+        is_error_response: Callable[[BaseException], bool] = is_http_error_response,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+        deadline: float = 30.0,
+        breaker: Optional[CircuitBreaker] = None,
+        metric_labels: Optional[dict[str, str]] = None,
+    ):
+        self.name = name
+        self.is_retryable = is_retryable
+        self.is_error_response = is_error_response
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker
+        # Labels of the failed attempts in presti_upstream_errors_total
+        self.metric_labels = metric_labels or {
+            "upstream": name,
+            "model": "",
+            "endpoint": "",
+        }
+        self.retries = 0
+
+    async def call(
+        self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any
+    ) -> Any:
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(1, self.max_attempts + 1):
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                result = await func(*args, **kwargs)
+            except BulkheadFullError:
+                if self.breaker is not None:
+                    self.breaker.release()
+                raise
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if not retryable and not self.is_error_response(e):
+                    if self.breaker is not None:
+                        self.breaker.release()
+                    raise
+                UPSTREAM_ERRORS.labels(**self.metric_labels, error=error_label(e)).inc()
+                if self.breaker is not None:
+                    if retryable:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+                )
+                if (
+                    not retryable
+                    or attempt == self.max_attempts
+                    or time.monotonic() + delay > deadline
+                ):
+                    raise
+                logger.info(
+                    f"Retrying {self.name} in {delay:.2f}s after attempt {attempt}: {e!r}"
+                )
+                self.retries += 1
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Cancelled, the upstream's state is unknown
+                if self.breaker is not None:
+                    self.breaker.release()
+                raise
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+    def __call__(self, func: Callable[..., Awaitable[Any]]):
+        """Use the policy as a decorator of a coroutine function."""
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            return await self.call(func, *args, **kwargs)
+
+        return wrapper
+
+
+# Every circuit breaker by name, for the stats endpoint
+CIRCUIT_BREAKERS: dict[str, CircuitBreaker] = {}
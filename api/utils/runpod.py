@@ -1,12 +1,101 @@
-import os
-from typing import List, Union
+import asyncio
+import importlib.util
+import logging
+import statistics
+import time
+from collections import deque
+from contextlib import AsyncExitStack
+from typing import List, Optional, Union
 
 from decouple import config
-import requests
+import httpx
 from PIL import Image
-from retry import retry
 
+from api.utils.bulkhead import Bulkhead
 from api.utils.image import base64_string_to_image
+from api.utils.retry_policy import CircuitBreaker, RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+RUNPOD_CONNECT_TIMEOUT = config("RUNPOD_CONNECT_TIMEOUT", default=10, cast=float)
+# /runsync holds the request open for the whole inference
+RUNPOD_READ_TIMEOUT = config("RUNPOD_READ_TIMEOUT", default=120, cast=float)
+RUNPOD_MAX_CONNECTIONS_PER_ENDPOINT = config(
+    "RUNPOD_MAX_CONNECTIONS_PER_ENDPOINT", default=20, cast=int
+)
+RUNPOD_KEEPALIVE_EXPIRY = config("RUNPOD_KEEPALIVE_EXPIRY", default=60, cast=float)
+# Inferences running at once per endpoint, and waiting for one of them to finish
+RUNPOD_MAX_CONCURRENCY_PER_ENDPOINT = config(
+    "RUNPOD_MAX_CONCURRENCY_PER_ENDPOINT",
+    default=RUNPOD_MAX_CONNECTIONS_PER_ENDPOINT,
+    cast=int,
+)
+RUNPOD_MAX_QUEUE_PER_ENDPOINT = config(
+    "RUNPOD_MAX_QUEUE_PER_ENDPOINT", default=50, cast=int
+)
+RUNPOD_RETRY_AFTER = config("RUNPOD_RETRY_AFTER", default=30, cast=int)
+RUNPOD_RETRY_DEADLINE = config("RUNPOD_RETRY_DEADLINE", default=60, cast=float)
+# How long a synchronous call keeps polling a job that /runsync handed back unfinished
+RUNPOD_SYNC_TIMEOUT = config("RUNPOD_SYNC_TIMEOUT", default=600, cast=float)
+RUNPOD_STATUS_POLL_INTERVAL = config(
+    "RUNPOD_STATUS_POLL_INTERVAL", default=1, cast=float
+)
+
+# Hedging: synchronous calls go through /run, and a duplicate job is submitted
+# when the first one is slower than the given percentile of recent calls
+RUNPOD_HEDGING = config("RUNPOD_HEDGING", default=False, cast=bool)
+RUNPOD_HEDGE_PERCENTILE = config("RUNPOD_HEDGE_PERCENTILE", default=90, cast=float)
+# Calls measured before hedging starts, and the calls the percentiles are taken over
+RUNPOD_HEDGE_MIN_SAMPLES = config("RUNPOD_HEDGE_MIN_SAMPLES", default=20, cast=int)
+RUNPOD_HEDGE_WINDOW = config("RUNPOD_HEDGE_WINDOW", default=200, cast=int)
+# Share of recent calls that may be hedged, so that hedging cannot double the
+# load of an endpoint that is slow for everyone
+RUNPOD_HEDGE_MAX_RATE = config("RUNPOD_HEDGE_MAX_RATE", default=0.2, cast=float)
+
+RUNPOD_PENDING_STATUSES = {"IN_QUEUE", "IN_PROGRESS"}
+RUNPOD_FAILED_STATUSES = {"FAILED", "CANCELLED", "TIMED_OUT"}
+
+RUNPOD_API_URL = "https://api.runpod.ai/v2"
+
+
+def endpoint_id(url: str) -> str:
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def endpoint_url(endpoint_id: str) -> str:
+    return f"{RUNPOD_API_URL}/{endpoint_id}"
+
+
+def create_runpod_http_client(api_key: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        # HTTP/2 needs the optional h2 package
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=RUNPOD_MAX_CONNECTIONS_PER_ENDPOINT,
+            max_keepalive_connections=RUNPOD_MAX_CONNECTIONS_PER_ENDPOINT,
+            keepalive_expiry=RUNPOD_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=RUNPOD_CONNECT_TIMEOUT,
+            read=RUNPOD_READ_TIMEOUT,
+            write=RUNPOD_CONNECT_TIMEOUT,
+            pool=RUNPOD_CONNECT_TIMEOUT,
+        ),
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        },
+    )
+
+
+class RunPodJobError(Exception):
+    """Raised when a RunPod job ends in a failed, cancelled or timed out state."""
+
+    def __init__(self, job_id: str, status: str, error: str | None = None):
+        self.job_id = job_id
+        self.status = status
+        self.error = error
+        super().__init__(f"RunPod job {job_id} {status}: {error}")
 
 
 def extract_base64_content(base64_string: str, output_format: str) -> str:
@@ -19,33 +108,10 @@ def extract_base64_content(base64_string: str, output_format: str) -> str:
     )
 
 
-@retry(tries=3, delay=1, backoff=2)
-def call_runpod_endpoint(
-    url: str, payload: dict, output_format: str = "png"
+def parse_runpod_output(
+    response_json: dict, output_format: str = "png"
 ) -> Union[Image.Image, List[Image.Image]]:
-    """Call a RunPod endpoint and process the image response.
-
-    Args:
-        url: The RunPod endpoint URL
-        payload: The request payload
-        output_format: The expected image format (default: png)
-
-    Returns:
-        A single image or list of images depending on the response
-
-    Raises:
-        requests.exceptions.HTTPError: If the API request fails
-        ValueError: If the response cannot be parsed or processed
-    """
-    headers = {
-        "Authorization": f"Bearer {config('RUNPOD_API_KEY', cast=str)}",
-        "Content-Type": "application/json",
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()  # Raises HTTPError for bad responses
-
-    response_json = response.json()
+    """Decode the images of a completed RunPod job."""
     outputs = (
         [response_json["output"]]
         if isinstance(response_json["output"], str)
@@ -58,3 +124,362 @@ def call_runpod_endpoint(
     ]
 
     return images[0] if len(images) == 1 else images
+
+
+def percentile(values: deque[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+
+class HedgeStats:
+    """Latency of the hedged calls to one endpoint, and how often hedging paid off.
+
+    Both the time a job waits in the RunPod queue and its total latency are
+    measured, so that a job can be hedged as soon as it has been queued for
+    longer than usual, without waiting for the total latency percentile.
+    """
+
+    def __init__(self):
+        self.queue_times: deque[float] = deque(maxlen=RUNPOD_HEDGE_WINDOW)
+        self.latencies: deque[float] = deque(maxlen=RUNPOD_HEDGE_WINDOW)
+        self._recent_hedges: deque[bool] = deque(maxlen=RUNPOD_HEDGE_WINDOW)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.cancelled = 0
+        self.cancel_failures = 0
+        self.hedge_failures = 0
+
+    def hedge_delays(self) -> Optional[tuple[float, float]]:
+        """Queue time and latency past which a job is hedged, in seconds."""
+        if len(self.latencies) < RUNPOD_HEDGE_MIN_SAMPLES:
+            return None
+        return (
+            percentile(self.queue_times, RUNPOD_HEDGE_PERCENTILE),
+            percentile(self.latencies, RUNPOD_HEDGE_PERCENTILE),
+        )
+
+    def can_hedge(self) -> bool:
+        recent = self._recent_hedges
+        return not recent or sum(recent) / len(recent) < RUNPOD_HEDGE_MAX_RATE
+
+    def record(
+        self, response_json: dict, latency: float, hedged: bool, won_by_hedge: bool
+    ):
+        self.calls += 1
+        self.hedged += hedged
+        self.hedge_wins += won_by_hedge
+        self._recent_hedges.append(hedged)
+        self.latencies.append(latency)
+        if "delayTime" in response_json:
+            self.queue_times.append(response_json["delayTime"] / 1000)
+
+    def stats(self) -> dict:
+        delays = self.hedge_delays()
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_rate": self.hedged / self.calls if self.calls else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": self.hedge_wins / self.hedged if self.hedged else 0.0,
+            "cancelled": self.cancelled,
+            "cancel_failures": self.cancel_failures,
+            "hedge_failures": self.hedge_failures,
+            "latency_ms": {
+                "p50": (
+                    statistics.median(self.latencies) * 1000 if self.latencies else 0.0
+                ),
+                "p99": (
+                    percentile(self.latencies, 99) * 1000 if self.latencies else 0.0
+                ),
+            },
+            "hedge_after_ms": (
+                {"queue_time": delays[0] * 1000, "latency": delays[1] * 1000}
+                if delays
+                else None
+            ),
+        }
+
+
+class RunPodClient:
+    """Keep-alive HTTP clients for the RunPod endpoints.
+
+    There is one client per endpoint, so that each endpoint gets its own
+    connection limit, and one bulkhead and one circuit breaker per endpoint, so
+    that a saturated or failing model does not hold up the others. The API key
+    is read once, when the client is built.
+
+    With ``hedging``, synchronous calls are hedged: see ``call_hedged``.
+    """
+
+    def __init__(
+        self, api_key: str, urls: List[str] = (), hedging: bool = RUNPOD_HEDGING
+    ):
+        self.api_key = api_key
+        self.hedging = hedging
+        self.clients: dict[str, httpx.AsyncClient] = {}
+        self.bulkheads: dict[str, Bulkhead] = {}
+        self.retry_policies: dict[str, RetryPolicy] = {}
+        self.hedge_stats: dict[str, HedgeStats] = {}
+        # Keep references to the cancellation tasks so they are not garbage collected
+        self._cancel_tasks: set[asyncio.Task] = set()
+        for url in urls:
+            self.get_client(url)
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        if url not in self.clients:
+            self.clients[url] = create_runpod_http_client(self.api_key)
+            name = f"runpod {endpoint_id(url)}"
+            self.bulkheads[url] = Bulkhead(
+                name,
+                RUNPOD_MAX_CONCURRENCY_PER_ENDPOINT,
+                RUNPOD_MAX_QUEUE_PER_ENDPOINT,
+                RUNPOD_RETRY_AFTER,
+            )
+            self.retry_policies[url] = RetryPolicy(
+                name,
+                deadline=RUNPOD_RETRY_DEADLINE,
+                breaker=CircuitBreaker(name),
+                # The model is set by the router, which knows what each endpoint serves
+                metric_labels={
+                    "upstream": "runpod",
+                    "model": "",
+                    "endpoint": endpoint_id(url),
+                },
+            )
+            self.hedge_stats[url] = HedgeStats()
+        return self.clients[url]
+
+    def get_bulkhead(self, url: str) -> Bulkhead:
+        self.get_client(url)
+        return self.bulkheads[url]
+
+    def get_retry_policy(self, url: str) -> RetryPolicy:
+        self.get_client(url)
+        return self.retry_policies[url]
+
+    async def _post(self, url: str, route: str, payload: dict) -> dict:
+        response = await self.get_client(url).post(f"{url}/{route}", json=payload)
+        response.raise_for_status()  # Raises HTTPStatusError for bad responses
+        return response.json()
+
+    async def _post_with_slot(self, url: str, route: str, payload: dict) -> dict:
+        async with self.get_bulkhead(url).slot():
+            return await self._post(url, route, payload)
+
+    async def _get_job_status(self, url: str, job_id: str) -> dict:
+        response = await self.get_client(url).get(f"{url}/status/{job_id}")
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self) -> None:
+        await asyncio.gather(*self._cancel_tasks, return_exceptions=True)
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+    async def get_health(self, url: str) -> dict:
+        """Fetch the worker and job counts of an endpoint."""
+        response = await self.get_client(url).get(f"{url}/health")
+        response.raise_for_status()
+        return response.json()
+
+    async def warm(self) -> None:
+        """Open a connection to every endpoint, through the cheap /health route."""
+        await asyncio.gather(
+            *(self.get_health(url) for url in list(self.clients)),
+            return_exceptions=True,
+        )
+
+    async def submit_job(self, url: str, payload: dict) -> str:
+        """Queue a job on a RunPod endpoint through /run and return its job id."""
+        response_json = await self.get_retry_policy(url).call(
+            self._post_with_slot, url, "run", payload
+        )
+        return response_json["id"]
+
+    async def get_job_status(self, url: str, job_id: str) -> dict:
+        """Fetch the status of a RunPod job, including its output once completed."""
+        return await self.get_retry_policy(url).call(self._get_job_status, url, job_id)
+
+    async def cancel_job(self, url: str, job_id: str) -> bool:
+        """Cancel a queued or running RunPod job through /cancel. Returns
+        whether it was cancelled."""
+        try:
+            response = await self.get_client(url).post(f"{url}/cancel/{job_id}")
+            response.raise_for_status()
+            return True
+        except httpx.HTTPError as e:
+            logger.warning(f"Could not cancel RunPod job {job_id}: {e!r}")
+            return False
+
+    async def _cancel_loser(self, url: str, job_id: str) -> None:
+        stats = self.hedge_stats[url]
+        if await self.cancel_job(url, job_id):
+            stats.cancelled += 1
+        else:
+            stats.cancel_failures += 1
+
+    def _schedule_cancel(self, url: str, job_id: str) -> None:
+        # The caller does not wait for the loser to be cancelled
+        task = asyncio.create_task(self._cancel_loser(url, job_id))
+        self._cancel_tasks.add(task)
+        task.add_done_callback(self._cancel_tasks.discard)
+
+    async def wait_for_job(self, url: str, response_json: dict) -> dict:
+        """Poll a job returned unfinished by /runsync until it reaches a final state."""
+        deadline = time.monotonic() + RUNPOD_SYNC_TIMEOUT
+        while response_json.get("status") in RUNPOD_PENDING_STATUSES:
+            if time.monotonic() > deadline:
+                raise RunPodJobError(
+                    response_json["id"], "TIMED_OUT", "Timed out waiting for job"
+                )
+            await asyncio.sleep(RUNPOD_STATUS_POLL_INTERVAL)
+            response_json = await self.get_job_status(url, response_json["id"])
+
+        if response_json.get("status") in RUNPOD_FAILED_STATUSES:
+            raise RunPodJobError(
+                response_json.get("id"),
+                response_json["status"],
+                response_json.get("error"),
+            )
+        return response_json
+
+    async def call_endpoint(
+        self, url: str, payload: dict, output_format: str = "png"
+    ) -> Union[Image.Image, List[Image.Image]]:
+        """Call a RunPod endpoint and process the image response.
+
+        Args:
+            url: The RunPod endpoint URL
+            payload: The request payload
+            output_format: The expected image format (default: png)
+
+        Returns:
+            A single image or list of images depending on the response
+
+        Raises:
+            httpx.HTTPError: If the API request fails
+            RunPodJobError: If the job fails on RunPod
+            ValueError: If the response cannot be parsed or processed
+        """
+        if self.hedging:
+            response_json = await self.call_hedged(url, payload)
+            return parse_runpod_output(response_json, output_format)
+
+        # The slot is held until the job is done, it bounds the inferences running at once
+        async with self.get_bulkhead(url).slot():
+            response_json = await self.get_retry_policy(url).call(
+                self._post, url, "runsync", payload
+            )
+
+            # /runsync returns before the job is done when it is still queued or running
+            response_json = await self.wait_for_job(url, response_json)
+
+        return parse_runpod_output(response_json, output_format)
+
+    async def call_hedged(self, url: str, payload: dict) -> dict:
+        """Run a job through /run, and submit a duplicate if it is slow.
+
+        The duplicate is submitted once the job has waited in the RunPod queue
+        for longer than ``RUNPOD_HEDGE_PERCENTILE`` percent of recent jobs, or
+        has not completed within that percentile of recent latencies. The
+        first job to complete wins, the other one is cancelled. A job is only
+        hedged while its endpoint's bulkhead has a free slot for the duplicate
+        and fewer than ``RUNPOD_HEDGE_MAX_RATE`` of recent calls were hedged.
+
+        Returns the status response of the winning job.
+        """
+        bulkhead = self.get_bulkhead(url)
+        policy = self.get_retry_policy(url)
+        stats = self.hedge_stats[url]
+        delays = stats.hedge_delays()
+        # The jobs still running, the first one first
+        submitted: list[str] = []
+        winner: Optional[dict] = None
+        hedged = False
+
+        async with AsyncExitStack() as slots:
+            # Each job holds a slot until the call is done
+            await slots.enter_async_context(bulkhead.slot())
+            try:
+                start = time.monotonic()
+                primary_id = (await policy.call(self._post, url, "run", payload))["id"]
+                submitted.append(primary_id)
+                failure: Optional[dict] = None
+
+                while winner is None:
+                    await asyncio.sleep(RUNPOD_STATUS_POLL_INTERVAL)
+                    statuses = await asyncio.gather(
+                        *(self.get_job_status(url, job_id) for job_id in submitted)
+                    )
+                    for response_json in statuses:
+                        if response_json.get("status") == "COMPLETED":
+                            winner = response_json
+                            break
+                        if response_json.get("status") in RUNPOD_FAILED_STATUSES:
+                            # The other job, if any, may still succeed
+                            failure = response_json
+                            submitted.remove(response_json["id"])
+                    else:
+                        if not submitted:
+                            raise RunPodJobError(
+                                failure.get("id"),
+                                failure["status"],
+                                failure.get("error"),
+                            )
+                        elapsed = time.monotonic() - start
+                        if elapsed > RUNPOD_SYNC_TIMEOUT:
+                            raise RunPodJobError(
+                                primary_id, "TIMED_OUT", "Timed out waiting for job"
+                            )
+                        if (
+                            delays is not None
+                            and len(submitted) == 1
+                            and failure is None
+                            and stats.can_hedge()
+                            and bulkhead.has_capacity()
+                            and (
+                                (
+                                    statuses[0].get("status") == "IN_QUEUE"
+                                    and elapsed > delays[0]
+                                )
+                                or elapsed > delays[1]
+                            )
+                        ):
+                            # Hedged at most once
+                            delays = None
+                            hedge_slot = AsyncExitStack()
+                            try:
+                                await hedge_slot.enter_async_context(bulkhead.slot())
+                                hedge = await policy.call(
+                                    self._post, url, "run", payload
+                                )
+                                hedge_id = hedge["id"]
+                                # Only a submitted duplicate keeps its slot
+                                slots.push_async_exit(hedge_slot.pop_all())
+                                submitted.append(hedge_id)
+                                hedged = True
+                            except Exception as e:
+                                # A hedge is only an optimisation, whatever
+                                # went wrong the first job goes on without it
+                                stats.hedge_failures += 1
+                                logger.warning(
+                                    f"Could not hedge RunPod job {primary_id}: {e!r}"
+                                )
+                            finally:
+                                await hedge_slot.aclose()
+            finally:
+                # The losers, or every job if the call failed or was cancelled
+                for job_id in submitted:
+                    if winner is None or job_id != winner["id"]:
+                        self._schedule_cancel(url, job_id)
+
+        # The latency of the call, not of the winning job alone
+        stats.record(
+            winner,
+            time.monotonic() - start,
+            hedged=hedged,
+            won_by_hedge=winner["id"] != primary_id,
+        )
+        return winner
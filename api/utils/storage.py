@@ -1,45 +1,112 @@
+from typing import Any, Callable
+
 from requests.exceptions import SSLError, ConnectionError
 
-from io import BytesIO
+from decouple import config
+from google.api_core.exceptions import ClientError, ServerError, TooManyRequests
 from google.cloud import storage
 from PIL import Image
-from retry import retry
+
+from api.utils.bulkhead import Bulkhead
+from api.utils.image import PNG_ENCODING, OutputEncoding
+from api.utils.retry_policy import CircuitBreaker, RetryPolicy
 
 BUCKET_NAME = "presti-tmp-test"
 DESTINATION_FOLDER = "gallery"
 
-storage_client = None
+GCS_MAX_CONCURRENCY = config("GCS_MAX_CONCURRENCY", default=16, cast=int)
+GCS_MAX_QUEUE = config("GCS_MAX_QUEUE", default=100, cast=int)
+GCS_RETRY_AFTER = config("GCS_RETRY_AFTER", default=5, cast=int)
+GCS_RETRY_DEADLINE = config("GCS_RETRY_DEADLINE", default=30, cast=float)
+
+gcs_bulkhead = Bulkhead("gcs", GCS_MAX_CONCURRENCY, GCS_MAX_QUEUE, GCS_RETRY_AFTER)
+
+
+def is_retryable_gcs_error(error: BaseException) -> bool:
+    return isinstance(error, (SSLError, ConnectionError, ServerError, TooManyRequests))
+
 
+def is_gcs_error_response(error: BaseException) -> bool:
+    # A missing object or a refused request
+    return isinstance(error, ClientError)
 
-# To cache the google cloud storage client
-def get_storage_client() -> storage.Client:
-    global storage_client
-    if not storage_client:
-        storage_client = storage.Client()
-    return storage_client
+
+gcs_retry = RetryPolicy(
+    "gcs",
+    is_retryable=is_retryable_gcs_error,
+    is_error_response=is_gcs_error_response,
+    deadline=GCS_RETRY_DEADLINE,
+    breaker=CircuitBreaker("gcs"),
+)
+
+
+async def call_gcs(func: Callable, *args: Any, shed: bool = True, **kwargs: Any) -> Any:
+    """Run a blocking call to GCS in the bulkhead's threads, retrying its
+    transient errors from the event loop rather than asleep in a thread."""
+    return await gcs_retry.call(gcs_bulkhead.run_sync, func, *args, shed=shed, **kwargs)
+
+
+def create_storage_client() -> storage.Client:
+    # Resolving the credentials is slow, the client is built once by the app lifespan
+    return storage.Client()
 
 
 def upload_blob_from_memory(
-    bucket_name: str, contents: bytes, destination_blob_name: str
+    storage_client: storage.Client,
+    bucket_name: str,
+    contents: bytes,
+    destination_blob_name: str,
+    content_type: str = "image/png",
 ) -> str:
     """Uploads a file to the bucket."""
 
-    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
-    blob.upload_from_string(contents)
+    blob.upload_from_string(contents, content_type=content_type)
 
     return blob.public_url
 
 
-@retry(exceptions=(SSLError, ConnectionError), tries=3, delay=1, backoff=2)
-def upload_image(image: bytes, file_path: str) -> str:
+def download_blob_to_memory(
+    storage_client: storage.Client, bucket_name: str, source_blob_name: str
+) -> bytes:
+    """Downloads a blob from the bucket."""
+
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(source_blob_name)
+    return blob.download_as_bytes()
+
+
+def upload_image(
+    storage_client: storage.Client,
+    image: bytes,
+    file_path: str,
+    content_type: str = "image/png",
+) -> str:
     path_uploaded_image = f"{DESTINATION_FOLDER}/{file_path}"
-    return upload_blob_from_memory(BUCKET_NAME, image, path_uploaded_image)
+    return upload_blob_from_memory(
+        storage_client, BUCKET_NAME, image, path_uploaded_image, content_type
+    )
+
 
+def image_public_url(storage_client: storage.Client, file_path: str) -> str:
+    """URL of an image uploaded with ``upload_image``, known before the upload is done."""
+    path_uploaded_image = f"{DESTINATION_FOLDER}/{file_path}"
+    return storage_client.bucket(BUCKET_NAME).blob(path_uploaded_image).public_url
 
-def upload_image_pil(image: Image, file_path: str, format: str = "PNG") -> str:
-    buffered = BytesIO()
-    image.save(buffered, format=format)
-    url = upload_image(buffered.getvalue(), file_path)
+
+def upload_image_pil(
+    storage_client: storage.Client,
+    image: Image,
+    file_path: str,
+    encoding: OutputEncoding = PNG_ENCODING,
+) -> str:
+    url = upload_image(
+        storage_client, encoding.encode(image), file_path, encoding.media_type
+    )
     return url
+
+
+def download_image(storage_client: storage.Client, file_path: str) -> bytes:
+    path_uploaded_image = f"{DESTINATION_FOLDER}/{file_path}"
+    return download_blob_to_memory(storage_client, BUCKET_NAME, path_uploaded_image)
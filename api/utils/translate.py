@@ -1,10 +1,34 @@
+import re
+
 from decouple import config
 from pydantic import BaseModel
-from openai import OpenAI
-from langdetect import detect
-import os
+from openai import AsyncOpenAI
+from langdetect import DetectorFactory, detect
+from langdetect.detector_factory import init_factory
 from typing import Tuple
-from retry import retry
+
+from api.utils.cache import StatsTTLCache
+from api.utils.openai_client import openai_bulkhead, openai_retry
+
+# Function words that practically only show up in English text (words shared
+# with other languages, like "a", "in" or "on", are left out). A prompt made of
+# ASCII words with several of these is English, no need to run detection.
+ENGLISH_FUNCTION_WORDS = frozenset(
+    {
+        "the", "and", "with", "without", "of", "at", "to", "for", "from",
+        "by", "into", "onto", "under", "above", "below", "behind", "near",
+        "next", "between", "through", "around", "are", "this", "that",
+        "these", "its", "some",
+    }
+)  # fmt: skip
+ENGLISH_MIN_FUNCTION_WORDS = 2
+ENGLISH_MIN_FUNCTION_WORD_RATIO = 0.15
+
+translation_cache = StatsTTLCache(
+    name="translations",
+    maxsize=config("TRANSLATION_CACHE_MAX_SIZE", default=5_000, cast=int),
+    ttl=config("TRANSLATION_CACHE_TTL_SECONDS", default=7 * 24 * 3600, cast=float),
+)
 
 
 class TranslatedPromptSchema(BaseModel):
@@ -12,8 +36,41 @@ class TranslatedPromptSchema(BaseModel):
     original_prompt_language_ISO_639: str
 
 
-@retry(tries=3, delay=1, backoff=2)
-def translate_prompt_if_needed(prompt: str) -> Tuple[str, str]:
+def preload_language_detector() -> None:
+    """Load the langdetect profiles now rather than on the first request."""
+    # Make detection deterministic, so a cached result matches a fresh one
+    DetectorFactory.seed = 0
+    init_factory()
+
+
+def looks_english(prompt: str) -> bool:
+    if not prompt.isascii():
+        return False
+    words = re.findall(r"[a-z]+", prompt.lower())
+    function_words = sum(word in ENGLISH_FUNCTION_WORDS for word in words)
+    return (
+        function_words >= ENGLISH_MIN_FUNCTION_WORDS
+        and function_words / len(words) >= ENGLISH_MIN_FUNCTION_WORD_RATIO
+    )
+
+
+async def translate_prompt_if_needed(
+    prompt: str, openai_client: AsyncOpenAI
+) -> Tuple[str, str]:
+    if looks_english(prompt):
+        return prompt, "en"
+
+    found, result = translation_cache.lookup(prompt)
+    if not found:
+        result = await detect_and_translate_prompt(prompt, openai_client)
+        translation_cache.set(prompt, result)
+    return result
+
+
+@openai_retry
+async def detect_and_translate_prompt(
+    prompt: str, openai_client: AsyncOpenAI
+) -> Tuple[str, str]:
     try:
         prompt_language = detect(prompt)
     except:
@@ -22,21 +79,21 @@ def translate_prompt_if_needed(prompt: str) -> Tuple[str, str]:
     if prompt_language == "en":
         return prompt, prompt_language
 
-    client = OpenAI(api_key=config("OPENAI_API_KEY", cast=str))
-    chat_completion = client.beta.chat.completions.parse(
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant that translates prompts to english if they are not already in english. If the prompt is already in english, you return it as is.",
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            },
-        ],
-        response_format=TranslatedPromptSchema,
-        model="gpt-4o-mini",
-    )
+    async with openai_bulkhead.slot():
+        chat_completion = await openai_client.beta.chat.completions.parse(
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant that translates prompts to english if they are not already in english. If the prompt is already in english, you return it as is.",
+                },
+                {
+                    "role": "user",
+                    "content": prompt,
+                },
+            ],
+            response_format=TranslatedPromptSchema,
+            model="gpt-4o-mini",
+        )
 
     response = chat_completion.choices[0].message.parsed
     return response.translated_prompt_to_english, prompt_language
@@ -0,0 +1,200 @@
+import base64
+import json
+from io import BytesIO
+from typing import Type, TypeVar
+
+from decouple import config
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+import httpx
+from PIL import Image, UnidentifiedImageError
+from pydantic import BaseModel, ValidationError
+from starlette.datastructures import UploadFile
+
+from api.utils.public_network import (
+    NonPublicURLError,
+    PublicTransport,
+    check_public_url,
+)
+
+# Large enough for an 8192x8192 RGBA PNG, the largest accepted packshot
+MAX_IMAGE_UPLOAD_BYTES = config(
+    "MAX_IMAGE_UPLOAD_BYTES", default=300 * 1024 * 1024, cast=int
+)
+RAW_IMAGE_CONTENT_TYPES = ("image/png", "image/jpeg", "image/webp")
+IMAGE_FETCH_TIMEOUT = config("IMAGE_FETCH_TIMEOUT", default=20, cast=float)
+IMAGE_FETCH_MAX_CONNECTIONS = config(
+    "IMAGE_FETCH_MAX_CONNECTIONS", default=50, cast=int
+)
+
+OptionsModel = TypeVar("OptionsModel", bound=BaseModel)
+
+
+def decode_base64_image(image: str) -> bytes:
+    """Decode a base64 image, with or without its data URL prefix."""
+    # Remove data URI prefix if present
+    if image.startswith("data:image"):
+        image = image.split(",", 1)[1]
+    try:
+        return base64.b64decode(image)
+    except base64.binascii.Error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid base64 image data: {e}")
+
+
+def open_image(image_data: bytes) -> Image.Image:
+    try:
+        return Image.open(BytesIO(image_data))
+    except UnidentifiedImageError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image data: {e}")
+
+
+def check_upload_size(size: int | None) -> None:
+    if size is not None and size > MAX_IMAGE_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is too large, the maximum upload size is {MAX_IMAGE_UPLOAD_BYTES} bytes.",
+        )
+
+
+async def read_raw_body(request: Request) -> bytes:
+    content_length = request.headers.get("content-length")
+    check_upload_size(int(content_length) if content_length else None)
+    chunks, size = [], 0
+    # Read chunk by chunk so that an oversized body is rejected before it is buffered
+    async for chunk in request.stream():
+        size += len(chunk)
+        check_upload_size(size)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def read_image_upload(request: Request, field: str) -> tuple[bytes, dict]:
+    """Read the image of a binary upload, along with its options.
+
+    The image is either the ``field`` file of a multipart/form-data body, or
+    the whole body of an image/png, image/jpeg or image/webp request. Options
+    are taken from the query string and, for multipart bodies, from the other
+    form fields.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    params = dict(request.query_params)
+
+    if content_type == "multipart/form-data":
+        async with request.form(max_files=1) as form:
+            upload = form.get(field)
+            if not isinstance(upload, UploadFile):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Missing image file in the '{field}' form field.",
+                )
+            check_upload_size(upload.size)
+            image_data = await upload.read()
+            params.update(
+                (key, value)
+                for key, value in form.multi_items()
+                if not isinstance(value, UploadFile)
+            )
+    elif content_type in RAW_IMAGE_CONTENT_TYPES:
+        image_data = await read_raw_body(request)
+    else:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported content type '{content_type}'. Send multipart/form-data or one of {', '.join(RAW_IMAGE_CONTENT_TYPES)}.",
+        )
+
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Empty image upload.")
+    return image_data, params
+
+
+def create_image_fetch_client() -> httpx.AsyncClient:
+    """Keep-alive client to download the images given by URL, shared by all requests."""
+    return httpx.AsyncClient(
+        timeout=IMAGE_FETCH_TIMEOUT,
+        transport=PublicTransport(
+            httpx.Limits(max_connections=IMAGE_FETCH_MAX_CONNECTIONS)
+        ),
+        follow_redirects=False,
+    )
+
+
+async def fetch_image(client: httpx.AsyncClient, url: str) -> bytes:
+    """Download an image given by URL, with the same size limit as uploads.
+
+    Only public http(s) URLs are fetched. The upstream's answer is not echoed
+    back, so that the endpoint cannot be used to probe other hosts.
+    """
+    try:
+        await check_public_url(url)
+    except NonPublicURLError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image URL {url}: {e}")
+    try:
+        async with client.stream("GET", url) as response:
+            if not response.is_success:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Could not download the image at {url}.",
+                )
+            content_length = response.headers.get("content-length")
+            check_upload_size(int(content_length) if content_length else None)
+            chunks, size = [], 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                check_upload_size(size)
+                chunks.append(chunk)
+    except httpx.HTTPError:
+        raise HTTPException(
+            status_code=400, detail=f"Could not download the image at {url}."
+        )
+    return b"".join(chunks)
+
+
+def parse_upload_options(model: Type[OptionsModel], params: dict) -> OptionsModel:
+    """Validate form or query string options with the model of the JSON endpoint."""
+    try:
+        # Structured options (like a per-side margin) are sent as JSON strings
+        params = {
+            key: json.loads(value) if value[:1] in ("{", "[") else value
+            for key, value in params.items()
+        }
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON option: {e}")
+    try:
+        return model.model_validate(params)
+    except ValidationError as e:
+        # Same error locations as the validation of a JSON body
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors()]
+        )
+
+
+def image_upload_openapi(
+    options_model: Type[BaseModel], field: str, description: str
+) -> dict:
+    """OpenAPI request body of an upload endpoint, documenting both body types."""
+    schema = options_model.model_json_schema()
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            field: {
+                                "type": "string",
+                                "format": "binary",
+                                "description": description,
+                            },
+                            **schema.get("properties", {}),
+                        },
+                        "required": [field, *schema.get("required", [])],
+                    }
+                },
+                **{
+                    content_type: {"schema": {"type": "string", "format": "binary"}}
+                    for content_type in RAW_IMAGE_CONTENT_TYPES
+                },
+            },
+        }
+    }
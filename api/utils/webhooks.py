@@ -0,0 +1,42 @@
+import hashlib
+import hmac
+import time
+
+from decouple import config
+import httpx
+
+from api.utils.public_network import PublicTransport
+
+WEBHOOK_TIMEOUT = config("WEBHOOK_TIMEOUT", default=10, cast=float)
+WEBHOOK_MAX_CONNECTIONS = config("WEBHOOK_MAX_CONNECTIONS", default=50, cast=int)
+
+SIGNATURE_HEADER = "X-Presti-Signature"
+
+
+def create_webhook_client() -> httpx.AsyncClient:
+    """Keep-alive client for callback deliveries, shared by all jobs. It only
+    connects to public addresses."""
+    return httpx.AsyncClient(
+        timeout=WEBHOOK_TIMEOUT,
+        transport=PublicTransport(
+            httpx.Limits(max_connections=WEBHOOK_MAX_CONNECTIONS)
+        ),
+        follow_redirects=False,
+    )
+
+
+def sign_payload(secret: str, body: bytes, timestamp: int | None = None) -> str:
+    """Build the signature header value for a webhook body.
+
+    The signature is an HMAC-SHA256 of "{timestamp}.{body}" keyed with the
+    secret, sent as "t={timestamp},v1={hex digest}". Receivers should recompute
+    it and reject old timestamps to prevent replays.
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed_content = f"{timestamp}.".encode() + body
+    digest = hmac.new(secret.encode(), signed_content, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def is_retryable_status(status_code: int) -> bool:
+    return status_code >= 500 or status_code in (408, 429)
@@ -0,0 +1,130 @@
+"""Event loop latency of generate_background's image work, with and without the process pool.
+
+A probe coroutine wakes up every millisecond and records how late it was woken,
+while concurrent simulated requests build the control image and post-process
+and encode the generation, as the handler does:
+
+- inline: on the event loop, as the handler used to
+- thread: in threads (IMAGE_PROCESS_POOL_SIZE=0)
+- process: in the image process pool
+
+Run from the repository root:
+
+    python -m benchmarks.event_loop_latency --multiplier 4 --requests 8
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from PIL import Image, ImageDraw
+
+from api.endpoints.v1.generate_background.helpers import (
+    build_control_image,
+    postprocess_and_encode,
+)
+from api.utils.image import PNG_ENCODING
+from api.utils.image_pool import IMAGE_PROCESS_POOL_SIZE, ImageProcessPool
+
+PROBE_INTERVAL = 0.001
+
+
+def make_packshot(width: int, height: int) -> Image.Image:
+    packshot = Image.new("RGBA", (width, height))
+    draw = ImageDraw.Draw(packshot)
+    draw.ellipse(
+        (width // 4, height // 4, 3 * width // 4, 3 * height // 4),
+        fill=(180, 120, 60, 255),
+    )
+    return packshot
+
+
+def make_generation(width: int, height: int) -> Image.Image:
+    # The model pads its output to a multiple of 64
+    return Image.effect_noise((width + 64, height + 64), 64).convert("RGB")
+
+
+async def probe_loop_lag(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def simulated_request(
+    mode: str, pool: ImageProcessPool, packshot: Image.Image, generation: Image.Image
+) -> None:
+    width, height = packshot.size
+    control_args = (packshot, width, height, True)
+    postprocess_args = (generation, packshot, width, height, PNG_ENCODING)
+    if mode == "inline":
+        build_control_image(*control_args)
+        postprocess_and_encode(*postprocess_args)
+    elif mode == "thread":
+        await asyncio.to_thread(build_control_image, *control_args)
+        await asyncio.to_thread(postprocess_and_encode, *postprocess_args)
+    else:
+        await pool.run(build_control_image, *control_args)
+        await pool.run(postprocess_and_encode, *postprocess_args)
+
+
+async def run_mode(
+    mode: str,
+    pool: ImageProcessPool,
+    packshot: Image.Image,
+    generation: Image.Image,
+    requests: int,
+) -> dict:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_loop_lag(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(simulated_request(mode, pool, packshot, generation) for _ in range(requests))
+    )
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    lags.sort()
+    return {
+        "mode": mode,
+        "wall_s": elapsed,
+        "lag_p50_ms": statistics.median(lags) * 1000,
+        "lag_p99_ms": lags[int(len(lags) * 0.99)] * 1000,
+        "lag_max_ms": lags[-1] * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--multiplier", type=int, default=4, choices=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=IMAGE_PROCESS_POOL_SIZE or 1)
+    args = parser.parse_args()
+
+    width, height = args.width * args.multiplier, args.height * args.multiplier
+    packshot = make_packshot(width, height)
+    generation = make_generation(width, height)
+    pool = ImageProcessPool(max_workers=args.workers)
+    await pool.warm()
+
+    print(
+        f"{width}x{height}, {args.requests} concurrent requests, {args.workers} workers"
+    )
+    print(f"{'mode':<8} {'wall s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    try:
+        for mode in ("inline", "thread", "process"):
+            result = await run_mode(mode, pool, packshot, generation, args.requests)
+            print(
+                f"{result['mode']:<8} {result['wall_s']:>8.2f} {result['lag_p50_ms']:>8.1f} "
+                f"{result['lag_p99_ms']:>8.1f} {result['lag_max_ms']:>8.1f}"
+            )
+    finally:
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
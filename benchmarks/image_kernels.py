@@ -0,0 +1,96 @@
+"""Micro-benchmarks of api.utils.image_kernels against the code they replaced.
+
+For each of the ALLOWED_DIMENSIONS (up to --max-multiplier), times on the same
+packshot:
+
+- alpha presence: ``split()`` band count vs ``has_alpha``
+- alpha threshold: ``split()[3].point(lambda)`` vs ``threshold_alpha_mask``
+- alpha bbox: ``crop_to_content``'s conversion to RGBA and ``getbbox`` vs
+  ``alpha_bbox``, on an LA packshot (RGBA ones were not converted)
+- composite: paste of the whole packshot vs ``composite_over``
+
+The packshot is opaque over the middle quarter of the image, like a cutout
+placed on its canvas. Run from the repository root:
+
+    python -m benchmarks.image_kernels --max-multiplier 4
+"""
+
+import argparse
+import time
+from typing import Callable
+
+from PIL import Image
+
+from api.utils import image_kernels
+from api.utils.constants import ALLOWED_DIMENSIONS
+from benchmarks.event_loop_latency import make_generation, make_packshot
+
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+    """Fastest of ``repeat`` runs, in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def baseline_composite(generation: Image.Image, packshot: Image.Image) -> Image.Image:
+    generation.paste(im=packshot, mask=packshot)
+    return generation.convert("RGB")
+
+
+def kernel_cases(
+    packshot: Image.Image, generation: Image.Image
+) -> dict[str, tuple[Callable[[], object], Callable[[], object]]]:
+    gray_packshot = packshot.convert("LA")
+    return {
+        "alpha presence": (
+            lambda: len(packshot.split()) >= 4,
+            lambda: image_kernels.has_alpha(packshot.mode),
+        ),
+        "alpha threshold": (
+            lambda: packshot.split()[3].point(lambda x: 255 if x >= 128 else 0),
+            lambda: image_kernels.threshold_alpha_mask(packshot),
+        ),
+        "alpha bbox": (
+            lambda: gray_packshot.convert("RGBA").getbbox(),
+            lambda: image_kernels.alpha_bbox(gray_packshot),
+        ),
+        "composite": (
+            lambda: baseline_composite(generation.copy(), packshot),
+            lambda: image_kernels.composite_over(generation.copy(), packshot),
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-multiplier", type=int, default=8, choices=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    dimensions = sorted(
+        ALLOWED_DIMENSIONS, key=lambda dimension: dimension[0] * dimension[1]
+    )
+    print(
+        f"{'size':<11} {'kernel':<16} {'before ms':>10} {'after ms':>10} {'speedup':>8}"
+    )
+    for width, height in dimensions:
+        if width * height > (1024 * args.max_multiplier) ** 2:
+            continue
+        packshot = make_packshot(width, height)
+        # Same size as the packshot, as after the model's padding is cropped
+        generation = make_generation(width, height).crop((0, 0, width, height))
+        for name, (baseline, kernel) in kernel_cases(packshot, generation).items():
+            before = best_of(baseline, args.repeat)
+            after = best_of(kernel, args.repeat)
+            print(
+                f"{f'{width}x{height}':<11} {name:<16} {before:>10.2f} {after:>10.2f} "
+                f"{before / max(after, 1e-6):>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Quality and latency of proxy segmentation against full resolution segmentation.
+
+A synthetic photo is composed from a known, anti-aliased alpha mask. The
+segmentation service is simulated as ideal: it returns the known mask at the
+resolution of the image it receives. Full resolution segmentation is then
+exact, and the proxy path is measured for what it loses and saves:
+
+- upload: bytes sent to the segmentation service
+- encode: time to encode what is sent (with the downscale, for the proxy)
+- refine: time to bring the proxy mask back to full resolution
+- MAE: mean absolute alpha error (0-255), over the image and over the edges,
+  for the guided upsampling and for a plain bicubic upsampling
+
+Run from the repository root:
+
+    python -m benchmarks.segmentation_proxy --max-size 2048
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from api.endpoints.v1.remove_background.helpers import (
+    SEGMENTATION_PROXY_MAX_SIZE,
+    apply_proxy_cutout,
+    encode_segmentation_proxy,
+)
+
+SIZES = [(3024, 4032), (4000, 6000), (6000, 8000)]
+# Supersampling of the drawn mask, for anti-aliased edges
+MASK_SUPERSAMPLING = 4
+
+
+def make_mask(width: int, height: int) -> Image.Image:
+    scale = MASK_SUPERSAMPLING
+    mask = Image.new("L", (width * scale, height * scale))
+    draw = ImageDraw.Draw(mask)
+    w, h = width * scale, height * scale
+    draw.ellipse((w // 5, h // 6, 3 * w // 5, 5 * h // 6), fill=255)
+    draw.polygon(
+        [(w * 0.55, h * 0.2), (w * 0.9, h * 0.5), (w * 0.6, h * 0.9)], fill=255
+    )
+    return mask.resize((width, height), Image.Resampling.BOX)
+
+
+def make_photo(mask: Image.Image) -> Image.Image:
+    # A product of one color on a textured background of similar brightness
+    background = Image.effect_noise(mask.size, 24).convert("RGB")
+    product = Image.new("RGB", mask.size, (200, 90, 40))
+    photo = Image.composite(product, background, mask)
+    encoded = io.BytesIO()
+    photo.save(encoded, format="JPEG", quality=90)
+    return Image.open(io.BytesIO(encoded.getvalue()))
+
+
+def simulated_cutout(data: bytes, mask: Image.Image) -> Image.Image:
+    """The cutout an ideal segmentation service returns for the encoded image."""
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    image.putalpha(mask.resize(image.size, Image.Resampling.LANCZOS))
+    return image
+
+
+def alpha_errors(alpha: Image.Image, mask: Image.Image, edges: np.ndarray) -> str:
+    errors = np.abs(
+        np.asarray(alpha, dtype=np.int16) - np.asarray(mask, dtype=np.int16)
+    )
+    return f"{errors.mean():.3f} / {errors[edges].mean():.2f}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-size", type=int, default=SEGMENTATION_PROXY_MAX_SIZE)
+    args = parser.parse_args()
+
+    print(
+        f"{'size':<11} {'path':<6} {'upload MB':>10} {'encode ms':>10} "
+        f"{'refine ms':>10} {'MAE guided':>15} {'MAE bicubic':>15}"
+    )
+    for width, height in SIZES:
+        mask = make_mask(width, height)
+        photo = make_photo(mask)
+        photo.load()
+        # Pixels within a few pixels of a transition
+        edges = np.asarray(mask.filter(ImageFilter.MaxFilter(9))) != np.asarray(
+            mask.filter(ImageFilter.MinFilter(9))
+        )
+        label = f"{width}x{height}"
+
+        start = time.perf_counter()
+        full_data = io.BytesIO()
+        photo.save(full_data, format="JPEG")
+        encode_ms = (time.perf_counter() - start) * 1000
+        print(
+            f"{label:<11} {'full':<6} {len(full_data.getvalue()) / 1e6:>10.2f} "
+            f"{encode_ms:>10.0f} {0:>10.0f} {'exact':>15} {'exact':>15}"
+        )
+
+        start = time.perf_counter()
+        proxy_data = encode_segmentation_proxy(photo, "JPEG", args.max_size)
+        encode_ms = (time.perf_counter() - start) * 1000
+        cutout = simulated_cutout(proxy_data, mask)
+        start = time.perf_counter()
+        result = apply_proxy_cutout(photo, cutout)
+        refine_ms = (time.perf_counter() - start) * 1000
+        bicubic = cutout.getchannel("A").resize(photo.size, Image.Resampling.BICUBIC)
+        print(
+            f"{label:<11} {'proxy':<6} {len(proxy_data) / 1e6:>10.2f} "
+            f"{encode_ms:>10.0f} {refine_ms:>10.0f} "
+            f"{alpha_errors(result.getchannel('A'), mask, edges):>15} "
+            f"{alpha_errors(bicubic, mask, edges):>15}"
+        )
+
+
+if __name__ == "__main__":
+    main()
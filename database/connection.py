@@ -1,35 +1,53 @@
 from decouple import config
-from sqlalchemy import create_engine
+from fastapi import Request
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import QueuePool
+from sqlmodel.ext.asyncio.session import AsyncSession
 import logging
 
 logger = logging.getLogger(__name__)
 
+# DATABASE_URL keeps the psycopg2 driver for Alembic, the API itself talks to
+# Postgres through asyncpg
 SQLALCHEMY_DATABASE_URL = config("DATABASE_URL", cast=str)
-
-# Enhanced engine configuration for production
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    client_encoding="utf8",
-    poolclass=QueuePool,
-    pool_pre_ping=True,  # Verify connections before use (prevents stale connections)
-    pool_recycle=3600,  # Recycle connections after 1 hour
+ASYNC_DATABASE_URL = make_url(SQLALCHEMY_DATABASE_URL).set(
+    drivername="postgresql+asyncpg"
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=5, cast=int)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", default=10, cast=int)
+DB_POOL_TIMEOUT = config("DB_POOL_TIMEOUT", default=30, cast=float)
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    except Exception as e:
-        logger.error(f"Database session error: {e}")
-        db.rollback()
-        raise
-    finally:
-        db.close()
+def create_db_engine() -> AsyncEngine:
+    # Enhanced engine configuration for production
+    return create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=True,  # Verify connections before use (prevents stale connections)
+        pool_recycle=3600,  # Recycle connections after 1 hour
+    )
+
+
+def create_sessionmaker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    # expire_on_commit is disabled so that attributes stay readable after a commit
+    # without an implicit (and, in async mode, forbidden) lazy refresh
+    return async_sessionmaker(
+        bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+
+async def get_db(request: Request):
+    # The engine is owned by the resources built in the app lifespan
+    async with request.app.state.resources.db_sessionmaker() as db:
+        try:
+            yield db
+        except Exception as e:
+            logger.error(f"Database session error: {e}")
+            await db.rollback()
+            raise
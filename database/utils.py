@@ -1,17 +1,22 @@
-from sqlalchemy.orm import Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from database.connection import get_db
 from api.models.user_models import User
 
 
-def check_api_key(api_key: str, db: Session) -> bool:
-    """Check if API key is valid and user is active"""
-    user = db.query(User).filter(User.api_key == api_key).first()
-    if user and user.is_active:
-        return True
-    return False
+async def get_user_from_api_key(api_key: str, db: AsyncSession) -> User | None:
+    """Get user by API key"""
+    result = await db.exec(select(User).where(User.api_key == api_key))
+    return result.first()
 
 
-def get_user_from_api_key(api_key: str, db: Session) -> User | None:
-    """Get user by API key"""
-    return db.query(User).filter(User.api_key == api_key).first()
+async def set_user_active(user: User, is_active: bool, db: AsyncSession) -> User:
+    """Activate or deactivate a user"""
+    try:
+        user.is_active = is_active
+        await db.commit()
+        await db.refresh(user)
+    except Exception as e:
+        await db.rollback()
+        raise e
+    return user
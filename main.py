@@ -1,3 +1,6 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
@@ -9,6 +12,11 @@ from api.deps.auth import get_user
 from api.endpoints.v1.router import api_router_v1
 
 from api.endpoints.healthcheck.route import router as healthcheck_router
+from api.resources import Resources
+from api.services.job_service import run_job_poller
+from api.services.webhook_service import drain_webhooks
+from api.utils.metrics import start_metrics_server
+from api.utils.translate import preload_language_detector
 
 description = """
 ### Description
@@ -38,6 +46,7 @@ Make sure you never share your API key with anyone, and you never commit it to a
 """
 
 SENTRY_DSN = config("SENTRY_DSN", cast=str)
+JOB_POLLER_ENABLED = config("JOB_POLLER_ENABLED", default=True, cast=bool)
 sentry_sdk.init(
     dsn=SENTRY_DSN,
     # Add data like request headers and IP for users, if applicable;
@@ -55,6 +64,29 @@ sentry_sdk.init(
 )
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Clients are built and warmed before the instance takes traffic, so the
+    # first request does not pay for the cold connections
+    resources = await Resources.create()
+    await resources.warm()
+    app.state.resources = resources
+    metrics_server = start_metrics_server()
+    resources.write_behind.start()
+    preload_language_detector()
+    job_poller_task = (
+        asyncio.create_task(run_job_poller(resources)) if JOB_POLLER_ENABLED else None
+    )
+    yield
+    if job_poller_task:
+        job_poller_task.cancel()
+    # Deliveries that do not finish in time are redelivered by another instance
+    await drain_webhooks()
+    await resources.aclose()
+    if metrics_server:
+        metrics_server.shutdown()
+
+
 app = FastAPI(
     title="Presti AI API",
     description=description,
@@ -65,6 +97,7 @@ app = FastAPI(
         "name": "Presti AI Support",
         "email": "support@presti.ai",
     },
+    lifespan=lifespan,
 )
 
 